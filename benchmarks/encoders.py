@@ -0,0 +1,87 @@
+"""
+Measures how fast the writers encode values, per column type and write
+method, with the compiled row encoders (geopetl.encoding.row_encoder)
+against looking up each value's encoder by type, as prepare_val does.
+
+No database is needed.
+
+    python benchmarks/encoders.py -n 200000
+"""
+import argparse
+import time
+import uuid
+
+from geopetl.encoding import RawValue, row_encoder
+from geopetl.pgcopy import TEXT_ENCODERS, geom_text_encoder
+from geopetl.postgis import LITERAL_ENCODERS, PARAM_CONVERTERS
+
+SRID = 2272
+
+# a typical value per generic column type
+SAMPLES = {
+    'text':         "Roland's code",
+    'num':          12345.678,
+    'date':         '2020-01-02',
+    'timestamp':    '2020-01-02 03:04:05',
+    'timestamptz':  '2020-01-02 03:04:05+00',
+    'boolean':      True,
+    'uuid':         uuid.uuid4(),
+    'geometry':     'POLYGON((2697100.5 241110.25, 2697200.5 241110.25, 2697200.5 241210.25, 2697100.5 241110.25))',
+    # a value read with decode='raw'
+    'raw':          RawValue('12345.678'),
+}
+
+METHODS = {
+    'insert':   dict(LITERAL_ENCODERS),
+    'copy':     dict(TEXT_ENCODERS, geometry=geom_text_encoder(SRID)),
+    'prepared': dict(PARAM_CONVERTERS),
+}
+
+
+def rate(n, fn):
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    return n / elapsed if elapsed else float('inf')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=200000, help='rows to encode per measurement')
+    args = parser.parse_args()
+    n = args.n
+
+    print('{:<12}{:<10}{:>16}'.format('type', 'method', 'values/s'))
+    for type_, val in SAMPLES.items():
+        for method, encoders in METHODS.items():
+            if type_ not in encoders:
+                continue
+            encode_row = row_encoder([(0, encoders[type_])])
+            rows = [(val,)] * n
+
+            def run():
+                for row in rows:
+                    encode_row(row)
+            print('{:<12}{:<10}{:>16,.0f}'.format(type_, method, rate(n, run)))
+
+    # a row with one column of every type the method handles
+    print()
+    print('{:<10}{:>16}{:>16}'.format('method', 'dispatch rows/s', 'compiled rows/s'))
+    for method, encoders in METHODS.items():
+        types = [x for x in SAMPLES if x in encoders]
+        row = tuple([SAMPLES[x] for x in types])
+        rows = [row] * n
+        encode_row = row_encoder([(i, encoders[x]) for i, x in enumerate(types)])
+
+        def dispatch():
+            for row in rows:
+                [encoders[type_](row[i]) for i, type_ in enumerate(types)]
+
+        def compiled():
+            for row in rows:
+                encode_row(row)
+        print('{:<10}{:>16,.0f}{:>16,.0f}'.format(method, rate(n, dispatch), rate(n, compiled)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Compares ways of getting SDE object IDs for a Postgres SDE table:
+
+    per-row         a sde.next_rowid() call per row, as INSERTs inline it
+    per-row trips   a round trip per row
+    block           SdeRowidAllocator, one round trip per block
+
+Every run consumes object IDs from the table's registration, so point it at
+a scratch table.
+
+    python benchmarks/sde_rowids.py postgresql://user:pw@host/db schema.table -n 100000
+"""
+import argparse
+import time
+
+from geopetl.postgis import DEFAULT_ROWID_BLOCK_SIZE, PostgisDatabase, SdeRowidAllocator
+
+
+def timed(label, n, fn):
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    print('{:<16}{:>10.3f}s {:>12.0f} ids/s'.format(label, elapsed, n / elapsed if elapsed else float('inf')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('dsn')
+    parser.add_argument('table')
+    parser.add_argument('-n', type=int, default=100000, help='object IDs to allocate')
+    parser.add_argument('--block-size', type=int, default=DEFAULT_ROWID_BLOCK_SIZE)
+    args = parser.parse_args()
+
+    db = PostgisDatabase(args.dsn)
+    table = db.table(args.table)
+    if not table.is_sde_registered:
+        raise SystemExit('{} is not registered with SDE'.format(args.table))
+    next_rowid = "sde.next_rowid('{}', '{}')".format(table.schema, table.name)
+
+    def per_row():
+        db.fetch('SELECT {} FROM generate_series(1, {})'.format(next_rowid, args.n))
+
+    def per_row_trips():
+        for _ in range(args.n):
+            db.fetch('SELECT {}'.format(next_rowid))
+
+    allocator = SdeRowidAllocator(table, block_size=args.block_size)
+
+    def block():
+        for _ in range(args.n):
+            allocator.next()
+
+    print('sequence: {}'.format(allocator.sequence or 'not found, using sde.next_rowid()'))
+    timed('per-row', args.n, per_row)
+    timed('per-row trips', args.n, per_row_trips)
+    timed('block', args.n, block)
+    print('block round trips: {}'.format(allocator.round_trips))
+    db.dbo.commit()
+
+
+if __name__ == '__main__':
+    main()
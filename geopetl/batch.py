@@ -0,0 +1,345 @@
+"""
+Batching and commit policies shared by the PostGIS and Oracle SDE writers.
+"""
+import csv
+import threading
+import time
+
+DEFAULT_BATCH_ROWS = 1000
+# flush a batch once its values add up to this many bytes, even if it has
+# fewer than the maximum number of rows
+DEFAULT_BATCH_BYTES = 16 * 1024 * 1024
+
+# auto-tuning won't grow a batch past this many rows...
+MAX_AUTO_TUNE_ROWS = 100000
+# ...or let a single batch take longer than this many seconds
+MAX_AUTO_TUNE_SECONDS = 10.0
+# how much faster a bigger batch has to be to keep growing
+AUTO_TUNE_MIN_GAIN = 1.05
+
+# when a writer commits:
+#   batch       after every `commit_every` batches and/or `commit_bytes` bytes
+#   single      once, at the end of the load
+#   savepoint   once, at the end, with a savepoint before each batch. If a
+#               batch fails the load is rolled back to the last good batch,
+#               which is committed, and the error is raised.
+COMMIT_MODES = ('batch', 'single', 'savepoint')
+SAVEPOINT_NAME = 'geopetl_batch'
+
+# what a writer does when the database rejects a row:
+#   raise   roll back as the commit mode says and raise the error
+#   reject  find the rows the database rejects, write them to a reject file
+#           with the error, and keep loading
+ON_ERROR_MODES = ('raise', 'reject')
+REJECT_ERROR_FIELD = 'geopetl_error'
+
+
+def row_size(values):
+    """Estimates the number of bytes a row's values take on the wire."""
+    return sum([len(x) if isinstance(x, (str, bytes)) else 8 for x in values])
+
+
+class Batcher(object):
+    """
+    Collects rows for a writer and hands them to `flush` in batches. A batch
+    is flushed when it reaches `max_rows` rows or `max_bytes` bytes,
+    whichever comes first, so a layer of 2 MB polygons and a layer of 40 byte
+    points both make reasonably sized round trips.
+
+    With auto_tune=True the row cap is adjusted from the measured throughput
+    of each flush: it doubles while rows per second keep improving, then
+    settles on the best size seen. A flush slower than MAX_AUTO_TUNE_SECONDS
+    halves it and settles. The size it settles on is printed when the
+    batcher is closed, so it can be pinned with buffer_size.
+
+    Args:
+        flush:      called with a list of rows for each batch
+        max_rows:   row cap per batch. None means no cap.
+        max_bytes:  byte budget per batch. None means no budget.
+        auto_tune:  tune max_rows from measured throughput
+        commit:     a CommitPolicy to run each flush under. If it has
+                    rejects, the source row given with each row is kept so
+                    rejected rows can be written out as they came in.
+    """
+
+    def __init__(self, flush, max_rows=DEFAULT_BATCH_ROWS, max_bytes=DEFAULT_BATCH_BYTES, auto_tune=False,
+                 commit=None):
+        self._flush = flush
+        self.commit = commit
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.auto_tune = auto_tune
+        self.settled = not auto_tune or not max_rows
+
+        self._rows = []
+        self._sources = [] if commit is not None and commit.rejects is not None else None
+        self._size = 0
+        # (rows per second, max_rows) of the fastest batch so far
+        self._best = (0.0, max_rows)
+
+        # running totals
+        self.batches = 0
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.seconds = 0.0
+
+    def add(self, row, size=0, source=None):
+        """Adds a row of `size` bytes, flushing if the batch is full. `source`
+        is the row as it was read, if `row` is an encoded form of it."""
+        self._rows.append(row)
+        if self._sources is not None:
+            self._sources.append(row if source is None else source)
+        self._size += size
+        if (self.max_rows and len(self._rows) >= self.max_rows) or \
+                (self.max_bytes and self._size >= self.max_bytes):
+            self.flush()
+
+    def flush(self, final=False):
+        """Sends the current batch, if any."""
+        if not self._rows:
+            return
+        rows, size, sources = self._rows, self._size, self._sources
+        self._rows, self._size = [], 0
+        if sources is not None:
+            self._sources = []
+
+        start = time.time()
+        if self.commit:
+            self.commit.run(self._flush, rows, size, sources)
+        else:
+            self._flush(rows)
+        elapsed = time.time() - start
+
+        self.batches += 1
+        self.rows_written += len(rows)
+        self.bytes_written += size
+        self.seconds += elapsed
+        # the last batch is usually short, so it says nothing about size
+        if not self.settled and not final:
+            self._tune(len(rows), elapsed)
+
+    def close(self):
+        """Sends any remaining rows and reports on the batching."""
+        self.flush(final=True)
+        if self.commit:
+            self.commit.finish()
+        if self.auto_tune:
+            print('Geopetl: batch size settled at {} rows ({:.0f} rows/s). Pass buffer_size={} to pin it.'.format(
+                self.max_rows, self.rows_per_second, self.max_rows))
+        return self.stats
+
+    @property
+    def rows_per_second(self):
+        return self.rows_written / self.seconds if self.seconds else 0.0
+
+    @property
+    def stats(self):
+        return {
+            'batches':          self.batches,
+            'rows':             self.rows_written,
+            'bytes':            self.bytes_written,
+            'seconds':          self.seconds,
+            'rows_per_second':  self.rows_per_second,
+            'batch_size':       self.max_rows,
+        }
+
+    def _tune(self, rows, elapsed):
+        # a batch cut short by the byte budget means the budget, not the row
+        # cap, is what limits the batch size
+        if rows < self.max_rows:
+            self.max_rows = max(rows, 1)
+            self.settled = True
+            return
+        if elapsed > MAX_AUTO_TUNE_SECONDS:
+            self.max_rows = max(rows // 2, 1)
+            self.settled = True
+            return
+        rate = rows / elapsed if elapsed else float('inf')
+        best_rate, best_rows = self._best
+        if rate > best_rate * AUTO_TUNE_MIN_GAIN:
+            self._best = (rate, rows)
+            if rows * 2 > MAX_AUTO_TUNE_ROWS:
+                self.settled = True
+            else:
+                self.max_rows = rows * 2
+        else:
+            self.max_rows = best_rows
+            self.settled = True
+
+
+class CommitPolicy(object):
+    """
+    Runs a writer's batches inside transactions according to one of
+    COMMIT_MODES. Committing after every batch costs a WAL flush (or redo
+    sync) each time and lets readers see a truncated, half-loaded table;
+    'single' and 'savepoint' commit once at the end instead.
+
+    Args:
+        dbo:                a DB-API connection
+        mode:               one of COMMIT_MODES
+        every:              in 'batch' mode, commit after this many batches
+        every_bytes:        in 'batch' mode, also commit once this many bytes
+                            have been written since the last commit
+        release_savepoints: release each savepoint after its batch succeeds.
+                            Oracle has no RELEASE SAVEPOINT, so it reuses
+                            the name instead.
+        defer_finish:       leave ending the transaction, by the final
+                            commit or a rollback, to the caller, e.g. to
+                            commit several connections' loads together
+        rejects:            a RejectFile. If given, a failed batch is rolled
+                            back to a savepoint and bisected until the rows
+                            the database rejects are found; those go to the
+                            reject file and the rest are written.
+    """
+
+    def __init__(self, dbo, mode='batch', every=1, every_bytes=None, release_savepoints=True, defer_finish=False,
+                 rejects=None):
+        if mode not in COMMIT_MODES:
+            raise ValueError("Unknown commit mode '{}', expected one of: {}".format(mode, ', '.join(COMMIT_MODES)))
+        self.dbo = dbo
+        self.mode = mode
+        self.every = every
+        self.every_bytes = every_bytes
+        self.release_savepoints = release_savepoints
+        self.defer_finish = defer_finish
+        self.rejects = rejects
+        self._cursor = dbo.cursor()
+
+        # since the last commit
+        self._batches = 0
+        self._bytes = 0
+        self.rows_committed = 0
+        self._rows_pending = 0
+
+    def run(self, flush, rows, size=0, sources=None):
+        """
+        Calls flush(rows), committing or rolling back as the mode says.
+
+        With rejects, `sources` are the rows as they were read, for the
+        reject file, and flush may return (index, error) pairs for rows the
+        database skipped without failing the batch, as Oracle's batcherrors
+        does.
+        """
+        if self.rejects is not None:
+            written = self._isolate(flush, rows, sources or rows)
+            self._count(written, size)
+            return
+        savepoint = self.mode == 'savepoint'
+        if savepoint:
+            self._cursor.execute('SAVEPOINT {}'.format(SAVEPOINT_NAME))
+        try:
+            flush(rows)
+        except Exception:
+            if savepoint:
+                self._cursor.execute('ROLLBACK TO SAVEPOINT {}'.format(SAVEPOINT_NAME))
+                self.commit()
+                print('Geopetl: batch failed, rolled back to the last good batch. {} rows committed.'.format(
+                    self.rows_committed))
+            elif not self.defer_finish:
+                self.dbo.rollback()
+            raise
+        if savepoint and self.release_savepoints:
+            self._cursor.execute('RELEASE SAVEPOINT {}'.format(SAVEPOINT_NAME))
+        self._count(len(rows), size)
+
+    def _isolate(self, flush, rows, sources):
+        """
+        Flushes rows under a savepoint. If that fails, rolls back to it and
+        tries each half, down to single rows, which are rejected. Finding k
+        bad rows in a batch of n takes O(k log n) round trips. Returns the
+        number of rows written.
+        """
+        self._cursor.execute('SAVEPOINT {}'.format(SAVEPOINT_NAME))
+        try:
+            skipped = flush(rows) or []
+        except Exception as e:
+            # if the connection is gone this raises too, ending the load
+            self._cursor.execute('ROLLBACK TO SAVEPOINT {}'.format(SAVEPOINT_NAME))
+            self._release_savepoint()
+            if len(rows) == 1:
+                self.rejects.add(sources[0], e)
+                return 0
+            half = len(rows) // 2
+            return self._isolate(flush, rows[:half], sources[:half]) + \
+                self._isolate(flush, rows[half:], sources[half:])
+        self._release_savepoint()
+        for i, error in skipped:
+            self.rejects.add(sources[i], error)
+        return len(rows) - len(skipped)
+
+    def _release_savepoint(self):
+        if self.release_savepoints:
+            self._cursor.execute('RELEASE SAVEPOINT {}'.format(SAVEPOINT_NAME))
+
+    def _count(self, rows, size):
+        self._batches += 1
+        self._bytes += size
+        self._rows_pending += rows
+        if self.mode == 'batch' and ((self.every and self._batches >= self.every) or
+                                     (self.every_bytes and self._bytes >= self.every_bytes)):
+            self.commit()
+
+    def commit(self):
+        self.dbo.commit()
+        self.rows_committed += self._rows_pending
+        self._batches = 0
+        self._bytes = 0
+        self._rows_pending = 0
+
+    def finish(self):
+        """Commits whatever hasn't been committed yet, unless that's been
+        left to the caller."""
+        if not self.defer_finish:
+            self.commit()
+
+    def abort(self):
+        """Ends the load after an error: rolls back whatever hasn't been
+        committed, except in 'savepoint' mode where every batch written so
+        far was good, so it's committed. Does nothing if ending the load
+        is left to the caller."""
+        if self.defer_finish:
+            return
+        if self.mode == 'savepoint':
+            self.commit()
+        else:
+            self.dbo.rollback()
+
+
+class RejectFile(object):
+    """
+    Writes rows the database rejected to a CSV file, with the error in an
+    extra REJECT_ERROR_FIELD column. The file is only created once a row is
+    rejected. Rows can be added from several threads.
+
+    Args:
+        path:   where to write the CSV
+        header: the source's header. Values past it, like object IDs a
+                writer appended, are left out.
+    """
+
+    def __init__(self, path, header):
+        self.path = path
+        self.header = list(header)
+        self.count = 0
+        self._file = None
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def add(self, row, error):
+        message = ' '.join(str(error).split())
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'w', newline='')
+                self._writer = csv.writer(self._file)
+                self._writer.writerow(self.header + [REJECT_ERROR_FIELD])
+            self._writer.writerow(list(row)[:len(self.header)] + [message])
+            self.count += 1
+
+    def close(self):
+        """Closes the file and reports how many rows were rejected."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.count:
+            print('Geopetl: {} rows rejected, written to {}'.format(self.count, self.path))
+        return self.count
@@ -0,0 +1,177 @@
+"""
+Opt-in local disk cache for query results.
+
+A petl pipeline often iterates the same query several times (header, nrows,
+the write itself, a validation pass) and each iteration runs the query
+again. With a ResultCache, the first iteration that reads a query to the end
+also writes its rows to a file, and later iterations, in this process or a
+later one, read that file instead while it's within the TTL and the table
+hasn't changed.
+
+Entries are keyed by the statement, the connection and a change marker read
+from the table before every iteration (see PostgisTable.change_marker and
+OracleSdeTable.change_marker), so a changed table misses the cache rather
+than returning stale rows. The directory is kept under max_bytes by removing
+the least recently used entries.
+
+Entries are pickled, so only point the cache at a directory you control.
+"""
+import hashlib
+import os
+import pickle
+import threading
+import time
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'geopetl')
+# seconds an entry is used for, even if the table hasn't changed
+DEFAULT_CACHE_TTL = 3600
+DEFAULT_CACHE_MAX_BYTES = 2 * 1024 ** 3
+# rows pickled together in an entry
+CACHE_CHUNK_ROWS = 1000
+
+_SUFFIX = '.rows'
+
+
+class ResultCache(object):
+    """
+    A directory of cached query results. `directory` defaults to the
+    GEOPETL_CACHE_DIR environment variable, or else ~/.cache/geopetl.
+    """
+
+    def __init__(self, directory=None, ttl=DEFAULT_CACHE_TTL, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.directory = directory or os.environ.get('GEOPETL_CACHE_DIR') or DEFAULT_CACHE_DIR
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def wrap(cls, cache):
+        """Returns the cache a query's `cache` argument asks for: None for
+        None or False, a default cache for True, a cache in the directory
+        for a path, or the cache itself."""
+        if cache is None or cache is False:
+            return None
+        if cache is True:
+            return cls()
+        if isinstance(cache, cls):
+            return cache
+        return cls(cache)
+
+    @staticmethod
+    def key(*parts):
+        """Returns a key for an entry identified by `parts`."""
+        return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    def rows(self, key, produce):
+        """
+        Returns an iterator over the header and rows cached under `key`. If
+        there's no current entry, the rows come from calling `produce`, and
+        are written to a new entry as they're read.
+        """
+        rows = self._read(self.path(key))
+        if rows is not None:
+            return rows
+        return self._write(self.path(key), produce())
+
+    def _read(self, path):
+        try:
+            f = open(path, 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            meta = pickle.load(f)
+        except Exception:
+            f.close()
+            return None
+        if time.time() - meta['created'] > self.ttl:
+            f.close()
+            self._remove(path)
+            return None
+        # the modified time records when it was last used, for eviction
+        os.utime(path, None)
+        print('Geopetl: reading cached rows from {}'.format(path))
+        return self._iter_file(f, meta['header'])
+
+    @staticmethod
+    def _iter_file(f, header):
+        with f:
+            yield header
+            while True:
+                try:
+                    chunk = pickle.load(f)
+                except EOFError:
+                    return
+                for row in chunk:
+                    yield row
+
+    def _write(self, path, rows):
+        """Yields rows while writing them to a temporary file, which becomes
+        the entry only if they're read to the end."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        f = open(tmp_path, 'wb')
+        complete = False
+        try:
+            rows = iter(rows)
+            header = next(rows)
+            pickle.dump({'created': time.time(), 'header': header}, f, pickle.HIGHEST_PROTOCOL)
+            yield header
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                yield row
+                if len(chunk) >= CACHE_CHUNK_ROWS:
+                    pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+                    chunk = []
+            if chunk:
+                pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+            complete = True
+        finally:
+            f.close()
+            if complete:
+                os.replace(tmp_path, path)
+                self.evict()
+            else:
+                self._remove(tmp_path)
+
+    def evict(self):
+        """Removes expired entries, then the least recently used ones until
+        the directory is under max_bytes."""
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith(_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum([size for _, size, _ in entries])
+        for used, size, path in entries:
+            # an entry is never used before it's written, so one last used
+            # more than the TTL ago has expired
+            if total <= self.max_bytes and now - used <= self.ttl:
+                continue
+            self._remove(path)
+            total -= size
+
+    def clear(self):
+        """Removes every entry."""
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith(_SUFFIX):
+                self._remove(os.path.join(self.directory, name))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
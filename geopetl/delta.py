@@ -0,0 +1,201 @@
+"""
+Change detection for delta writes.
+
+Rows are reduced to a stable hash of their values, so the rows being written
+can be compared with what's already in the table without holding either in
+memory: only a hash per target objectid is kept, and the source streams
+through to the writer with its unchanged rows left out.
+Values are normalized by column kind before hashing, so e.g. '1.50' from a
+CSV and Decimal('1.5') from the database hash the same.
+"""
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+import hashlib
+import json
+from dateutil import parser as dt_parser
+from dateutil import tz
+
+from geopetl import geometry
+
+NUM_TYPES = ('num', 'numeric', 'integer', 'smallint', 'bigint', 'real', 'float', 'double precision', 'money')
+TEMPORAL_TYPES = ('date', 'timestamp', 'timestamptz', 'timestamp without time zone', 'timestamp with time zone')
+GEOM_TYPES = ('geom', 'geometry')
+BOOL_TYPES = ('boolean',)
+
+_NULL = b'\x00'
+_SEPARATOR = b'\x1f'
+
+# changed rows held back for Diff's before_update at a time
+UPDATE_BATCH_ROWS = 1000
+
+
+def column_kind(type_):
+    """Generalizes a field type from table metadata for normalizing."""
+    type_ = (type_ or '').lower()
+    if type_ in GEOM_TYPES:
+        return 'geom'
+    if type_ in NUM_TYPES:
+        return 'num'
+    if type_ in TEMPORAL_TYPES:
+        return 'temporal'
+    if type_ in BOOL_TYPES:
+        return 'bool'
+    return 'text'
+
+
+def _num(val):
+    try:
+        return str(Decimal(str(val)).normalize())
+    except InvalidOperation:
+        return str(val)
+
+
+def _temporal(val):
+    if isinstance(val, str):
+        try:
+            val = dt_parser.parse(val)
+        except (ValueError, OverflowError):
+            return val
+    if isinstance(val, datetime):
+        if val.tzinfo:
+            val = val.astimezone(tz.tzutc())
+        # dates and midnight timestamps come out the same, since a DATE
+        # column in one database is a timestamp in another
+        if not val.tzinfo and val.time() == datetime.min.time():
+            return val.date().isoformat()
+        return val.isoformat()
+    if isinstance(val, date):
+        return val.isoformat()
+    return str(val)
+
+
+def _bool(val):
+    return 'true' if str(val).lower() in ('t', 'true', '1', 'y', 'yes') else 'false'
+
+
+def _text(val):
+    if isinstance(val, (dict, list)):
+        return json.dumps(val, sort_keys=True)
+    return str(val)
+
+
+def normalizer(kind, multi_geom=False):
+    """Returns a function that normalizes values of a column kind to text.
+    Geometries come out as hex EWKB without an SRID, optionally cast to
+    their MULTI type."""
+    if kind == 'num':
+        return _num
+    if kind == 'temporal':
+        return _temporal
+    if kind == 'bool':
+        return _bool
+    if kind == 'geom':
+        def normalize(val):
+            try:
+                return geometry.to_wkb(val, multi=multi_geom).hex()
+            except ValueError:
+                # e.g. curves
+                return geometry.to_wkt(val, multi=multi_geom)
+        return normalize
+    return _text
+
+
+class RowHasher(object):
+    """
+    Hashes rows of `fields`, given as a list of (index of the value in a row,
+    column kind) pairs.
+    """
+
+    def __init__(self, fields, multi_geom=False):
+        self.fields = [(i, normalizer(kind, multi_geom)) for i, kind in fields]
+
+    def __call__(self, row):
+        parts = []
+        for i, normalize in self.fields:
+            val = row[i]
+            parts.append(_NULL if val is None or val == '' else normalize(val).encode('utf-8'))
+        return hashlib.blake2b(_SEPARATOR.join(parts), digest_size=16).digest()
+
+
+class Diff(object):
+    """
+    The source rows that are new or changed compared with target rows on
+    `key_field`. Both are petl tables with the key field and the compared
+    fields, which may be in a different order; `kinds` maps each compared
+    field to its column kind.
+
+    Iterating reads the target to the end, keeping only a hash per key, then
+    streams the source, yielding its header and the rows that are new or
+    changed. `changes` holds the keys to insert, update and delete and the
+    number of unchanged rows; the keys to delete, the target's that weren't
+    in the source, are only known once the source has been read to the end.
+    It can only be iterated once.
+
+    before_update(keys), if given, is called with the keys of changed rows
+    before they're yielded, up to UPDATE_BATCH_ROWS at a time, e.g. to
+    delete the old rows before the writer inserts the new ones. Changed rows
+    are held back until then, so they may come after new rows that followed
+    them in the source.
+    """
+
+    def __init__(self, source, target, key_field, kinds, multi_geom=False, before_update=None):
+        self.source = source
+        self.target = target
+        self.key_field = key_field
+        self.kinds = kinds
+        self.multi_geom = multi_geom
+        self.before_update = before_update
+        self.changes = {'insert': [], 'update': [], 'delete': [], 'unchanged': 0}
+        self._consumed = False
+
+    def _target_hashes(self, key):
+        target = iter(self.target)
+        header = list(next(target))
+        target_key = header.index(self.key_field)
+        hasher = RowHasher([(header.index(f), self.kinds[f]) for f in self.kinds], self.multi_geom)
+        hashes = {}
+        for row in target:
+            hashes[key(row[target_key])] = hasher(row)
+        return hashes
+
+    def __iter__(self):
+        if self._consumed:
+            raise RuntimeError('The diff has already been read')
+        self._consumed = True
+        key = normalizer('num')
+        hashes = self._target_hashes(key)
+
+        source = iter(self.source)
+        header = tuple(next(source))
+        source_key = header.index(self.key_field)
+        hasher = RowHasher([(header.index(f), self.kinds[f]) for f in self.kinds], self.multi_geom)
+        changes = self.changes
+        yield header
+        held = []
+        for row in source:
+            row_key = key(row[source_key])
+            row_hash = hashes.pop(row_key, None)
+            if row_hash is None:
+                changes['insert'].append(row[source_key])
+            elif row_hash != hasher(row):
+                changes['update'].append(row[source_key])
+                if self.before_update:
+                    held.append(row)
+                    if len(held) >= UPDATE_BATCH_ROWS:
+                        for held_row in self._release(held, source_key):
+                            yield held_row
+                        held = []
+                    continue
+            else:
+                changes['unchanged'] += 1
+                continue
+            yield row
+        for held_row in self._release(held, source_key):
+            yield held_row
+        # whatever is left in the target wasn't in the source
+        changes['delete'] = list(hashes)
+
+    def _release(self, rows, source_key):
+        if rows:
+            self.before_update([row[source_key] for row in rows])
+        return rows
@@ -0,0 +1,38 @@
+"""
+Compiled row encoders shared by the writers.
+
+A writer works out once per load which encoder each column needs and where
+its value is in a row, then encodes rows with row_encoder's function: one
+itemgetter call to pick the values out in column order and one pass over
+(encoder, value) pairs, with no type dispatch per value.
+"""
+from operator import itemgetter
+
+
+class RawValue(str):
+    """
+    A value as the database's own text output, read by frompostgis with
+    decode='raw'. That's a form the database takes as input too, so the
+    writers only escape or quote it rather than encoding it again.
+    """
+    __slots__ = ()
+
+
+def row_encoder(columns):
+    """
+    Compiles `columns`, a list of (index of the value in a row, encoder)
+    pairs, into a function that takes a row and returns a list of its
+    encoded values in column order.
+    """
+    if not columns:
+        return lambda row: []
+    encoders = tuple([encode for _, encode in columns])
+    if len(columns) == 1:
+        (i, encode), = columns
+        return lambda row: [encode(row[i])]
+    get = itemgetter(*[i for i, _ in columns])
+
+    def encode_row(row):
+        return [encode(val) for encode, val in zip(encoders, get(row))]
+
+    return encode_row
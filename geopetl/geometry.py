@@ -0,0 +1,457 @@
+"""
+Client-side geometry codec.
+
+Geometry values come in as WKT, EWKT, WKB or EWKB (as bytes or hex). decode
+works out which, along with the SRID, type and dimensions, from the head of
+the value alone. The writers then normalize them here, once per value, to 2D
+and to the MULTI type of the column, and emit EWKB or WKT, instead of
+searching the whole text for markers and wrapping it in SQL functions.
+"""
+from collections import namedtuple
+from math import isnan
+import re
+import struct
+
+WKB_TYPES = {
+    'POINT':                1,
+    'LINESTRING':           2,
+    'POLYGON':              3,
+    'MULTIPOINT':           4,
+    'MULTILINESTRING':      5,
+    'MULTIPOLYGON':         6,
+    'GEOMETRYCOLLECTION':   7,
+}
+WKB_TYPE_NAMES = {v: k for k, v in WKB_TYPES.items()}
+SINGLE_TYPES = ('POINT', 'LINESTRING', 'POLYGON')
+# curves can be decoded, but not linearized on the client; that's left to
+# ST_CurveToLine on the server
+CURVE_TYPES = {
+    'CIRCULARSTRING':   8,
+    'COMPOUNDCURVE':    9,
+    'CURVEPOLYGON':     10,
+    'MULTICURVE':       11,
+    'MULTISURFACE':     12,
+}
+
+# EWKB flags, or'ed into the geometry type
+EWKB_Z = 0x80000000
+EWKB_M = 0x40000000
+EWKB_SRID = 0x20000000
+
+_WKT_HEAD_RE = re.compile(r'\s*([A-Za-z]+?)\s*(ZM|Z|M)?\s*(?=\(|EMPTY\s*$)', re.IGNORECASE)
+_PAREN_RE = re.compile(r'\(|\)|[^()]+')
+_EMPTY_RE = re.compile(r'EMPTY\s*$', re.IGNORECASE)
+_FIRST_COORD_RE = re.compile(r'[\s(]*([^(),]+)')
+# WKB starts with a byte order byte, 00 or 01
+_HEX_HEAD_RE = re.compile('0[01][0-9A-Fa-f]{8}')
+# a coordinate with three or four ordinates, e.g. `1 2 NaN`
+_XYZ_RE = re.compile(r'([^\s,()]+)\s+([^\s,()]+)(?:\s+[^\s,()]+)+')
+
+Geometry = namedtuple('Geometry', ['format', 'srid', 'geom_type', 'dims', 'empty', 'data'])
+Geometry.__doc__ = """A decoded geometry value. `format` is 'wkt' or 'wkb'; `data` is
+the WKT without any SRID= prefix, or the WKB/EWKB bytes."""
+
+
+def _coords(text, dims, force_2d):
+    """Parses a WKT coordinate list, e.g. `1 2, 3 4`, into packed doubles.
+    Returns the packed bytes and the number of points."""
+    if dims == 2 or not force_2d:
+        values = [float(x) for x in text.replace(',', ' ').split()]
+    else:
+        values = [float(x) for p in text.split(',') for x in p.split()[:2]]
+    if force_2d:
+        dims = 2
+    return struct.pack('<{}d'.format(len(values)), *values), len(values) // dims
+
+
+def _nest(body):
+    """Splits a WKT body into nested lists of coordinate text by
+    parentheses, e.g. `((1 2, 3 4),(5 6))` => [['1 2, 3 4'], ['5 6']]."""
+    root = []
+    stack = [root]
+    for token in _PAREN_RE.findall(body):
+        if token == '(':
+            child = []
+            stack[-1].append(child)
+            stack.append(child)
+        elif token == ')':
+            stack.pop()
+        elif token.strip(' \t\r\n,'):
+            stack[-1].append(token)
+    return root[0] if root else []
+
+
+def _split_collection(body):
+    """Splits the members of a GEOMETRYCOLLECTION body at top-level commas."""
+    body = body.strip()[1:-1]
+    members = []
+    depth = 0
+    start = 0
+    for i, char in enumerate(body):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            members.append(body[start:i])
+            start = i + 1
+    members.append(body[start:])
+    return [x.strip() for x in members if x.strip()]
+
+
+def _header(geom_type, flags, srid=None):
+    code = WKB_TYPES[geom_type] | flags
+    if srid:
+        return struct.pack('<BII', 1, code | EWKB_SRID, int(srid))
+    return struct.pack('<BI', 1, code)
+
+
+def _encode(geom_type, dims, flags, tree, srid, force_2d):
+    """Encodes one geometry, parsed into nested coordinate text by _nest, as
+    EWKB."""
+    header = _header(geom_type, flags, srid)
+    if geom_type == 'POINT':
+        coords, _ = _coords(tree[0], dims, force_2d)
+        return header + coords
+    if geom_type == 'LINESTRING':
+        coords, n = _coords(tree[0], dims, force_2d)
+        return header + struct.pack('<I', n) + coords
+    if geom_type == 'POLYGON':
+        parts = [header, struct.pack('<I', len(tree))]
+        for ring in tree:
+            coords, n = _coords(ring[0], dims, force_2d)
+            parts.append(struct.pack('<I', n))
+            parts.append(coords)
+        return b''.join(parts)
+
+    # multi types are a count followed by full WKB members without SRIDs
+    member_type = geom_type[len('MULTI'):]
+    if geom_type == 'MULTIPOINT' and len(tree) == 1 and isinstance(tree[0], str):
+        # unparenthesized form: MULTIPOINT(1 2, 3 4)
+        tree = [[x] for x in tree[0].split(',')]
+    members = [_encode(member_type, dims, flags, x, None, force_2d) for x in tree]
+    return header + struct.pack('<I', len(members)) + b''.join(members)
+
+
+def _encode_empty(geom_type, flags, srid):
+    header = _header(geom_type, flags, srid)
+    if geom_type == 'POINT':
+        dims = 2 + bool(flags & EWKB_Z) + bool(flags & EWKB_M)
+        # PostGIS represents an empty point as NaN coordinates
+        return header + struct.pack('<{}d'.format(dims), *[float('nan')] * dims)
+    return header + struct.pack('<I', 0)
+
+
+def from_wkt(wkt, srid=None, multi=False, force_2d=False):
+    """
+    Encodes WKT or EWKT as little-endian EWKB.
+
+    Args:
+        srid:       SRID to embed if the text doesn't carry its own
+        multi:      cast single-part geometries to their MULTI type
+        force_2d:   drop Z/M ordinates
+    """
+    if wkt.startswith('SRID='):
+        prefix, wkt = wkt.split(';', 1)
+        srid = prefix[len('SRID='):]
+
+    m = _WKT_HEAD_RE.match(wkt)
+    if not m:
+        raise ValueError('Not a WKT geometry: {}'.format(wkt[:50]))
+    geom_type = m.group(1).upper()
+    if geom_type not in WKB_TYPES:
+        # curves would need to be linearized, which is done server-side
+        # with ST_CurveToLine
+        raise ValueError('Unsupported geometry type for client-side encoding: {}'.format(geom_type))
+    body = wkt[m.end():]
+    tag = (m.group(2) or '').upper()
+    flags = {'': 0, 'Z': EWKB_Z, 'M': EWKB_M, 'ZM': EWKB_Z | EWKB_M}[tag]
+    dims = 2 + len(tag)
+    is_empty = body.strip().upper() == 'EMPTY'
+    if not tag and not is_empty:
+        # dimension tags are optional, so count the ordinates of the first
+        # coordinate instead
+        first = re.search(r'\(\s*([^(),]+)', body)
+        if first:
+            dims = len(first.group(1).split())
+            flags = {3: EWKB_Z, 4: EWKB_Z | EWKB_M}.get(dims, 0)
+    if force_2d:
+        flags = 0
+
+    if multi and geom_type in ('POINT', 'LINESTRING', 'POLYGON'):
+        if is_empty:
+            return _encode_empty('MULTI' + geom_type, flags, srid)
+        member = _encode(geom_type, dims, flags, _nest(body), None, force_2d)
+        return _header('MULTI' + geom_type, flags, srid) + struct.pack('<I', 1) + member
+    if is_empty:
+        return _encode_empty(geom_type, flags, srid)
+    if geom_type == 'GEOMETRYCOLLECTION':
+        members = [from_wkt(x, force_2d=force_2d) for x in _split_collection(body)]
+        return _header(geom_type, flags, srid) + struct.pack('<I', len(members)) + b''.join(members)
+    return _encode(geom_type, dims, flags, _nest(body), srid, force_2d)
+
+
+def _ewkb_code(code):
+    """Converts an ISO WKB geometry type, which encodes dimensions as e.g.
+    1001 for POINT Z, to its EWKB equivalent."""
+    if code & 0xffff > 1000:
+        iso_dims = (code & 0xffff) // 1000
+        code = (code & EWKB_SRID) | (code & 0xffff) % 1000 | {1: EWKB_Z, 2: EWKB_M, 3: EWKB_Z | EWKB_M}[iso_dims]
+    return code
+
+
+def with_srid(wkb, srid=None, multi=False):
+    """
+    Normalizes WKB or EWKB bytes to little or big endian EWKB carrying an
+    SRID, optionally cast to a MULTI type.
+    """
+    wkb = bytes(wkb)
+    endian = '<' if wkb[0] == 1 else '>'
+    code, = struct.unpack(endian + 'I', wkb[1:5])
+    has_srid = code & EWKB_SRID
+    body = wkb[9:] if has_srid else wkb[5:]
+    if has_srid:
+        srid, = struct.unpack(endian + 'I', wkb[5:9])
+    base_code = _ewkb_code(code) & ~EWKB_SRID
+    if multi and (base_code & 0xff) in (1, 2, 3):
+        member = wkb[:1] + struct.pack(endian + 'I', base_code) + body
+        base_code += 3
+        body = struct.pack(endian + 'I', 1) + member
+    if srid:
+        return wkb[:1] + struct.pack(endian + 'II', base_code | EWKB_SRID, int(srid)) + body
+    return wkb[:1] + struct.pack(endian + 'I', base_code) + body
+
+
+def _fmt(val):
+    if isnan(val):
+        return 'NaN'
+    text = repr(val)
+    return text[:-2] if text.endswith('.0') else text
+
+
+def _read_wkb(data, offset, force_2d):
+    """Reads the WKB geometry at `offset`. Returns its type, dimension tag,
+    WKT body and the offset after it."""
+    endian = '<' if data[offset] == 1 else '>'
+    code, = struct.unpack_from(endian + 'I', data, offset + 1)
+    offset += 9 if code & EWKB_SRID else 5
+    code = _ewkb_code(code)
+    geom_type = WKB_TYPE_NAMES.get(code & 0xff)
+    if not geom_type:
+        raise ValueError('Unsupported WKB geometry type: {}'.format(code & 0xff))
+    dims = 2 + bool(code & EWKB_Z) + bool(code & EWKB_M)
+    keep = 2 if force_2d else dims
+    tag = '' if keep == 2 else {EWKB_Z: 'Z', EWKB_M: 'M', EWKB_Z | EWKB_M: 'ZM'}[code & (EWKB_Z | EWKB_M)]
+
+    def points(offset, n):
+        values = struct.unpack_from('{}{}d'.format(endian, n * dims), data, offset)
+        text = ', '.join(' '.join(_fmt(v) for v in values[i:i + keep]) for i in range(0, n * dims, dims))
+        return values, text, offset + 8 * n * dims
+
+    def count(offset):
+        return struct.unpack_from(endian + 'I', data, offset)[0], offset + 4
+
+    if geom_type == 'POINT':
+        values, text, offset = points(offset, 1)
+        body = 'EMPTY' if isnan(values[0]) and isnan(values[1]) else '({})'.format(text)
+    elif geom_type == 'LINESTRING':
+        n, offset = count(offset)
+        _, text, offset = points(offset, n)
+        body = '({})'.format(text) if n else 'EMPTY'
+    elif geom_type == 'POLYGON':
+        n, offset = count(offset)
+        rings = []
+        for _ in range(n):
+            m, offset = count(offset)
+            _, text, offset = points(offset, m)
+            rings.append('({})'.format(text))
+        body = '({})'.format(', '.join(rings)) if n else 'EMPTY'
+    else:
+        n, offset = count(offset)
+        members = []
+        for _ in range(n):
+            member_type, member_tag, member_body, offset = _read_wkb(data, offset, force_2d)
+            if geom_type == 'GEOMETRYCOLLECTION':
+                members.append(_format_wkt(member_type, member_tag, member_body))
+            else:
+                members.append(member_body)
+        body = '({})'.format(', '.join(members)) if n else 'EMPTY'
+    return geom_type, tag, body, offset
+
+
+def _format_wkt(geom_type, tag, body):
+    head = '{} {}'.format(geom_type, tag) if tag else geom_type
+    if body == 'EMPTY':
+        return head + ' EMPTY'
+    return head + body
+
+
+def _decode_wkb(data):
+    endian = '<' if data[0] == 1 else '>'
+    code, = struct.unpack_from(endian + 'I', data, 1)
+    srid = None
+    offset = 5
+    if code & EWKB_SRID:
+        srid, = struct.unpack_from(endian + 'I', data, 5)
+        offset = 9
+    code = _ewkb_code(code)
+    base = code & 0xff
+    geom_type = WKB_TYPE_NAMES.get(base) or {v: k for k, v in CURVE_TYPES.items()}.get(base)
+    if not geom_type:
+        raise ValueError('Not a WKB geometry')
+    dims = 2 + bool(code & EWKB_Z) + bool(code & EWKB_M)
+    if geom_type == 'POINT':
+        empty = isnan(struct.unpack_from(endian + 'd', data, offset)[0])
+    else:
+        empty = struct.unpack_from(endian + 'I', data, offset)[0] == 0
+    return Geometry('wkb', srid or None, geom_type, dims, empty, data)
+
+
+def decode(val):
+    """
+    Works out the format, SRID, type and dimensions of a geometry value from
+    its head, without reading the rest. Takes WKT, EWKT, and WKB or EWKB as
+    bytes or hex; returns a Geometry, or None for an empty value. Raises
+    ValueError if the value isn't a geometry.
+    """
+    if val is None or val == '' or val == 'EMPTY':
+        return None
+    if isinstance(val, Geometry):
+        return val
+    if isinstance(val, LazyGeometry):
+        return val.geom
+    if isinstance(val, (bytes, bytearray, memoryview)):
+        return _decode_wkb(bytes(val))
+    val = str(val)
+    if _HEX_HEAD_RE.match(val):
+        try:
+            return _decode_wkb(bytes.fromhex(val))
+        except (ValueError, struct.error):
+            raise ValueError('Not a geometry: {}'.format(val[:50]))
+
+    srid = None
+    start = 0
+    if val.startswith('SRID='):
+        start = val.find(';') + 1
+        try:
+            srid = int(val[len('SRID='):start - 1])
+        except ValueError:
+            raise ValueError('Not a geometry: {}'.format(val[:50]))
+    m = _WKT_HEAD_RE.match(val, start)
+    geom_type = m.group(1).upper() if m else None
+    if geom_type not in WKB_TYPES and geom_type not in CURVE_TYPES:
+        raise ValueError('Not a geometry: {}'.format(val[:50]))
+    tag = (m.group(2) or '').upper()
+    empty = bool(_EMPTY_RE.match(val, m.end()))
+    dims = 2 + len(tag)
+    if not tag and not empty:
+        # dimension tags are optional, so count the ordinates of the first
+        # coordinate instead
+        first = _FIRST_COORD_RE.match(val, m.end())
+        if first:
+            dims = len(first.group(1).split())
+    return Geometry('wkt', srid, geom_type, dims, empty, val[start:] if start else val)
+
+
+def to_wkt(val, multi=False, force_2d=True):
+    """
+    Returns a geometry value as WKT, without an SRID, forced to 2D and cast
+    to its MULTI type if asked. Text that needs neither is returned as-is.
+    Empty values come out as None.
+    """
+    geom = decode(val)
+    if geom is None:
+        return None
+    if geom.format == 'wkb':
+        geom_type, tag, body, _ = _read_wkb(geom.data, 0, force_2d)
+    else:
+        flatten = force_2d and geom.dims > 2
+        cast = multi and geom.geom_type in SINGLE_TYPES
+        if not flatten and not cast:
+            return geom.data
+        m = _WKT_HEAD_RE.match(geom.data)
+        geom_type = geom.geom_type
+        tag = (m.group(2) or '').upper()
+        body = 'EMPTY' if geom.empty else geom.data[m.end():].rstrip()
+        if flatten:
+            tag = ''
+            body = _XYZ_RE.sub(r'\1 \2', body)
+    if multi and geom_type in SINGLE_TYPES:
+        geom_type = 'MULTI' + geom_type
+        body = body if body == 'EMPTY' else '({})'.format(body)
+    return _format_wkt(geom_type, tag, body)
+
+
+def to_ewkt(val, srid=None, multi=False, force_2d=True):
+    """Like to_wkt, with the value's SRID, or else `srid`, in front."""
+    geom = decode(val)
+    if geom is None:
+        return None
+    wkt = to_wkt(geom, multi=multi, force_2d=force_2d)
+    srid = geom.srid or srid
+    return 'SRID={};{}'.format(srid, wkt) if srid else wkt
+
+
+def to_ewkb(val, srid=None, multi=False, force_2d=True):
+    """
+    Returns a geometry value as little-endian EWKB (or WKB with its own byte
+    order) carrying the value's SRID, or else `srid`, forced to 2D and cast
+    to its MULTI type if asked. Empty values come out as None. Raises
+    ValueError for curves.
+    """
+    geom = decode(val)
+    if geom is None:
+        return None
+    srid = geom.srid or srid
+    if geom.geom_type in CURVE_TYPES:
+        raise ValueError('Unsupported geometry type for client-side encoding: {}'.format(geom.geom_type))
+    if geom.format == 'wkb':
+        if force_2d and geom.dims > 2:
+            return from_wkt(to_wkt(geom), srid, multi=multi)
+        return with_srid(geom.data, srid, multi=multi)
+    return from_wkt(geom.data, srid, multi=multi, force_2d=force_2d and geom.dims > 2)
+
+
+def to_wkb(val, multi=False, force_2d=True):
+    """Like to_ewkb, without an SRID."""
+    wkb = to_ewkb(val, multi=multi, force_2d=force_2d)
+    if wkb is None:
+        return None
+    endian = '<' if wkb[0] == 1 else '>'
+    code, = struct.unpack(endian + 'I', wkb[1:5])
+    if not code & EWKB_SRID:
+        return wkb
+    return wkb[:1] + struct.pack(endian + 'I', code & ~EWKB_SRID) + wkb[9:]
+
+
+class LazyGeometry(bytes):
+    """
+    WKB or EWKB bytes as read from the database, decoded only when one of its
+    properties is used. Writers take it like any other WKB, so a geometry
+    passed from one database to another never goes through text; str() gives
+    EWKT, e.g. for writing CSVs.
+    """
+
+    @property
+    def geom(self):
+        """The decoded head of the value; see decode."""
+        try:
+            return self._geom
+        except AttributeError:
+            self._geom = _decode_wkb(self)
+            return self._geom
+
+    @property
+    def srid(self):
+        return self.geom.srid
+
+    @property
+    def geom_type(self):
+        return self.geom.geom_type
+
+    @property
+    def wkt(self):
+        return to_wkt(self.geom, force_2d=False)
+
+    def __str__(self):
+        return to_ewkt(self.geom, force_2d=False)
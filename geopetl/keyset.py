@@ -0,0 +1,102 @@
+"""
+Keyset-paginated reads that can be resumed.
+
+Rather than one query over the whole table, which holds a snapshot open for
+as long as the extraction takes (bloating PostGIS tables, and failing with
+ORA-01555 on Oracle once undo runs out), rows are read a page at a time with
+short queries like
+
+    SELECT ... WHERE objectid > :last ORDER BY objectid LIMIT :page_size
+
+that an index on the key answers directly. The last key of each page can be
+saved to a checkpoint file, so a read that fails can be rerun from where it
+stopped rather than from the start.
+"""
+import json
+import os
+
+from petl.util.base import Table
+
+# rows read per page
+DEFAULT_PAGE_SIZE = 10000
+
+
+class Checkpoint(object):
+    """
+    The last key read by a keyset-paginated read, kept in a JSON file.
+    `name` identifies the table and `query` the statement read from it, with
+    its filters, so a checkpoint isn't resumed by a read of another table or
+    of other rows of the same table.
+    """
+
+    def __init__(self, path, name, query=None):
+        self.path = path
+        self.name = name
+        self.query = query
+
+    def load(self):
+        """Returns the saved key, or None if there's no checkpoint."""
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            state = json.load(f)
+        if state.get('name') != self.name:
+            raise ValueError('Checkpoint {} is for {}, not {}'.format(self.path, state.get('name'), self.name))
+        if state.get('query') != self.query:
+            raise ValueError('Checkpoint {} is for another query of {}: {}'.format(
+                self.path, self.name, state.get('query')))
+        return state['key']
+
+    def save(self, key):
+        # write a new file and move it into place, so a crash mid-write
+        # leaves the last checkpoint as it was
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'name': self.name, 'query': self.query, 'key': key}, f, default=str)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class KeysetView(Table):
+    """
+    Reads a query a page at a time in order of `key`. `fetch_page(last,
+    page_size)` runs the query for one page, the first `page_size` rows with
+    a key greater than `last` (or from the start if last is None), and
+    returns its header and rows. Rows with a null key can't be paged
+    through, so fetch_page must leave them out of every page, including the
+    first; they are never read.
+
+    With a checkpoint, the key of the last row of a page is saved once every
+    row of the page has been taken, and reading starts after the saved key.
+    The checkpoint is removed when the read finishes, so the next run starts
+    from the start again.
+    """
+
+    def __init__(self, fetch_page, key, page_size=DEFAULT_PAGE_SIZE, checkpoint=None):
+        self.fetch_page = fetch_page
+        self.key = key
+        self.page_size = page_size
+        self.checkpoint = checkpoint
+
+    def __iter__(self):
+        checkpoint = self.checkpoint
+        last = checkpoint.load() if checkpoint else None
+        if last is not None:
+            print('Geopetl: resuming after {} {}'.format(self.key, last))
+        header, rows = self.fetch_page(last, self.page_size)
+        yield tuple(header)
+        i = [h.lower() for h in header].index(self.key.lower())
+        while rows:
+            for row in rows:
+                yield row
+            last = rows[-1][i]
+            if checkpoint:
+                checkpoint.save(last)
+            if len(rows) < self.page_size:
+                break
+            _, rows = self.fetch_page(last, self.page_size)
+        if checkpoint:
+            checkpoint.clear()
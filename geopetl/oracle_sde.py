@@ -11,11 +11,70 @@ from petl.compat import string_types
 from petl.io.db_utils import _quote, _is_dbapi_connection
 from petl.util.base import Table
 from geopetl.base import SpatialQuery
+from geopetl.batch import DEFAULT_BATCH_BYTES, ON_ERROR_MODES, Batcher, CommitPolicy, RejectFile, row_size
+from geopetl import delta as row_delta
+from geopetl.encoding import row_encoder
+from geopetl.keyset import DEFAULT_PAGE_SIZE, Checkpoint, KeysetView
+from geopetl.cache import ResultCache
+from geopetl.stream import RowStream
+from geopetl import geometry
 from geopetl.util import parse_db_url
 import cx_Oracle
 
 DEFAULT_WRITE_BUFFER_SIZE = 1000
 
+def _as_is(val):
+    return val
+
+def _encode_date(val):
+    if val is None or val == '' or val == 0:
+        return val
+    # Convert datetimes to ISO-8601
+    if isinstance(val, str):
+        splitval = val.split(' ')
+        if ' ' in val and ':' in splitval[1] and 'T' not in val:
+            val =splitval[0] + 'T' + splitval[1]
+        val = dt_parser().parse(val)
+        val = val.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(val, datetime):
+        val = val.strftime("%Y-%m-%d %H:%M:%S")
+    return val
+
+def _encode_timestamptz(val):
+    if val is None or val == '' or val == 0:
+        return val
+    if isinstance(val, datetime):
+        val = val.isoformat()
+    elif isinstance(val, str):
+        val=dt_parser().parse(val)
+        val = val.isoformat()
+    return val
+
+def _encode_timestamp(val):
+    if val is None or val == '' or val == 0:
+        return val
+    if isinstance(val, datetime):
+        val = val.strftime("%Y-%m-%d %H:%M:%S.%f")
+    elif isinstance(val, str):
+        val = dt_parser().parse(val)
+        val = val.strftime("%Y-%m-%d %H:%M:%S.%f")
+    return val
+
+# maps field types to functions that convert row values to bind values.
+# TODO handle more types. Most are passed through and seem to work.
+VALUE_ENCODERS = {
+    'text':                         _as_is,
+    'num':                          _as_is,
+    'integer':                      _as_is,
+    'geom':                         _as_is,
+    'date':                         _encode_date,
+    # Cast as a CLOB object so cx_Oracle doesn't try to make it a LONG
+    # var = self._c.var(cx_Oracle.NCLOB)
+    'nclob':                        _as_is,
+    'timestamp with time zone':     _encode_timestamptz,
+    'timestamp without time zone':  _encode_timestamp,
+}
+
 def oracle_extract_table_schema(dbo, table_name, table_schema_output_path):
     db = OracleSdeDatabase(dbo)
     table = db.table(table_name)
@@ -24,20 +83,59 @@ def oracle_extract_table_schema(dbo, table_name, table_schema_output_path):
 etl.oracle_extract_table_schema = oracle_extract_table_schema
 
 def fromoraclesde(dbo, table_name, **kwargs):
+    """
+    Returns an iterable query container; keyword args are passed to
+    OracleSdeQuery.
+
+    With keyset=True (or checkpoint=<path>), rows are read page_size at a
+    time in objectid order with short queries instead of one long one, and
+    the last objectid read can be saved to the checkpoint file so a failed
+    read resumes where it stopped; see geopetl.keyset.
+
+    bbox=(xmin, ymin, xmax, ymax), intersects=<geometry> and
+    dwithin=(<geometry>, distance) only read rows whose geometry meets them,
+    using the spatial index; see OracleSdeQuery.spatial_filters.
+
+    cache=True (or a directory, or a geopetl.cache.ResultCache) keeps the
+    rows on local disk once they've been read to the end, and reads them
+    from there while the table hasn't changed.
+
+    header() describes the query without reading rows, and nrows() counts
+    in the database; estimate_count=True uses ALL_TABLES.NUM_ROWS
+    instead where it can. See OracleSdeQuery.nrows.
+    """
     db = OracleSdeDatabase(dbo)
     table = db.table(table_name)
-    if table.row_count == 0:
+    if table.is_empty:
         raise Exception("Table {table_name} is empty, exiting...".format(table_name=table_name))
     return table.query(**kwargs)
 
 etl.fromoraclesde = fromoraclesde
 
 def tooraclesde(rows, dbo, table_name, srid=None, table_srid=None,
-                buffer_size=DEFAULT_WRITE_BUFFER_SIZE, truncate=True, increment=True, fail_on_empty=True):
+                buffer_size=DEFAULT_WRITE_BUFFER_SIZE, truncate=True, increment=True, fail_on_empty=True,
+                batch_bytes=DEFAULT_BATCH_BYTES, auto_tune=False, commit='batch', commit_every=1, commit_bytes=None,
+                delta=False, on_error='raise', reject_file=None):
     """
     Writes rows to database. Truncates by default.
 
     If table isn't registered with SDE, you must specify a to_srid.
+
+    Rows are sent in batches of at most buffer_size rows and batch_bytes
+    bytes. With auto_tune=True the batch size is tuned from measured
+    throughput and the size it settles on is printed.
+
+    commit is one of geopetl.batch.COMMIT_MODES. 'batch' commits after every
+    commit_every batches (or commit_bytes bytes); 'single' and 'savepoint'
+    load in one transaction, deleting rows instead of truncating since
+    TRUNCATE commits on its own in Oracle.
+
+    With delta=True, only rows that differ from the table are written, matched
+    on the objectid field; see OracleSdeTable.write_delta. It can't be used
+    with on_error='reject'.
+
+    With on_error='reject', rows Oracle rejects are written to reject_file
+    with the error instead of failing the load; see OracleSdeTable.write.
     """
 
     # create db wrappers
@@ -56,39 +154,56 @@ def tooraclesde(rows, dbo, table_name, srid=None, table_srid=None,
         # TODO create table if it doesn't exist
         raise NotImplementedError('Autocreate tables for Oracle SDE not currently implemented.')
 
-    table.write(rows, srid=srid, table_srid=table_srid, increment=increment, truncate=truncate, fail_on_empty=fail_on_empty)
+    if delta:
+        return table.write_delta(rows, srid=srid, table_srid=table_srid, buffer_size=buffer_size,
+                                 fail_on_empty=fail_on_empty, batch_bytes=batch_bytes, auto_tune=auto_tune,
+                                 commit=commit, commit_every=commit_every, commit_bytes=commit_bytes,
+                                 on_error=on_error, reject_file=reject_file)
+    table.write(rows, srid=srid, table_srid=table_srid, buffer_size=buffer_size, increment=increment, truncate=truncate,
+                fail_on_empty=fail_on_empty, batch_bytes=batch_bytes, auto_tune=auto_tune, commit=commit,
+                commit_every=commit_every, commit_bytes=commit_bytes, on_error=on_error, reject_file=reject_file)
 
 etl.tooraclesde = tooraclesde
 
 def _tooraclesde(self, dbo, table_name, srid=None, table_srid=None,
-                 buffer_size=DEFAULT_WRITE_BUFFER_SIZE, truncate=True, increment=True, fail_on_empty=True):
+                 buffer_size=DEFAULT_WRITE_BUFFER_SIZE, truncate=True, increment=True, fail_on_empty=True,
+                 batch_bytes=DEFAULT_BATCH_BYTES, auto_tune=False, commit='batch', commit_every=1, commit_bytes=None,
+                 delta=False, on_error='raise', reject_file=None):
     """
     This wraps tooraclesde and adds a `self` arg so it can be attached to
     the Table class. This enables functional-style chaining.
     """
     return tooraclesde(self, dbo, table_name, table_srid=table_srid,
-                       buffer_size=buffer_size, truncate=truncate, increment=increment, fail_on_empty=fail_on_empty)
+                       buffer_size=buffer_size, truncate=truncate, increment=increment, fail_on_empty=fail_on_empty,
+                       batch_bytes=batch_bytes, auto_tune=auto_tune, commit=commit, commit_every=commit_every,
+                       commit_bytes=commit_bytes, delta=delta, on_error=on_error, reject_file=reject_file)
 
 Table.tooraclesde = _tooraclesde
 
 def appendoraclesde(rows, dbo, table_name, srid=None, table_srid=None,
-                buffer_size=DEFAULT_WRITE_BUFFER_SIZE, fail_on_empty=True):
+                buffer_size=DEFAULT_WRITE_BUFFER_SIZE, fail_on_empty=True,
+                batch_bytes=DEFAULT_BATCH_BYTES, auto_tune=False, commit='batch', commit_every=1, commit_bytes=None):
     """
     Appends rows to database. Calls tooraclesde with truncate parameter set to False.
     """
     return tooraclesde(rows, dbo, table_name, srid=None, table_srid=None,
-                buffer_size=DEFAULT_WRITE_BUFFER_SIZE, truncate=False, fail_on_empty=fail_on_empty)
+                buffer_size=buffer_size, truncate=False, fail_on_empty=fail_on_empty,
+                batch_bytes=batch_bytes, auto_tune=auto_tune, commit=commit, commit_every=commit_every,
+                commit_bytes=commit_bytes)
 
 etl.appendoraclesde = appendoraclesde
 
 def _appendoraclesde(self, dbo, table_name, table_srid=None,
-                 buffer_size=DEFAULT_WRITE_BUFFER_SIZE, fail_on_empty=True):
+                 buffer_size=DEFAULT_WRITE_BUFFER_SIZE, fail_on_empty=True,
+                 batch_bytes=DEFAULT_BATCH_BYTES, auto_tune=False, commit='batch', commit_every=1, commit_bytes=None):
     """
     This wraps appendoraclesde and adds a `self` arg so it can be attached to
     the Table class. This enables functional-style chaining.
     """
     return appendoraclesde(self, dbo, table_name, table_srid=table_srid,
-                       buffer_size=buffer_size, fail_on_empty=fail_on_empty)
+                       buffer_size=buffer_size, fail_on_empty=fail_on_empty,
+                       batch_bytes=batch_bytes, auto_tune=auto_tune, commit=commit, commit_every=commit_every,
+                       commit_bytes=commit_bytes)
 
 Table.appendoraclesde = _appendoraclesde
 ################################################################################
@@ -328,7 +443,7 @@ class OracleSdeTable(object):
         else:
             self.schema = self.db.user.lower()
             self.name = name.lower()
-        self.row_count = self._get_row_count()
+        self.is_empty = self._get_is_empty()
         self.geom_field = self._get_geom_field()
         self.geom_type = self._get_geom_type()
         self.max_num_points_in_geom = 0 if not self.geom_field else self._get_max_num_points_in_geom()
@@ -487,6 +602,42 @@ class OracleSdeTable(object):
         with open(table_schema_output_path, 'w') as fp:
             json.dump(metadata_fmt, fp)
 
+    @property
+    def change_marker(self):
+        """
+        Returns values that change whenever the table's rows do, for telling
+        whether cached rows are current: the highest ORA_ROWSCN, which any
+        committed change to a block raises, and LAST_DDL_TIME, which
+        TRUNCATE and other DDL change. Returns None if they can't be read,
+        e.g. for views.
+        """
+        stmt = '''
+            SELECT
+                (SELECT MAX(ORA_ROWSCN) FROM {table}),
+                (SELECT TO_CHAR(LAST_DDL_TIME, 'YYYY-MM-DD HH24:MI:SS') FROM ALL_OBJECTS
+                 WHERE OWNER = :1 AND OBJECT_NAME = :2 AND OBJECT_TYPE = 'TABLE')
+            FROM DUAL
+        '''.format(table=self._name_with_schema_p)
+        try:
+            self.db.cursor.execute(stmt, (self._owner.upper(), self.name.upper()))
+        except cx_Oracle.DatabaseError:
+            return None
+        scn, ddl_time = self.db.cursor.fetchone()
+        if ddl_time is None:
+            return None
+        return (scn, ddl_time)
+
+    @property
+    def row_count(self):
+        """The number of rows in the table, counted when asked for."""
+        return self._get_row_count()
+
+    def _get_is_empty(self):
+        """Checks for a first row rather than counting them all."""
+        stmt = 'SELECT 1 FROM {}.{} WHERE ROWNUM = 1'.format(self._owner.upper(), self.name.upper())
+        self.db.cursor.execute(stmt)
+        return self.db.cursor.fetchone() is None
+
     def _get_row_count(self):
         row_count_stmt = '''
             select count(*) from {}.{}
@@ -534,7 +685,7 @@ class OracleSdeTable(object):
         #     raise AssertionError('Table is not registered with SDE! To write with shapes it needs to be registered.')
 
         # If the table isn't empty, get geom types from sde.st_geometrytype()
-        if self.row_count > 0:
+        if not self.is_empty:
             stmt = '''select distinct sde.st_geometrytype({geom_field}) from {owner}.{table_name} WHERE SDE.ST_ISEMPTY({geom_field}) = 0 '''.format(geom_field=self.geom_field, owner=self._owner.upper(), table_name=self.name.upper())
             geom_type_response = self.db.cursor.execute(stmt)
             geom_types = []
@@ -653,8 +804,12 @@ class OracleSdeTable(object):
         return max_num_points_in_geom
 
 
-    def wkt_getter(self, to_srid):
+    def wkt_getter(self, to_srid, with_srid=False):
         assert self.geom_field
+        if with_srid and self.srid:
+            # EWKT; Oracle has no empty strings, so nulls stay null
+            return "CASE WHEN {geom_field} IS NULL THEN NULL ELSE 'SRID={srid};' || sde.st_astext({geom_field}) END " \
+                   "AS {geom_field}".format(geom_field=self.geom_field, srid=self.srid)
         return 'sde.st_astext({geom_field}) AS {geom_field}'.format(geom_field=self.geom_field)
 
     #returns a list of the time zone aware field names in a table
@@ -700,86 +855,29 @@ class OracleSdeTable(object):
 
     def _prepare_val(self, val, type_):
         """Prepare a value for entry into the DB."""
-        if val is None or val == '' or val == 0:
-            return val
-        # TODO handle types. Seems to be working without this for most cases.
-        if type_ == 'text':
-            pass
-        elif type_ == 'num':
-            pass
-        elif type_ == 'integer':
-            pass
-        elif type_ == 'geom':
-            pass
-        elif type_ == 'date':
-            # Convert datetimes to ISO-8601
-            if isinstance(val, str):
-                splitval = val.split(' ')
-                if ' ' in val and ':' in splitval[1] and 'T' not in val:
-                    val =splitval[0] + 'T' + splitval[1]
-                val = dt_parser().parse(val)
-                val = val.strftime("%Y-%m-%d %H:%M:%S")
-            if isinstance(val, datetime):
-                val = val.strftime("%Y-%m-%d %H:%M:%S")
-        elif type_ == 'nclob': 
-            # Cast as a CLOB object so cx_Oracle doesn't try to make it a LONG
-            # var = self._c.var(cx_Oracle.NCLOB)
-            # var.setvalue(0, val)
-            # val = var
-            pass
-        elif type_ == 'timestamp with time zone':
-            if isinstance(val, datetime):
-                val = val.isoformat()
-            elif isinstance(val, str):
-                val=dt_parser().parse(val)
-                val = val.isoformat()
-        elif type_ == 'timestamp without time zone':
-            if isinstance(val, datetime):
-                val = val.strftime("%Y-%m-%d %H:%M:%S.%f")
-            elif isinstance(val, str):
-                val = dt_parser().parse(val)
-                val = val.strftime("%Y-%m-%d %H:%M:%S.%f")
-        else:
+        try:
+            encode = VALUE_ENCODERS[type_]
+        except KeyError:
             raise TypeError("Unhandled type: '{}'".format(type_))
-        return val
+        return encode(val)
 
     def _prepare_geom(self, geom, srid, transform_srid=None, multi_geom=True):
-        """Prepares WKT geometry by projecting and casting as necessary."""
-        if geom is None or geom == '':
+        """Prepares a geometry value as 2D WKT for SDE.ST_Geometry, which
+        takes the SRID separately."""
+        wkt = geometry.to_wkt(geom, multi=multi_geom)
+        if wkt is None:
             # TODO: should this use the `EMPTY` keyword?
             if not self.geom_type:
                 return 'POINT EMPTY'
             else:
                 return '{} EMPTY'.format(self.geom_type)
-        
-        # If shape was exported as EWKT (e.g. we exported from postgis with --with_srid), then remove the SRID which is in front of the shape
-        # which is converting to WKT.
-        if geom.startswith('SRID='):
-            geom = geom.split(';')[1]
-
-        # Uncomment this to use write method #1 (see write function for details)
-        # geom = "SDE.ST_Geometry('{}', {})".format(geom, srid)
-
-        # Handle 3D geometries
-        # TODO screen these with regex
-        if 'NaN' in geom:
-            geom = geom.replace('NaN', '0')
-            geom = "ST_Force_2D({})".format(geom)
-
-        # TODO this was copied over from PostGIS, but maybe Oracle can handle
-        # them as-is?
-        if 'CURVE' in geom or geom.startswith('CIRC'):
-            geom = "ST_CurveToLine({})".format(geom)
 
         # Reproject if necessary
         # TODO: do this with pyproj since ST_Geometry can't
         # if transform_srid and srid != transform_srid:
         #      geom = "ST_Transform({}, {})".format(geom, transform_srid)
 
-        if multi_geom:
-            geom = 'ST_Multi({})'.format(geom)
-
-        return geom
+        return wkt
 
     @property
     def privileges(self):
@@ -825,7 +923,9 @@ class OracleSdeTable(object):
 
 
     def write(self, rows, srid=None, table_srid=None,
-              buffer_size=DEFAULT_WRITE_BUFFER_SIZE,increment=True,truncate=True, fail_on_empty=True):
+              buffer_size=DEFAULT_WRITE_BUFFER_SIZE,increment=True,truncate=True, fail_on_empty=True,
+              batch_bytes=DEFAULT_BATCH_BYTES, auto_tune=False, commit='batch', commit_every=1, commit_bytes=None,
+              on_error='raise', reject_file=None):
         """
         Inserts dictionary row objects in the the database.
         Args: list of row dicts, table name, ordered field names
@@ -834,11 +934,25 @@ class OracleSdeTable(object):
         rows, but it's considerably faster to use the cx_Oracle `executemany`
         function. See methods 1 and 2 below.
 
+        Rows are sent in batches of at most buffer_size rows and batch_bytes
+        bytes; see geopetl.batch.Batcher. When they're committed is up to
+        `commit`; see geopetl.batch.CommitPolicy.
+
+        With on_error='reject', batches are sent with batcherrors so rows
+        Oracle rejects are skipped and written to `reject_file`
+        (<owner>.<table>_rejects.csv by default) with the error. A batch that
+        fails outright is bisected under savepoints to find the bad rows.
+
         TODO: it might be faster to call NEXTVAL on the DB sequence for OBJECTID
         rather than use the SDE helper function.
         """
+        if on_error not in ON_ERROR_MODES:
+            raise ValueError("Unknown on_error '{}', expected one of: {}".format(on_error, ', '.join(ON_ERROR_MODES)))
+        # The source is read once, so a query or file isn't extracted again
+        # just to look at the first rows.
+        rows = RowStream.wrap(rows)
         # If the dataframe is empty or only has a header, exit
-        if len(rows) < 2:
+        if rows.empty:
             print("Dataframe is empty, exiting...")
             if fail_on_empty:    
                 raise Exception("Dataframe is empty, exiting...")
@@ -854,10 +968,8 @@ class OracleSdeTable(object):
 
         # Get fields from the row because some fields from self.fields may be
         # optional, such as an autoincrementing PK.
-        try:
-            fields = rows.header()
-        except:
-            fields = rows[0]
+        fields = rows.header
+        header = list(fields)
         # Sort so LOB fields are at the end
         # TODO this will raise an error if the rows being passed in have
         # different fields from the destination table. We should do this more
@@ -871,51 +983,44 @@ class OracleSdeTable(object):
         #     if geom_field else None
         if table_geom_field:
             # get row geom field
-            first_row_view = rows.head(n=1)
-            first_row_header = first_row_view.header()
-            first_row = first_row_view[1]
-
-            rows_geom_field = None
-            for i, val in enumerate(first_row):
-                # TODO make a function to screen for wkt-like text
-                if str(val).startswith('SRID='):
-                    val = val.split(';')[1]
-                if str(val).startswith(('POINT', 'POLYGON', 'LINESTRING', 'MULTIPOLYGON')):
-                    if rows_geom_field:
-                        raise ValueError('Multiple geometry fields found: {}'.format(', '.join([rows_geom_field, first_row_header[i]])))
-                    rows_geom_field = first_row_header[i]
+            first_row_header = header
+            first_row = rows.head(1)[0]
+
+            # use the table's own geom field when the rows have it, and only
+            # sniff the values otherwise, so text like 'Point' in another
+            # field isn't taken for a geometry
+            rows_geom_field = table_geom_field if table_geom_field in first_row_header else None
+            if not rows_geom_field:
+                for i, val in enumerate(first_row):
+                    if not isinstance(val, (str, geometry.LazyGeometry)):
+                        continue
+                    try:
+                        if geometry.decode(val) is None:
+                            continue
+                    except ValueError:
+                        continue
+                    else:
+                        if rows_geom_field:
+                            raise ValueError('Multiple geometry fields found: {}'.format(', '.join([rows_geom_field, first_row_header[i]])))
+                        rows_geom_field = first_row_header[i]
 
             # for cases when the above method doesn't work b/c the first row geom is empty, set rows_geom_field = table_geom_field
             rows_geom_field = rows_geom_field or table_geom_field
 
             if rows_geom_field:
-                geom_rows = rows.selectnotnone(rows_geom_field).records()
-                geom_row = geom_rows[0]
-                geom = geom_row[rows_geom_field]
+                first_geom = rows.first(rows_geom_field)
+                try:
+                    geom = geometry.decode(first_geom)
+                except ValueError:
+                    raise Exception('Could not find geometry type, is the table SDE registered? Geom looks like: {}'.format(
+                        str(first_geom)[:100]))
                 # Override SRID we'll use to insert with if we find the SRID in the shape field in the CSV.
                 # This is so we can insert shapes into unregistered tables.
-                if geom.startswith('SRID='):
-                    srid = geom.split(';')[0].split('=')[1]
-                # if geom value is empty in staging data, insert "point table"
-                if not geom:
-                    geom = 'POINT EMPTY'
-                try:
-                    row_geom_type = re.match('[A-Z]+', geom).group()
-                except AttributeError:
-                    raise Exception(f'Could not find geometry type, is the table SDE registered? Geom looks like: {geom}')
-                # For "bytes-like objects"
-                except TypeError:
-                    row_geom_type = re.match(b'[A-Z]+', geom).group()
-
-                # Do we need to cast the geometry to a MULTI type? (Assuming all rows
-                # have the same geom type.)
-                # if row_geom_type:
-                # Check for a geom_type first, in case the table is empty.
-                if row_geom_type and row_geom_type.startswith('MULTI') and \
-                    not row_geom_type.startswith('MULTI'):
-                    multi_geom = True
-                else:
-                    multi_geom = False
+                if geom and geom.srid:
+                    srid = geom.srid
+                # Geometries are written as they are, without casting to
+                # MULTI types.
+                multi_geom = False
 
         # Make a map of non geom field name => type
         # TODO we might not need this since self.metadata is now mappy
@@ -1004,8 +1109,15 @@ class OracleSdeTable(object):
         c.execute('select * from {} where rownum = 1'.format(self._name_with_schema))
         db_types = {d[0]: d[1] for d in self.db.cursor.description}
 
+        # Oracle has no RELEASE SAVEPOINT; setting one with the same name
+        # replaces the last
+        rejects = None
+        if on_error == 'reject':
+            rejects = RejectFile(reject_file or '{}_rejects.csv'.format(self._name_with_schema), header)
+        commit_policy = CommitPolicy(self.db.dbo, commit, every=commit_every, every_bytes=commit_bytes,
+                                     release_savepoints=False, rejects=rejects)
         if truncate:
-            self.truncate()
+            self.truncate(commit=commit == 'batch')
         # Prepare statement
         placeholders_joined = ', '.join(placeholders)
         stmt_fields_joined = ', '.join(stmt_fields)
@@ -1023,46 +1135,12 @@ class OracleSdeTable(object):
         except:
             pass
 
-        # Make list of value lists
-        val_rows = []
-        cur_stmt = prepare_stmt
-        # use Record object for convenience
-        rows = rows.records()
-
-        for i, row in enumerate(rows):
-            val_row = {}
-            for field, type_ in type_map_items:
-                if type_ == 'geom':
-                    geom = row[rows_geom_field]
-                    val = self._prepare_geom(geom, srid, \
-                        multi_geom=multi_geom)
-                    val_row[field.upper()] = val
-                else:
-                    if field == self.objectid_field and increment:
-                        continue
-                    val = self._prepare_val(row[field], type_)
-                    # TODO: NCLOBS should be inserted via array vars
-                    # if type_ == 'nclob':
-                    # val_row.append(val)
-                    val_row[field.upper()] = val
-            val_rows.append(val_row)
-
-            if i % buffer_size == 0:
-                # execute
-                try:
-                    self.db.cursor.executemany(None, val_rows, batcherrors=False)
-                except Exception as e:
-                    print(f'Error trying to write. Length of val_rows {len(val_rows)}')
-                    print(f'Prepare statement used for executemany: {prepare_stmt}')
-                    err = self.db.cursor.getbatcherrors()
-                    print(err)
-                    raise e
-                self.db.dbo.commit()
-
-                val_rows = []
-                cur_stmt = prepare_stmt
-        # if there are remaining rows, write them:
-        if val_rows:
+        def flush(val_rows):
+            if rejects is not None:
+                # rows that fail are skipped and reported rather than
+                # failing the batch, so no bisecting is needed for them
+                self.db.cursor.executemany(None, val_rows, batcherrors=True)
+                return [(e.offset, e.message) for e in self.db.cursor.getbatcherrors()]
             try:
                 self.db.cursor.executemany(None, val_rows, batcherrors=False)
             except Exception as e:
@@ -1071,11 +1149,107 @@ class OracleSdeTable(object):
                 err = self.db.cursor.getbatcherrors()
                 print(err)
                 raise e
-            self.db.dbo.commit()
 
-    def truncate(self, cascade=False):
-        """Delete all rows."""
+        # pair each bind variable with the index of its value in a row and an
+        # encoder for its type, once, so rows are encoded without checking
+        # fields or types
+        def encode_geom(geom):
+            return self._prepare_geom(geom, srid, multi_geom=multi_geom)
+
+        columns = []
+        bind_names = []
+        for field, type_ in type_map_items:
+            if type_ == 'geom':
+                column = (header.index(rows_geom_field), encode_geom)
+            elif field == self.objectid_field and increment:
+                continue
+            elif type_ in VALUE_ENCODERS:
+                # TODO: NCLOBS should be inserted via array vars
+                column = (header.index(field), VALUE_ENCODERS[type_])
+            else:
+                raise TypeError("Unhandled type: '{}'".format(type_))
+            columns.append(column)
+            bind_names.append(field.upper())
+        encode_row = row_encoder(columns)
+
+        batcher = Batcher(flush, max_rows=buffer_size, max_bytes=batch_bytes, auto_tune=auto_tune,
+                          commit=commit_policy)
+
+        try:
+            for row in etl.data(rows):
+                val_row = dict(zip(bind_names, encode_row(row)))
+                batcher.add(val_row, row_size(val_row.values()), row)
+            # if there are remaining rows, write them:
+            batcher.close()
+        except Exception:
+            commit_policy.abort()
+            raise
+        finally:
+            if rejects is not None:
+                rejects.close()
+
+    def write_delta(self, rows, **write_kwargs):
+        """
+        Writes only the rows that differ from what's in the table, matched on
+        the objectid field. Rows are compared by a hash of their values (see
+        geopetl.delta); changed and removed rows are deleted, and new and
+        changed rows are inserted with their own object IDs. Changed rows
+        stream into the write, each batch of them deleted just before it's
+        read. Keyword args are passed to write(), except that the load is
+        always one transaction (commit='single'), so readers never miss a
+        changed row between its delete and insert. Returns the changes.
+
+        on_error='reject' isn't supported: a changed row Oracle refused would
+        be rejected after its old version was deleted, and so lost.
+        """
+        if write_kwargs.get('on_error', 'raise') == 'reject':
+            raise ValueError("Delta writes can't reject rows, since a rejected changed row would be deleted. "
+                             "Use on_error='raise'.")
+        objectid_field = self.objectid_field
+        rows = RowStream.wrap(rows)
+        header = list(rows.header)
+        if not objectid_field or objectid_field not in header:
+            raise ValueError('Delta writes need the objectid field in the rows')
+        types = {name: x['type'] for name, x in self.metadata.items()}
+        kinds = OrderedDict([(x, row_delta.column_kind(types[x])) for x in header
+                             if x in types and x != objectid_field])
+        geom_field = self.geom_field
+        multi_geom = bool(geom_field) and (self.geom_type or '').upper().startswith('MULTI')
+        target = self.query(fields=[objectid_field] + [x for x in kinds if x != geom_field],
+                            return_geom=bool(geom_field) and geom_field in kinds)
+        # a cursor of its own, since the writer sets input sizes on the
+        # shared one
+        delete_cursor = self.db.dbo.cursor()
+        delete_stmt = 'DELETE FROM {} WHERE {} = :1'.format(self._name_with_schema_p, objectid_field)
+
+        def delete(keys):
+            delete_cursor.executemany(delete_stmt, [(x,) for x in keys])
+
+        diff = row_delta.Diff(rows, target, objectid_field, dict(kinds), multi_geom=multi_geom, before_update=delete)
+        changed = RowStream(diff)
+        write_kwargs.update(commit='single', truncate=False, increment=False)
+        if not changed.empty:
+            self.write(changed, **write_kwargs)
+        # the rows to delete are known once the source has been read
+        changes = diff.changes
+        if changes['delete']:
+            delete(changes['delete'])
+        self.db.dbo.commit()
+        print('Geopetl: delta for {}: {} inserted, {} updated, {} deleted, {} unchanged'.format(
+            self._name_with_schema_p, len(changes['insert']), len(changes['update']), len(changes['delete']),
+            changes['unchanged']))
+        return changes
+
+    def truncate(self, cascade=False, commit=True):
+        """
+        Delete all rows. TRUNCATE is DDL and commits by itself, so with
+        commit=False the rows are deleted instead, leaving the delete in the
+        current transaction.
+        """
         name = self._name_with_schema_p
+        if not commit:
+            self.db.cursor.execute(f"DELETE FROM {name}")
+            return
         stmt = f"TRUNCATE TABLE {name}"
         stmt += ' CASCADE' if cascade else ''
         self.db.cursor.execute(stmt)
@@ -1097,7 +1271,12 @@ class OracleSdeTable(object):
 
 class OracleSdeQuery(SpatialQuery):
     def __init__(self,  db, table, fields=None, return_geom=True, to_srid=None,
-                 where=None, limit=None, timestamp=False, geom_with_srid=False, sql=None):
+                 where=None, limit=None, timestamp=False, geom_with_srid=False, sql=None,
+                 keyset=False, page_size=DEFAULT_PAGE_SIZE, checkpoint=None, bbox=None, intersects=None,
+                 dwithin=None, filter_srid=None, cache=None, estimate_count=False):
+        keyset = keyset or checkpoint is not None
+        if keyset and (sql or limit):
+            raise ValueError('keyset can\'t be combined with sql or limit')
         self.db = db
         self.table = table
         self.fields = fields
@@ -1108,6 +1287,15 @@ class OracleSdeQuery(SpatialQuery):
         self.timestamp = timestamp
         self.geom_with_srid = geom_with_srid
         self.sql = sql
+        self.keyset = keyset
+        self.page_size = page_size
+        self.checkpoint = checkpoint
+        self.bbox = bbox
+        self.intersects = intersects
+        self.dwithin = dwithin
+        self.filter_srid = filter_srid
+        self.cache = ResultCache.wrap(cache)
+        self.estimate_count = estimate_count
         # For tests to ensure we're not slamming the database
         self.times_db_called = 0
 
@@ -1126,10 +1314,62 @@ class OracleSdeQuery(SpatialQuery):
     def mkcursor(self):
         cursor = self.db.dbo.cursor()
         cursor.outputtypehandler = self.output_type_handler
+        # filter geometries are bound as CLOBs, since WKT often runs past the
+        # 4000 characters a string can
+        binds = self.stmt_params()
+        if binds:
+            cursor.setinputsizes(**{name: cx_Oracle.CLOB for name in binds})
         return cursor
 
     def __iter__(self):
         """Proxy iteration to core petl."""
+        if self.cache is not None:
+            marker = self.table.change_marker
+            if marker is not None:
+                dbo = self.db.dbo
+                key = self.cache.key(dbo.dsn, dbo.username, self.stmt(), sorted(self.stmt_params().items()),
+                                     marker, self.geom_with_srid)
+                return self.cache.rows(key, self._iter_rows)
+            print('Geopetl: {} has no change marker, so its rows aren\'t cached'.format(self.table._name_with_schema))
+        return self._iter_rows()
+
+    def _subquery(self):
+        return self.stmt().rstrip().rstrip(';')
+
+    def header(self):
+        """Returns the header from running the query with WHERE 1 = 0,
+        rather than reading its first row."""
+        cursor = self.mkcursor()
+        try:
+            cursor.execute('SELECT * FROM ({}) WHERE 1 = 0'.format(self._subquery()), self.stmt_params())
+            return tuple([d[0].lower() for d in cursor.description])
+        finally:
+            cursor.close()
+
+    def nrows(self, estimate=None):
+        """
+        Returns the number of rows the query returns, counted with COUNT(*)
+        in the database rather than by reading them. With estimate (which
+        defaults to estimate_count), a query over a whole table returns the
+        table's NUM_ROWS from its last statistics run instead, if it has
+        one.
+        """
+        if estimate is None:
+            estimate = self.estimate_count
+        if estimate and not (self.sql or self.where or self.spatial_filters()):
+            self.db.cursor.execute('SELECT NUM_ROWS FROM ALL_TABLES WHERE OWNER = :1 AND TABLE_NAME = :2',
+                                   (self.table._owner.upper(), self.table.name.upper()))
+            row = self.db.cursor.fetchone()
+            if row and row[0] is not None:
+                return min(row[0], self.limit) if self.limit else row[0]
+        cursor = self.mkcursor()
+        try:
+            cursor.execute('SELECT COUNT(*) FROM ({})'.format(self._subquery()), self.stmt_params())
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+
+    def _iter_rows(self):
         # form sql statement if sql isn't provided on fct call
         # if there is a sql arg provided
         if self.sql:
@@ -1141,14 +1381,20 @@ class OracleSdeQuery(SpatialQuery):
         dbo = self.db.dbo
         # execute qry
         print('Geopetl: Reading data from database..', datetime.now())
-        db_view = etl.fromdb(self.mkcursor(), stmt)
+        params = self.stmt_params()
+        if self.keyset:
+            db_view = self._keyset_view()
+        elif params:
+            # a new cursor each time it's executed, with the binds set up
+            db_view = etl.fromdb(self.mkcursor, stmt, params)
+        else:
+            db_view = etl.fromdb(self.mkcursor(), stmt)
         self.times_db_called += 1
 
-        header = [h.lower() for h in db_view.header()]
+        # describe the query rather than db_view.header(), which would run
+        # all of it an extra time
+        header = list(self.header())
 
-        if self.geom_with_srid and self.geom_field and self.geom_field in header and self.srid:
-            db_view = db_view.convert(self.geom_field.upper(), lambda g: 'SRID={srid};{g}'.format(srid=self.srid, g=g) if g not in ('', None) else '')
-        
         # checks tz field in table not view
         selected_ts_fields = [f for f in self.table.timezone_fields if f in header]
         if len(selected_ts_fields) > 0:
@@ -1161,6 +1407,42 @@ class OracleSdeQuery(SpatialQuery):
         iter_fn = db_view.__iter__()
         return iter_fn
 
+    def _keyset_view(self):
+        """Returns a view reading the query a page at a time in objectid
+        order; see geopetl.keyset."""
+        key = self.table.objectid_field
+        if not key:
+            raise ValueError('Keyset reads need an objectid field')
+        if self.fields is not None and key not in self.fields:
+            raise ValueError('Keyset reads need the objectid field in fields')
+        checkpoint = None
+        if self.checkpoint:
+            query = self.stmt()
+            params = self.stmt_params()
+            if params:
+                query += ' -- {}'.format(json.dumps(params, sort_keys=True, default=str))
+            checkpoint = Checkpoint(self.checkpoint, self.table._name_with_schema, query)
+
+        def fetch_page(last, page_size):
+            # rows with a null key can't be paged through, so they're left out
+            if last is None:
+                where = '{} IS NOT NULL'.format(_quote(key.upper()))
+            else:
+                where = '{} > :last'.format(_quote(key.upper()))
+            stmt = 'SELECT * FROM ({}) WHERE ROWNUM <= {}'.format(
+                self.stmt(where=where, order_by=key), page_size)
+            cursor = self.mkcursor()
+            params = self.stmt_params()
+            if last is not None:
+                params['last'] = last
+            cursor.execute(stmt, params)
+            header = [d[0] for d in cursor.description]
+            rows = cursor.fetchall()
+            cursor.close()
+            return header, rows
+
+        return KeysetView(fetch_page, key, self.page_size, checkpoint)
+
     @property
     def geom_field(self):
         return self.table.geom_field
@@ -1169,7 +1451,66 @@ class OracleSdeQuery(SpatialQuery):
     def srid(self):
         return self.table.srid
 
-    def stmt(self):
+    def _filter_geom(self, name, val):
+        """Returns SQL for a filter geometry in the table's SRID, bound to
+        :name, and its bind value."""
+        geom = geometry.decode(val)
+        if geom is None:
+            raise ValueError('Spatial filters need a geometry, got: {!r}'.format(val))
+        table_srid = self.srid
+        srid = geom.srid or self.filter_srid or table_srid
+        sql = 'sde.st_geometry(:{}, {})'.format(name, srid)
+        if table_srid and srid != table_srid:
+            sql = 'sde.st_transform({}, {})'.format(sql, table_srid)
+        return sql, geometry.to_wkt(geom, force_2d=False)
+
+    def _spatial_filters(self):
+        if not (self.bbox or self.intersects or self.dwithin):
+            return [], {}
+        geom_field = self.geom_field
+        if not geom_field:
+            raise ValueError('Spatial filters need a table with a geometry column')
+        conditions = []
+        binds = {}
+        if self.bbox:
+            xmin, ymin, xmax, ymax = [float(x) for x in self.bbox]
+            if not self.filter_srid or self.filter_srid == self.srid:
+                conditions.append('sde.st_envintersects({}, {}, {}, {}, {}) = 1'.format(
+                    geom_field, xmin, ymin, xmax, ymax))
+            else:
+                envelope = 'POLYGON(({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))'.format(xmin, ymin, xmax, ymax)
+                sql, binds['geopetl_bbox'] = self._filter_geom('geopetl_bbox', envelope)
+                conditions.append('sde.st_envintersects({}, {}) = 1'.format(geom_field, sql))
+        if self.intersects:
+            sql, binds['geopetl_intersects'] = self._filter_geom('geopetl_intersects', self.intersects)
+            conditions.append('sde.st_intersects({}, {}) = 1'.format(geom_field, sql))
+        if self.dwithin:
+            geom, distance = self.dwithin
+            sql, binds['geopetl_dwithin'] = self._filter_geom('geopetl_dwithin', geom)
+            # st_geometry has no st_dwithin; a buffer keeps the index usable
+            conditions.append('sde.st_intersects({}, sde.st_buffer({}, {})) = 1'.format(
+                geom_field, sql, float(distance)))
+        return conditions, binds
+
+    def spatial_filters(self):
+        """
+        Returns WHERE conditions for the bbox, intersects and dwithin
+        filters, using st_envintersects and st_intersects so the spatial
+        index is used. Filter geometries are transformed to the table's SRID
+        and bound as parameters; see stmt_params.
+        """
+        return self._spatial_filters()[0]
+
+    def stmt_params(self):
+        """Returns the bind values stmt() needs, i.e. the filter
+        geometries as WKT."""
+        if self.sql:
+            return {}
+        return self._spatial_filters()[1]
+
+    def stmt(self, where=None, order_by=None):
+        """Forms the query. `where` is a condition added to the query's own
+        where clause and `order_by` a field to sort on."""
         # handle custom sql stmt
         if self.sql:
             return self.sql
@@ -1189,7 +1530,7 @@ class OracleSdeQuery(SpatialQuery):
         # handle geom
         geom_field = self.table.geom_field
         if geom_field and self.return_geom:
-            wkt_getter = self.table.wkt_getter(self.to_srid)
+            wkt_getter = self.table.wkt_getter(self.to_srid, with_srid=self.geom_with_srid)
             fields.append(wkt_getter)
 
         # form statement
@@ -1200,7 +1541,7 @@ class OracleSdeQuery(SpatialQuery):
             stmt = 'SELECT {} FROM {}'.format(fields_joined, self.table._name_with_schema_p)
 
         # where conditions
-        wheres = [self.where]
+        wheres = [self.where, where] + self.spatial_filters()
 
         # filter empty geoms which throw a db error. these are geoms that aren't
         # null, but have no points.
@@ -1214,6 +1555,9 @@ class OracleSdeQuery(SpatialQuery):
                                                                wheres_filtered])
             stmt += ' WHERE {}'.format(wheres_joined)
 
+        if order_by:
+            stmt += ' ORDER BY {}'.format(_quote(order_by.upper()))
+
         if self.limit:
-            stmt += ' WHERE ROWNUM < {}'.format(self.limit + 1)
+            stmt += ' {} ROWNUM < {}'.format('AND' if any(wheres) else 'WHERE', self.limit + 1)
         return stmt
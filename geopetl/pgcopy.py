@@ -0,0 +1,587 @@
+"""
+Helpers for streaming petl rows into PostgreSQL with COPY ... FROM STDIN,
+and out of it with COPY ... TO STDOUT.
+
+psycopg2's `copy_expert` pulls data from a file-like object with read(), so
+the objects here render rows lazily as they are asked for. Only about one
+read's worth of COPY data is held in memory at a time, rather than a whole
+INSERT statement.
+
+Rows can be rendered in COPY's text format or in its binary format. The
+binary format skips parsing numbers, timestamps and geometries on the server,
+but its encoders have to match the exact column types.
+
+Going the other way, iter_copy_text and iter_copy_binary parse rows out of a
+file object COPY TO STDOUT output is written into.
+"""
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+import io
+import json
+import re
+import struct
+import uuid
+from dateutil import parser as dt_parser
+from dateutil import tz
+from geopetl import geometry
+from geopetl.encoding import row_encoder
+
+# bytes handed to psycopg2 per read() call during a COPY
+COPY_READ_SIZE = 64 * 1024
+
+COPY_NULL = '\\N'
+
+# COPY can't apply ST_CurveToLine, and curves can't be linearized on the
+# client
+CURVE_ERROR = "{} geometries can't be loaded with COPY, which can't linearize curves; use method='insert'"
+
+_COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\n': '\\n',
+    '\r': '\\r',
+    '\t': '\\t',
+})
+
+
+def _escape(val):
+    return str(val).translate(_COPY_ESCAPES)
+
+
+def _encode_text(val):
+    if val is None or val == '':
+        return COPY_NULL
+    if isinstance(val, (dict, list)):
+        val = json.dumps(val)
+    return _escape(val)
+
+
+def _encode_num(val):
+    if val is None or val == '':
+        return COPY_NULL
+    return str(val)
+
+
+def _encode_temporal(val):
+    if val is None or val == '' or val == 'None':
+        return COPY_NULL
+    return _escape(val)
+
+
+def _encode_boolean(val):
+    if val is None or val == '':
+        return COPY_NULL
+    if val is True:
+        return 't'
+    if val is False:
+        return 'f'
+    return _escape(val)
+
+
+def _encode_raw(val):
+    if val is None:
+        return COPY_NULL
+    return _escape(val)
+
+
+# maps the generic types of PostgisTable.metadata to COPY text encoders, and
+# 'raw' to the one for columns of RawValues.
+# geometry is handled separately because it needs an srid.
+TEXT_ENCODERS = {
+    'text':                     _encode_text,
+    'num':                      _encode_num,
+    'date':                     _encode_temporal,
+    'timestamp':                _encode_temporal,
+    'timestamptz':              _encode_temporal,
+    'time without time zone':   _encode_temporal,
+    'time with time zone':      _encode_temporal,
+    'boolean':                  _encode_boolean,
+    'money':                    _encode_num,
+    'uuid':                     _encode_text,
+    'raw':                      _encode_raw,
+}
+
+
+def geom_ewkt_encoder(srid, multi_geom=False, curves=False):
+    """
+    Returns a function that normalizes geometry values for the geometry input
+    function: WKT and EWKT come out as 2D EWKT, cast to multi if needed; WKB
+    (bytes or a hex string) comes out as hex EWKB, which is accepted as-is.
+    Empty values come out as None.
+
+    Curves raise ValueError, unless curves=True says the statement the value
+    goes into linearizes them with ST_CurveToLine; then they come out with
+    the SRID but otherwise as they are.
+    """
+    def encode(val):
+        geom = geometry.decode(val)
+        if geom is None:
+            return None
+        if geom.geom_type in geometry.CURVE_TYPES:
+            if not curves:
+                raise ValueError(CURVE_ERROR.format(geom.geom_type))
+            if geom.format == 'wkb':
+                return geometry.with_srid(geom.data, geom.srid or srid).hex()
+            return geometry.to_ewkt(geom, srid)
+        if geom.format == 'wkb':
+            return geometry.to_ewkb(geom, srid, multi=multi_geom).hex()
+        return geometry.to_ewkt(geom, srid, multi=multi_geom)
+
+    return encode
+
+
+def geom_text_encoder(srid, multi_geom=False, curves=False):
+    """Returns a COPY text encoder for geometry values (see
+    geom_ewkt_encoder)."""
+    to_ewkt = geom_ewkt_encoder(srid, multi_geom, curves)
+
+    def encode(val):
+        val = to_ewkt(val)
+        return COPY_NULL if val is None else _escape(val)
+
+    return encode
+
+
+class CopyTextStream(object):
+    """
+    Read-only file-like object that renders rows as COPY text format lines.
+
+    Args:
+        rows:       an iterable of row tuples
+        columns:    a list of (row index, encoder) pairs, one per COPY column
+    """
+
+    empty = ''
+
+    def __init__(self, rows, columns):
+        self._lines = self._render(rows, columns)
+        self._buffer = self.empty
+
+    @staticmethod
+    def _render(rows, columns):
+        encode_row = row_encoder(columns)
+        for row in rows:
+            yield '\t'.join(encode_row(row)) + '\n'
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = float('inf')
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        for line in self._lines:
+            chunks.append(line)
+            length += len(line)
+            if length >= size:
+                break
+        data = self.empty.join(chunks)
+        if length > size:
+            data, self._buffer = data[:size], data[size:]
+        else:
+            self._buffer = self.empty
+        return data
+
+
+################################################################################
+# BINARY FORMAT
+################################################################################
+
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('>h', -1)
+
+# PostgreSQL counts dates and timestamps from 2000-01-01
+PG_EPOCH_DATE = date(2000, 1, 1)
+PG_EPOCH = datetime(2000, 1, 1)
+PG_EPOCH_TZ = datetime(2000, 1, 1, tzinfo=tz.UTC)
+
+_TRUE_STRINGS = ('t', 'true', 'y', 'yes', 'on', '1')
+
+_NUMERIC_POS = 0x0000
+_NUMERIC_NEG = 0x4000
+_NUMERIC_NAN = 0xC000
+
+
+# types whose values can arrive as the string 'None', from str(None)
+_TEMPORAL_UDTS = ('date', 'timestamp', 'timestamptz', 'time')
+
+
+def _to_int(val):
+    if isinstance(val, int):
+        return val
+    num = Decimal(str(val).strip())
+    # text COPY and INSERT refuse a fraction rather than truncating it
+    if num != num.to_integral_value():
+        raise ValueError('Not an integer: {!r}'.format(val))
+    return int(num)
+
+
+def _to_date(val):
+    if isinstance(val, datetime):
+        return val.date()
+    if isinstance(val, date):
+        return val
+    val = str(val).strip()
+    try:
+        return date.fromisoformat(val)
+    except ValueError:
+        return dt_parser.parse(val).date()
+
+
+def _to_datetime(val):
+    if isinstance(val, datetime):
+        return val
+    if isinstance(val, date):
+        return datetime(val.year, val.month, val.day)
+    val = str(val).strip()
+    try:
+        return datetime.fromisoformat(val)
+    except ValueError:
+        return dt_parser.parse(val)
+
+
+def _micros(delta):
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _bin_numeric(val):
+    """Encodes a number in PostgreSQL's numeric format: base-10000 digits
+    with a weight, sign and display scale."""
+    if not isinstance(val, Decimal):
+        val = Decimal(str(val).strip())
+    if val.is_nan():
+        return struct.pack('>hhHh', 0, 0, _NUMERIC_NAN, 0)
+    if val.is_infinite():
+        raise ValueError('Cannot encode infinite numeric: {}'.format(val))
+    sign, digits, exp = val.as_tuple()
+    digits = ''.join(map(str, digits))
+    if exp >= 0:
+        int_digits, frac_digits = digits + '0' * exp, ''
+    else:
+        digits = digits.rjust(-exp, '0')
+        int_digits, frac_digits = digits[:len(digits) + exp], digits[len(digits) + exp:]
+    dscale = max(0, -exp)
+    int_digits = int_digits.lstrip('0')
+    int_digits = int_digits.rjust(len(int_digits) + (-len(int_digits)) % 4, '0')
+    frac_digits = frac_digits.ljust(len(frac_digits) + (-len(frac_digits)) % 4, '0')
+    groups = [int(int_digits[i:i + 4]) for i in range(0, len(int_digits), 4)] + \
+             [int(frac_digits[i:i + 4]) for i in range(0, len(frac_digits), 4)]
+    weight = len(int_digits) // 4 - 1
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight = 0
+    return struct.pack('>hhHh{}H'.format(len(groups)), len(groups), weight,
+                       _NUMERIC_NEG if sign else _NUMERIC_POS, dscale, *groups)
+
+
+def _bin_bool(val):
+    if isinstance(val, str):
+        val = val.strip().lower() in _TRUE_STRINGS
+    return b'\x01' if val else b'\x00'
+
+
+def _bin_date(val):
+    return struct.pack('>i', (_to_date(val) - PG_EPOCH_DATE).days)
+
+
+def _bin_timestamp(val):
+    # like the text format, a timestamp without time zone ignores any offset
+    val = _to_datetime(val).replace(tzinfo=None)
+    return struct.pack('>q', _micros(val - PG_EPOCH))
+
+
+def _bin_time(val):
+    if isinstance(val, datetime):
+        val = val.time()
+    elif not isinstance(val, time):
+        val = time.fromisoformat(str(val).strip())
+    return struct.pack('>q', ((val.hour * 60 + val.minute) * 60 + val.second) * 1000000 + val.microsecond)
+
+
+def _bin_uuid(val):
+    if not isinstance(val, uuid.UUID):
+        val = uuid.UUID(str(val).strip())
+    return val.bytes
+
+
+def binary_encoder(udt, encoding='utf_8', timezone=None):
+    """
+    Returns a function that encodes a value as a binary COPY field (length
+    prefix included) for a column with the given udt_name (e.g. int4, text).
+
+    Args:
+        encoding:   python codec of the connection's client_encoding
+        timezone:   tzinfo used for naive values of timestamptz columns,
+                    i.e. the session TimeZone
+    """
+    def text(val):
+        if isinstance(val, (dict, list)):
+            val = json.dumps(val)
+        return str(val).encode(encoding)
+
+    def timestamptz(val):
+        val = _to_datetime(val)
+        if val.tzinfo is None:
+            val = val.replace(tzinfo=timezone or tz.UTC)
+        return struct.pack('>q', _micros(val - PG_EPOCH_TZ))
+
+    encoders = {
+        'int2':         lambda v: struct.pack('>h', _to_int(v)),
+        'int4':         lambda v: struct.pack('>i', _to_int(v)),
+        'int8':         lambda v: struct.pack('>q', _to_int(v)),
+        'float4':       lambda v: struct.pack('>f', float(v)),
+        'float8':       lambda v: struct.pack('>d', float(v)),
+        'numeric':      _bin_numeric,
+        'text':         text,
+        'varchar':      text,
+        'bpchar':       text,
+        'name':         text,
+        'json':         text,
+        'jsonb':        lambda v: b'\x01' + text(v),
+        'bytea':        lambda v: bytes(v) if isinstance(v, (bytes, bytearray, memoryview)) else text(v),
+        'bool':         _bin_bool,
+        'date':         _bin_date,
+        'timestamp':    _bin_timestamp,
+        'timestamptz':  timestamptz,
+        'time':         _bin_time,
+        'uuid':         _bin_uuid,
+    }
+    try:
+        encode = encoders[udt]
+    except KeyError:
+        raise TypeError("Unhandled type for binary COPY: '{}'".format(udt))
+
+    null_strings = ('', 'None') if udt in _TEMPORAL_UDTS else ('',)
+
+    def encode_field(val):
+        if val is None or val in null_strings:
+            return b'\xff\xff\xff\xff'
+        data = encode(val)
+        return struct.pack('>i', len(data)) + data
+
+    return encode_field
+
+
+def geom_binary_encoder(srid, multi_geom=False):
+    """Returns a binary COPY field encoder that sends geometries as EWKB,
+    converting WKT/EWKT on the client. Curves raise ValueError, as they can't
+    be linearized here."""
+    def encode_field(val):
+        geom = geometry.decode(val)
+        if geom is not None and geom.geom_type in geometry.CURVE_TYPES:
+            raise ValueError(CURVE_ERROR.format(geom.geom_type))
+        data = geometry.to_ewkb(geom, srid, multi=multi_geom)
+        if data is None:
+            return b'\xff\xff\xff\xff'
+        return struct.pack('>i', len(data)) + data
+
+    return encode_field
+
+
+class CopyBinaryStream(CopyTextStream):
+    """
+    Read-only file-like object that renders rows in COPY's binary format.
+
+    Args:
+        rows:       an iterable of row tuples
+        columns:    a list of (row index, binary encoder) pairs, one per COPY
+                    column
+    """
+
+    empty = b''
+
+    @staticmethod
+    def _render(rows, columns):
+        yield PGCOPY_HEADER
+        field_count = struct.pack('>h', len(columns))
+        encode_row = row_encoder(columns)
+        for row in rows:
+            yield field_count + b''.join(encode_row(row))
+        yield PGCOPY_TRAILER
+
+
+################################################################################
+# COPY TO STDOUT
+################################################################################
+
+_TEXT_UNESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+_TEXT_ESCAPE_RE = re.compile(r'\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)')
+
+
+def _unescape_match(m):
+    seq = m.group(1)
+    if seq in _TEXT_UNESCAPES:
+        return _TEXT_UNESCAPES[seq]
+    if seq[0] == 'x' and len(seq) > 1:
+        return chr(int(seq[1:], 16))
+    if seq[0] in '01234567':
+        return chr(int(seq, 8))
+    return seq
+
+
+def iter_copy_text(f, encoding, converters):
+    """
+    Yields rows parsed from COPY text format read from the binary file
+    object `f`. Values are unescaped, '\\N' becomes None, and each column's
+    converter in `converters` (None to leave it a string) is applied to the
+    values that aren't null.
+    """
+    for line in io.TextIOWrapper(f, encoding=encoding, newline='\n'):
+        if line.endswith('\n'):
+            line = line[:-1]
+        row = []
+        for val, convert in zip(line.split('\t'), converters):
+            if val == COPY_NULL:
+                row.append(None)
+                continue
+            if '\\' in val:
+                val = _TEXT_ESCAPE_RE.sub(_unescape_match, val)
+            row.append(convert(val) if convert else val)
+        yield tuple(row)
+
+
+_INT16 = struct.Struct('>h')
+_INT32 = struct.Struct('>i')
+_INT64 = struct.Struct('>q')
+_NUMERIC_PINF = 0xD000
+_NUMERIC_NINF = 0xF000
+
+
+def _unbin_numeric(data):
+    ndigits, weight, sign, dscale = struct.unpack('>hhHh', data[:8])
+    if sign == _NUMERIC_NAN:
+        return Decimal('NaN')
+    if sign == _NUMERIC_PINF:
+        return Decimal('Infinity')
+    if sign == _NUMERIC_NINF:
+        return Decimal('-Infinity')
+    digits = ''.join(['{:04d}'.format(x) for x in struct.unpack('>{}H'.format(ndigits), data[8:])])
+    # the first base-10000 digit is worth 10000 ** weight
+    point = (weight + 1) * 4
+    if point <= 0:
+        digits, point = '0' * -point + digits, 0
+    elif point > len(digits):
+        digits += '0' * (point - len(digits))
+    text = digits[:point].lstrip('0') or '0'
+    if dscale > 0:
+        text += '.' + (digits[point:] + '0' * dscale)[:dscale]
+    return Decimal('-' + text if sign == _NUMERIC_NEG else text)
+
+
+def _unbin_date(data):
+    days = _INT32.unpack(data)[0]
+    try:
+        return PG_EPOCH_DATE + timedelta(days=days)
+    except OverflowError:
+        # infinity, as psycopg2 returns it
+        return date.max if days > 0 else date.min
+
+
+def _unbin_timestamp(data, epoch=PG_EPOCH):
+    micros = _INT64.unpack(data)[0]
+    try:
+        return epoch + timedelta(microseconds=micros)
+    except OverflowError:
+        return (datetime.max if micros > 0 else datetime.min).replace(tzinfo=epoch.tzinfo)
+
+
+def _unbin_time(data):
+    micros = _INT64.unpack(data[:8])[0]
+    seconds, micros = divmod(micros, 1000000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    tzinfo = None
+    if len(data) == 12:
+        # timetz adds the zone's offset, in seconds west of UTC
+        tzinfo = tz.tzoffset(None, -_INT32.unpack(data[8:])[0])
+    return time(hours, minutes, seconds, micros, tzinfo=tzinfo)
+
+
+def _unbin_interval(data):
+    micros, days, months = struct.unpack('>qii', data)
+    # a month is 30 days, as psycopg2 counts them
+    return timedelta(days=days + months * 30, microseconds=micros)
+
+
+def binary_decoder(udt, encoding='utf_8', timezone=None):
+    """
+    Returns a function that decodes a binary COPY field (without its length
+    prefix) from a column with the given udt_name into the python value a
+    psycopg2 cursor would return for it. Geometries come back as hex EWKB,
+    as their text output is.
+
+    Args:
+        encoding:   python codec of the connection's client_encoding
+        timezone:   tzinfo that timestamptz values are returned in, i.e. the
+                    session TimeZone
+    """
+    def text(data):
+        return data.decode(encoding)
+
+    def timestamptz(data):
+        val = _unbin_timestamp(data, PG_EPOCH_TZ)
+        if timezone:
+            try:
+                val = val.astimezone(timezone)
+            except OverflowError:
+                # infinity
+                pass
+        return val
+
+    decoders = {
+        'int2':         lambda d: _INT16.unpack(d)[0],
+        'int4':         lambda d: _INT32.unpack(d)[0],
+        'int8':         lambda d: _INT64.unpack(d)[0],
+        'oid':          lambda d: struct.unpack('>I', d)[0],
+        'float4':       lambda d: struct.unpack('>f', d)[0],
+        'float8':       lambda d: struct.unpack('>d', d)[0],
+        'numeric':      _unbin_numeric,
+        'text':         text,
+        'varchar':      text,
+        'bpchar':       text,
+        'name':         text,
+        'json':         lambda d: json.loads(text(d)),
+        # jsonb starts with a version byte
+        'jsonb':        lambda d: json.loads(text(d[1:])),
+        'bytea':        bytes,
+        'bool':         lambda d: d == b'\x01',
+        'date':         _unbin_date,
+        'timestamp':    _unbin_timestamp,
+        'timestamptz':  timestamptz,
+        'time':         _unbin_time,
+        'timetz':       _unbin_time,
+        'interval':     _unbin_interval,
+        'uuid':         lambda d: str(uuid.UUID(bytes=d)),
+        'geometry':     lambda d: d.hex().upper(),
+    }
+    try:
+        return decoders[udt]
+    except KeyError:
+        raise TypeError("Unhandled type for binary COPY: '{}'".format(udt))
+
+
+def iter_copy_binary(f, decoders):
+    """Yields rows parsed from COPY binary format read from the file object
+    `f`, decoding each column's values with its decoder in `decoders`."""
+    def read(size):
+        data = f.read(size)
+        if len(data) != size:
+            raise ValueError('COPY binary data ended in the middle of a row')
+        return data
+
+    header = read(len(PGCOPY_HEADER))
+    if header[:11] != PGCOPY_HEADER[:11]:
+        raise ValueError('Not COPY binary data')
+    # skip the header extension
+    read(_INT32.unpack(header[15:])[0])
+    unpack_int16 = _INT16.unpack
+    unpack_int32 = _INT32.unpack
+    while True:
+        if unpack_int16(read(2))[0] == -1:
+            return
+        row = []
+        for decode in decoders:
+            size = unpack_int32(read(4))[0]
+            row.append(None if size == -1 else decode(read(size)))
+        yield tuple(row)
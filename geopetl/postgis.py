@@ -1,17 +1,84 @@
+import codecs
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import locale
+import os
+import queue
 import re
+import threading
+import time
+import uuid
 import petl as etl
 from petl.compat import string_types
 from petl.util.base import Table
 from petl.io.db_utils import _quote
+from petl.io.sources import write_source_from_arg
 from geopetl.util import parse_db_url
 import json
 from dateutil import parser as dt_parser
+from dateutil import tz
+from geopetl.batch import DEFAULT_BATCH_BYTES, ON_ERROR_MODES, Batcher, CommitPolicy, RejectFile, row_size
+from geopetl import delta as row_delta
+from geopetl.encoding import RawValue, row_encoder
+from geopetl.keyset import DEFAULT_PAGE_SIZE, Checkpoint, KeysetView
+from geopetl.cache import ResultCache
+from geopetl.stream import RowStream
+from geopetl import geometry
+from geopetl.pgcopy import COPY_READ_SIZE, CURVE_ERROR, CopyBinaryStream, CopyTextStream, TEXT_ENCODERS, \
+    binary_decoder, binary_encoder, geom_binary_encoder, geom_ewkt_encoder, geom_text_encoder, \
+    iter_copy_binary, iter_copy_text
 # For some errors below
 import psycopg2
+from psycopg2.extras import execute_batch
 
 
 DEFAULT_WRITE_BUFFER_SIZE = 1000
+# SDE object IDs reserved per round trip
+DEFAULT_ROWID_BLOCK_SIZE = 1000
+# EXECUTE statements sent per round trip by the prepared write method
+DEFAULT_PREPARED_PAGE_SIZE = 100
+# rows fetched per round trip by server-side (named) read cursors
+DEFAULT_ITERSIZE = 2000
+
+# ways PostgisTable.write can ship rows to the database:
+#   insert: multi-row INSERT ... VALUES statements built from SQL literals
+#   copy:   COPY ... FROM STDIN in text format, streamed from the row iterator
+#   binary: COPY ... FROM STDIN in binary format, with geometries encoded as
+#           EWKB on the client
+#   prepared: a server-side prepared INSERT, executed in pages with values
+#           bound as parameters
+WRITE_METHODS = ('insert', 'copy', 'binary', 'prepared')
+
+# how PostgisQuery returns geometries:
+#   wkt:    text from ST_AsText
+#   wkb:    bytes from ST_AsBinary
+#   ewkb:   bytes from ST_AsEWKB, carrying the SRID
+GEOM_FORMATS = ('wkt', 'wkb', 'ewkb')
+
+# how PostgisQuery returns other values:
+#   python: parsed by psycopg2, e.g. numeric into Decimal and jsonb into dict
+#   raw:    the server's text for them, as geopetl.encoding.RawValue
+DECODE_MODES = ('python', 'raw')
+
+# OIDs of the types psycopg2 parses that decode='raw' leaves as text:
+# numbers, booleans, dates and times, intervals, and json (114) and jsonb
+# (3802)
+RAW_TYPE_OIDS = (psycopg2.extensions.INTEGER.values + psycopg2.extensions.LONGINTEGER.values +
+                 psycopg2.extensions.FLOAT.values + psycopg2.extensions.DECIMAL.values +
+                 psycopg2.extensions.BOOLEAN.values + psycopg2.extensions.PYDATE.values +
+                 psycopg2.extensions.PYTIME.values + psycopg2.extensions.PYDATETIME.values +
+                 psycopg2.extensions.PYDATETIMETZ.values + psycopg2.extensions.PYINTERVAL.values +
+                 (114, 3802))
+RAW_TYPE = psycopg2.extensions.new_type(RAW_TYPE_OIDS, 'GEOPETL_RAW',
+                                        lambda val, cursor: None if val is None else RawValue(val))
+
+# formats PostgisQuery can read the query in with COPY (...) TO STDOUT:
+#   text:   COPY's text format; values are the server's text for them, or
+#           RawValues with decode='raw'
+#   binary: COPY's binary format, decoded to the python values a cursor
+#           returns
+COPY_FORMATS = ('text', 'binary')
 
 DATA_TYPE_MAP = {
     'smallint':                     'numeric',
@@ -52,7 +119,10 @@ def postgres_extract_table_schema(dbo, table_name, table_schema_output_path):
 etl.postgres_extract_table_schema = postgres_extract_table_schema
 
 def frompostgis(dbo, table_name, fields=None, return_geom=True, geom_with_srid=False,
-                where=None, limit=None, sql=None):
+                where=None, limit=None, sql=None, server_side=False, itersize=DEFAULT_ITERSIZE,
+                geom_format='wkt', lazy_geom=False, partitions=1, ordered=False, keyset=False,
+                page_size=DEFAULT_PAGE_SIZE, checkpoint=None, bbox=None, intersects=None, dwithin=None,
+                filter_srid=None, cache=None, estimate_count=False, decode='python', copy_format=None):
     """
     Returns an iterable query container.
     Params
@@ -66,6 +136,65 @@ def frompostgis(dbo, table_name, fields=None, return_geom=True, geom_with_srid=F
                     Defaults to True.
     - where:        (optional) A where clause for the SQL statement.
     - limit:        (optional) Number of rows to return.
+    - server_side:  (optional) Read through a named (server-side) cursor,
+                    fetching `itersize` rows per round trip, instead of
+                    loading the whole result into memory before the first
+                    row is returned. Use for large tables.
+    - itersize:     (optional) Rows fetched per round trip with server_side.
+    - geom_format:  (optional) One of GEOM_FORMATS. The binary formats skip
+                    generating and parsing WKT, which pays off for dense
+                    geometries, and the writers take them as they are.
+                    Defaults to 'wkt'.
+    - lazy_geom:    (optional) With a binary geom_format, return geometries
+                    as geopetl.geometry.LazyGeometry, which is the bytes
+                    decoded only if asked for its SRID, type or WKT.
+    - partitions:   (optional) Read the table as this many ranges at once, on
+                    a connection and thread each. Ranges split the objectid
+                    field, or ctid blocks if there isn't one, and every range
+                    reads the same snapshot, so the result is what a single
+                    query would have returned. Can't be combined with sql or
+                    limit.
+    - ordered:      (optional) With partitions, return the ranges one after
+                    another in objectid (or ctid) order rather than rows as
+                    they arrive from whichever range is ready.
+    - keyset:       (optional) Read a page of `page_size` rows at a time in
+                    objectid order, each page a short query starting after
+                    the last objectid read, instead of one long query. See
+                    geopetl.keyset. Can't be combined with sql or limit.
+    - page_size:    (optional) Rows per page with keyset.
+    - checkpoint:   (optional) Path of a file to save the last objectid read
+                    to after each page, implying keyset. Rerunning with the
+                    same checkpoint resumes after it; it's removed once the
+                    read finishes.
+    - bbox:         (optional) Only read rows whose geometry's bounding box
+                    overlaps (xmin, ymin, xmax, ymax).
+    - intersects:   (optional) Only read rows whose geometry intersects this
+                    WKT, EWKT or WKB geometry.
+    - dwithin:      (optional) A (geometry, distance) pair; only read rows
+                    within distance of the geometry, in the table's units.
+    - filter_srid:  (optional) SRID of bbox and of filter geometries without
+                    their own. Defaults to the table's. The filters are
+                    transformed to the table's SRID, so the spatial index is
+                    still used.
+    - cache:        (optional) Cache the rows on local disk the first time
+                    they're read to the end, and read them from there while
+                    the table hasn't changed. True for the default
+                    directory, a directory path, or a
+                    geopetl.cache.ResultCache to set the TTL and size.
+    - estimate_count:   (optional) Have nrows() return the planner's
+                    row estimate rather than a COUNT(*); see
+                    PostgisQuery.nrows.
+    - decode:       (optional) One of DECODE_MODES. With 'raw', numbers,
+                    booleans, dates, times and json come back as the
+                    server's text for them (geopetl.encoding.RawValue)
+                    instead of being parsed into python objects, and the
+                    writers pass them on as they are. Use when copying
+                    from one database to another. Defaults to 'python'.
+    - copy_format:  (optional) One of COPY_FORMATS. Read the query with
+                    COPY (...) TO STDOUT instead of a cursor, on a connection
+                    of its own, with the rows parsed in a background thread.
+                    tocsv() on the result writes COPY's CSV output straight
+                    to the file. Can't be combined with partitions or keyset.
     """
 
     # create db wrappers
@@ -74,14 +203,76 @@ def frompostgis(dbo, table_name, fields=None, return_geom=True, geom_with_srid=F
 
     # return a query container
     return table.query(fields=fields, return_geom=return_geom, geom_with_srid=geom_with_srid,
-                       where=where, limit=limit, sql=sql)
+                       where=where, limit=limit, sql=sql, server_side=server_side, itersize=itersize,
+                       geom_format=geom_format, lazy_geom=lazy_geom, partitions=partitions, ordered=ordered,
+                       keyset=keyset, page_size=page_size, checkpoint=checkpoint, bbox=bbox,
+                       intersects=intersects, dwithin=dwithin, filter_srid=filter_srid, cache=cache,
+                       estimate_count=estimate_count, decode=decode, copy_format=copy_format)
 
 etl.frompostgis = frompostgis
 
-def topostgis(rows, dbo, table_name, from_srid=None, column_definition_json=None, buffer_size=DEFAULT_WRITE_BUFFER_SIZE):
+def topostgis(rows, dbo, table_name, from_srid=None, column_definition_json=None, buffer_size=DEFAULT_WRITE_BUFFER_SIZE,
+              method='insert', batch_bytes=DEFAULT_BATCH_BYTES, auto_tune=False, commit='batch', commit_every=1,
+              commit_bytes=None, synchronous_commit=True, swap=False, defer_indexes=False, index_workers=1,
+              maintenance_work_mem=None, delta=False, parallel=1, on_error='raise', reject_file=None):
     """
-    Writes rows to database.
+    Writes rows to database. Returns what PostgisTable.write returns, or the
+    changes with delta=True.
+
+    - buffer_size:  (optional) Maximum number of rows sent per batch.
+    - method:       (optional) How rows are sent to the database, one of
+                    WRITE_METHODS. 'copy' streams rows with COPY FROM STDIN,
+                    which is much faster for large loads, but can't load
+                    curved geometries. Defaults to 'insert'.
+    - batch_bytes:  (optional) A batch is also sent once its values add up to
+                    this many bytes, so large geometries make smaller batches.
+    - auto_tune:    (optional) Tune the batch size from measured throughput,
+                    starting from buffer_size. The size it settles on is
+                    printed at the end so it can be pinned with buffer_size.
+    - commit:       (optional) When to commit, one of geopetl.batch.COMMIT_MODES.
+                    'batch' commits after every `commit_every` batches (or
+                    `commit_bytes` bytes), 'single' loads everything in one
+                    transaction, truncate included, and 'savepoint' does too
+                    but keeps the batches before a failed one.
+    - synchronous_commit:   (optional) Pass False to turn off
+                    synchronous_commit for the session while loading. Commits
+                    return without waiting for WAL to reach disk; a server
+                    crash can lose the last few, but can't corrupt the table.
+    - swap:         (optional) Load an existing table by building a staging
+                    copy and swapping it in, so readers never see it empty.
+                    See PostgisTable.write_swap.
+    - defer_indexes:    (optional) Drop the table's indexes, other than ones
+                    backing constraints like the primary key, before loading
+                    and recreate them afterwards, then ANALYZE. Indexes are
+                    restored if the load fails.
+    - index_workers:    (optional) Number of connections to recreate deferred
+                    indexes on in parallel.
+    - maintenance_work_mem: (optional) maintenance_work_mem for the sessions
+                    recreating deferred indexes, e.g. '1GB'.
+    - delta:        (optional) Instead of reloading an existing table, only
+                    insert, update and delete the rows that differ from it,
+                    matched on the objectid field. See
+                    PostgisTable.write_delta.
+    - parallel:     (optional) Load on this many connections at once, with
+                    batches handed out to a thread per connection. Nothing
+                    is committed until every worker is done, so `commit` is
+                    ignored. The connections are committed together with
+                    two-phase commit if the server's
+                    max_prepared_transactions allows it, and one after
+                    another, which isn't atomic, otherwise. Throughput per
+                    worker is printed at the end.
+    - on_error:     (optional) 'raise' (the default) fails the load on the
+                    first row the database rejects. 'reject' rolls a failed
+                    batch back to a savepoint and bisects it to find the bad
+                    rows, which are written to reject_file with the error,
+                    and keeps loading.
+    - reject_file:  (optional) Path of the CSV for rejected rows. Defaults to
+                    <schema>.<table>_rejects.csv in the working directory.
     """
+    if swap and delta:
+        raise ValueError('swap and delta can\'t be combined')
+    if delta and parallel > 1:
+        raise ValueError('delta can\'t be combined with parallel')
     # create db wrappers
     db = PostgisDatabase(dbo)
     # do we need to create the table?
@@ -98,42 +289,82 @@ def topostgis(rows, dbo, table_name, from_srid=None, column_definition_json=None
         else:
             print('Autocreating PostGIS table')
             db.create_table(column_definition_json, table)
-    if not create:
-        table.truncate()
-
-    table.write(rows, from_srid=from_srid)
+    write_kwargs = dict(from_srid=from_srid, buffer_size=buffer_size, method=method, batch_bytes=batch_bytes,
+                        auto_tune=auto_tune, commit=commit, commit_every=commit_every, commit_bytes=commit_bytes,
+                        synchronous_commit=synchronous_commit, defer_indexes=defer_indexes,
+                        index_workers=index_workers, maintenance_work_mem=maintenance_work_mem, parallel=parallel,
+                        on_error=on_error, reject_file=reject_file)
+    if swap and not create:
+        return table.write_swap(rows, **write_kwargs)
+    if delta and not create:
+        return table.write_delta(rows, **write_kwargs)
+
+    return table.write(rows, replace=not create, **write_kwargs)
 
 etl.topostgis = topostgis
 
-def _topostgis(self, dbo, table_name, from_srid=None, column_definition_json=None, buffer_size=DEFAULT_WRITE_BUFFER_SIZE):
+def _topostgis(self, dbo, table_name, from_srid=None, column_definition_json=None, buffer_size=DEFAULT_WRITE_BUFFER_SIZE,
+               method='insert', batch_bytes=DEFAULT_BATCH_BYTES, auto_tune=False, commit='batch', commit_every=1,
+               commit_bytes=None, synchronous_commit=True, swap=False, defer_indexes=False, index_workers=1,
+               maintenance_work_mem=None, delta=False, parallel=1, on_error='raise', reject_file=None):
     """
     This wraps topostgis and adds a `self` arg so it can be attached to
     the Table class. This enables functional-style chaining.
     """
-    return topostgis(self, dbo, table_name, from_srid=from_srid,column_definition_json=column_definition_json, buffer_size=buffer_size)
+    return topostgis(self, dbo, table_name, from_srid=from_srid,column_definition_json=column_definition_json, buffer_size=buffer_size,
+                     method=method, batch_bytes=batch_bytes, auto_tune=auto_tune, commit=commit,
+                     commit_every=commit_every, commit_bytes=commit_bytes, synchronous_commit=synchronous_commit,
+                     swap=swap, defer_indexes=defer_indexes, index_workers=index_workers,
+                     maintenance_work_mem=maintenance_work_mem, delta=delta, parallel=parallel, on_error=on_error,
+                     reject_file=reject_file)
 
 Table.topostgis = _topostgis
 
 
-def appendpostgis(rows, dbo, table_name, from_srid=None, buffer_size=DEFAULT_WRITE_BUFFER_SIZE):
+def appendpostgis(rows, dbo, table_name, from_srid=None, buffer_size=DEFAULT_WRITE_BUFFER_SIZE, method='insert',
+                  batch_bytes=DEFAULT_BATCH_BYTES, auto_tune=False, commit='batch', commit_every=1,
+                  commit_bytes=None, synchronous_commit=True, defer_indexes=False, index_workers=1,
+                  maintenance_work_mem=None, upsert=False, upsert_keys=None, parallel=1, on_error='raise',
+                  reject_file=None):
     """
-    Writes rows to database.
+    Writes rows to database. See topostgis for the options.
+
+    - upsert:       (optional) Update rows that match an existing row on
+                    upsert_keys instead of inserting them. Each batch is
+                    merged through a temp table. Returns the inserted and
+                    updated counts.
+    - upsert_keys:  (optional) Fields to match rows on. Defaults to the
+                    objectid field. Needs a unique index on these fields,
+                    except for SDE tables.
     """
     # create db wrappers
     db = PostgisDatabase(dbo)
 
     # write
     table = db.table(table_name)
-    table.write(rows, from_srid=from_srid)
+    return table.write(rows, from_srid=from_srid, buffer_size=buffer_size, method=method,
+                       batch_bytes=batch_bytes, auto_tune=auto_tune, commit=commit, commit_every=commit_every,
+                       commit_bytes=commit_bytes, synchronous_commit=synchronous_commit, defer_indexes=defer_indexes,
+                       index_workers=index_workers, maintenance_work_mem=maintenance_work_mem, upsert=upsert,
+                       upsert_keys=upsert_keys, parallel=parallel, on_error=on_error, reject_file=reject_file)
 
 etl.appendpostgis = appendpostgis
 
-def _appendpostgis(self, dbo, table_name, from_srid=None, buffer_size=DEFAULT_WRITE_BUFFER_SIZE):
+def _appendpostgis(self, dbo, table_name, from_srid=None, buffer_size=DEFAULT_WRITE_BUFFER_SIZE, method='insert',
+                   batch_bytes=DEFAULT_BATCH_BYTES, auto_tune=False, commit='batch', commit_every=1,
+                   commit_bytes=None, synchronous_commit=True, defer_indexes=False, index_workers=1,
+                   maintenance_work_mem=None, upsert=False, upsert_keys=None, parallel=1, on_error='raise',
+                   reject_file=None):
     """
     This wraps topostgis and adds a `self` arg so it can be attached to
     the Table class. This enables functional-style chaining.
     """
-    return appendpostgis(self, dbo, table_name, from_srid=from_srid, buffer_size=buffer_size)
+    return appendpostgis(self, dbo, table_name, from_srid=from_srid, buffer_size=buffer_size, method=method,
+                         batch_bytes=batch_bytes, auto_tune=auto_tune, commit=commit, commit_every=commit_every,
+                         commit_bytes=commit_bytes, synchronous_commit=synchronous_commit,
+                         defer_indexes=defer_indexes, index_workers=index_workers,
+                         maintenance_work_mem=maintenance_work_mem, upsert=upsert, upsert_keys=upsert_keys,
+                         parallel=parallel, on_error=on_error, reject_file=reject_file)
 
 Table.appendpostgis = _appendpostgis
 
@@ -196,6 +427,17 @@ class PostgisDatabase(object):
         """Alternate notation for getting a table: db['table']"""
         return self.table(key)
 
+    def connect(self):
+        """Opens another connection to the same database, e.g. for work
+        that runs in parallel with this one."""
+        import psycopg2
+        params = self.dbo.get_dsn_parameters()
+        # the password isn't part of the dsn parameters
+        password = getattr(getattr(self.dbo, 'info', None), 'password', None)
+        if password:
+            params['password'] = password
+        return psycopg2.connect(**params)
+
     def fetch(self, stmt):
         """Run a SQL statement and fetch all rows."""
         try:
@@ -378,6 +620,150 @@ FIELD_TYPE_MAP = {
     'jsonb':                    'text'
 }
 
+def _literal_text(val):
+    if not val:
+        return 'NULL'
+    # accommodate value if contains single quote for proper postgres syntax. ('roland's code -> 'roland''s code')
+    return "'{}'".format(str(val).replace("'", "''"))
+
+def _literal_num(val):
+    return 'NULL' if val is None or val == '' else str(val)
+
+def _literal_date(val):
+    # TODO dates should be converted to real dates, not strings
+    return "'{}'".format(val) if val else 'NULL'
+
+def _literal_geometry(val):
+    return str(val) if val else 'NULL'
+
+def _literal_timestamp(val):
+    val = str(val)
+    if not val or val == 'None':
+        return 'NULL'
+    if 'timestamp' not in val.lower():
+        return '''TIMESTAMP '{}' '''.format(val)
+    return val
+
+def _literal_timestamptz(val):
+    val = str(val)
+    if not val or val == 'None':
+        return 'NULL'
+    if 'timestamptz' not in val.lower():
+        return '''TIMESTAMPTZ '{}' '''.format(val)
+    return val
+
+def _literal_null(val):
+    return val if val else 'NULL'
+
+def _literal_raw(val):
+    # a quoted literal takes the column's type
+    return 'NULL' if val is None else "'{}'".format(str(val).replace("'", "''"))
+
+# maps generic field types to functions that format values as SQL literals
+# for the insert write method
+LITERAL_ENCODERS = {
+    'text':         _literal_text,
+    'num':          _literal_num,
+    'date':         _literal_date,
+    'geometry':     _literal_geometry,
+    'timestamp':    _literal_timestamp,
+    'timestamptz':  _literal_timestamptz,
+    'boolean':      _literal_null,
+    'money':        _literal_null,
+    'uuid':         str,
+    'raw':          _literal_raw,
+}
+
+def _param_null(val):
+    return None if val is None or val == '' else val
+
+def _param_temporal(val):
+    return None if val is None or val == '' or val == 'None' else val
+
+def _param_raw(val):
+    return val
+
+def _param_text(val):
+    if val is None or val == '':
+        return None
+    if isinstance(val, (dict, list)):
+        return json.dumps(val)
+    return str(val)
+
+# Postgres truncates identifiers longer than this
+MAX_IDENTIFIER_LENGTH = 63
+
+def _suffixed_name(name, suffix):
+    """Appends a suffix to an identifier, shortening the name so the result
+    isn't truncated by Postgres."""
+    return name[:MAX_IDENTIFIER_LENGTH - len(suffix)] + suffix
+
+_INDEXDEF_RE = re.compile(r'^CREATE (UNIQUE )?INDEX ("[^"]+"|\S+) ON (ONLY )?((?:"[^"]+"|[^\s."]+)(?:\.(?:"[^"]+"|[^\s."]+))?) ')
+
+def _if_not_exists_indexdef(indexdef):
+    """Rewrites a pg_get_indexdef() statement to skip an existing index."""
+    return _INDEXDEF_RE.sub(lambda m: 'CREATE {}INDEX IF NOT EXISTS {} ON {}{} '.format(
+        m.group(1) or '', m.group(2), m.group(3) or '', m.group(4)), indexdef, count=1)
+
+def _retarget_indexdef(indexdef, index_name, table_name):
+    """Rewrites a pg_get_indexdef() statement to create the index under
+    another name, on another table."""
+    return _INDEXDEF_RE.sub(lambda m: 'CREATE {}INDEX {} ON {} '.format(m.group(1) or '', index_name, table_name),
+                            indexdef, count=1)
+
+# maps generic field types to converters from row values to parameters for
+# the prepared write method. psycopg2 adapts the python values, and the
+# server coerces them to the column types.
+PARAM_CONVERTERS = {
+    'text':                     _param_text,
+    'num':                      _param_null,
+    'date':                     _param_temporal,
+    'timestamp':                _param_temporal,
+    'timestamptz':              _param_temporal,
+    'time without time zone':   _param_temporal,
+    'time with time zone':      _param_temporal,
+    'boolean':                  _param_null,
+    'money':                    _param_null,
+    'uuid':                     _param_text,
+    'raw':                      _param_raw,
+}
+
+class SdeRowidAllocator(object):
+    """
+    Hands out SDE object IDs for a table from blocks reserved in one round
+    trip each, so rows don't need a sde.next_rowid() call apiece. IDs are
+    drawn straight from the registration's rowid sequence, r<registration
+    id>, which is what sde.next_rowid() draws from, falling back to
+    sde.next_rowid() if it can't be found. IDs are assigned on the client,
+    so any write method can send them as plain values.
+    """
+
+    def __init__(self, table, block_size=DEFAULT_ROWID_BLOCK_SIZE):
+        self.table = table
+        self.block_size = block_size
+        self.sequence = table.rowid_sequence
+        self._ids = []
+        self.round_trips = 0
+
+    def take(self, n):
+        """Returns the next `n` object IDs."""
+        if len(self._ids) < n:
+            self._ids.extend(self._reserve(max(self.block_size, n - len(self._ids))))
+        ids, self._ids = self._ids[:n], self._ids[n:]
+        return ids
+
+    def next(self):
+        return self.take(1)[0]
+
+    def _reserve(self, n):
+        if self.sequence:
+            stmt = "SELECT nextval('{}') AS rowid FROM generate_series(1, {})".format(self.sequence, n)
+        else:
+            stmt = "SELECT sde.next_rowid('{}', '{}') AS rowid FROM generate_series(1, {})".format(
+                self.table.schema, self.table.name, n)
+        self.round_trips += 1
+        return [x['rowid'] for x in self.table.db.fetch(stmt)]
+
 class PostgisTable(object):
 
     _geom_field = None
@@ -645,13 +1031,30 @@ class PostgisTable(object):
 
         return f[0]
 
-    def wkt_getter(self, geom_field, to_srid):
+    def wkt_getter(self, geom_field, to_srid, with_srid=False):
         assert geom_field is not None
         geom_getter = geom_field
         if to_srid:
             geom_getter = 'ST_Transform({}, {})'.format(geom_getter, to_srid)
+        if with_srid:
+            # EWKT, with '' for nulls
+            if self.geom_udt == 'st_geometry':
+                # st_geometry has no EWKT output
+                getter = "'SRID={};' || ST_AsText({})".format(to_srid or self.srid, geom_getter)
+            else:
+                getter = 'ST_AsEWKT({})'.format(geom_getter)
+            return "COALESCE({}, '') AS {}".format(getter, geom_field)
         return 'ST_AsText({}) AS {}'.format(geom_getter, geom_field)
 
+    def wkb_getter(self, geom_field, to_srid, ewkb=False):
+        assert geom_field is not None
+        geom_getter = geom_field
+        if to_srid:
+            geom_getter = 'ST_Transform({}, {})'.format(geom_getter, to_srid)
+        # st_geometry has no EWKB output; PostgisQuery adds the SRID itself
+        fn = 'ST_AsEWKB' if ewkb and self.geom_udt != 'st_geometry' else 'ST_AsBinary'
+        return '{}({}) AS {}'.format(fn, geom_getter, geom_field)
+
 
     @property
     def srid(self):
@@ -737,100 +1140,120 @@ class PostgisTable(object):
         else:
             raise Exception('DB is not SDE or Postgis enabled??')
 
+    @property
+    def change_marker(self):
+        """
+        Returns values that change whenever the table's rows do, for telling
+        whether cached rows are current: its insert, update and delete
+        counts from pg_stat_user_tables, and its file node, which TRUNCATE
+        and table rewrites change. Returns None for relations without
+        statistics, such as views. The counts can trail a commit by up to a
+        second or so, as the statistics are collected asynchronously.
+        """
+        stmt = '''
+            SELECT pg_relation_filenode(relid) AS filenode, n_tup_ins, n_tup_upd, n_tup_del
+            FROM pg_stat_user_tables
+            WHERE relid = '{}'::regclass
+        '''.format(self.name_with_schema)
+        rows = self.db.fetch(stmt)
+        if not rows:
+            return None
+        row = rows[0]
+        return (row['filenode'], row['n_tup_ins'], row['n_tup_upd'], row['n_tup_del'])
+
+    @property
+    def column_udts(self):
+        """Returns a map of field name => underlying type name, e.g. int4,
+        varchar, or geometry. Unlike metadata these aren't generalized."""
+        stmt = """
+            SELECT column_name, udt_name FROM information_schema.columns
+            WHERE table_schema = '{}' AND table_name = '{}'
+            """.format(self.schema, self.name)
+        return {x['column_name']: x['udt_name'].lower() for x in self.db.fetch(stmt)}
+
+    @property
+    def geom_udt(self):
+        """Returns the underlying type name of the geometry column, e.g.
+        'geometry' for PostGIS or 'st_geometry' for SDE."""
+        if not self.geom_field:
+            return None
+        return self.column_udts.get(self.geom_field)
+
+    @property
+    def index_definitions(self):
+        """
+        Returns the table's indexes as a list of dicts with the index name,
+        its CREATE INDEX statement, and for indexes backing a primary key,
+        unique or exclusion constraint, the constraint's name, type and
+        definition.
+        """
+        stmt = """
+            SELECT i.relname AS name, pg_get_indexdef(i.oid) AS indexdef,
+                c.conname AS constraint_name, c.contype AS constraint_type,
+                pg_get_constraintdef(c.oid) AS constraintdef
+            FROM pg_index x
+            JOIN pg_class i ON i.oid = x.indexrelid
+            LEFT JOIN pg_constraint c ON c.conindid = x.indexrelid AND c.conrelid = x.indrelid
+            WHERE x.indrelid = '{}.{}'::regclass
+            """.format(self.schema, self.name)
+        return [dict(x) for x in self.db.fetch(stmt)]
+
     @property
     def non_geom_fields(self):
         return [x for x in self.fields if x != self.geom_field]
 
-    def query(self, fields=None, return_geom=None, geom_with_srid=None, where=None, limit=None, sql=None):
+    def query(self, fields=None, return_geom=None, geom_with_srid=None, where=None, limit=None, sql=None,
+              server_side=False, itersize=DEFAULT_ITERSIZE, geom_format='wkt', lazy_geom=False,
+              partitions=1, ordered=False, keyset=False, page_size=DEFAULT_PAGE_SIZE, checkpoint=None,
+              bbox=None, intersects=None, dwithin=None, filter_srid=None, cache=None, estimate_count=False,
+              decode='python', copy_format=None):
         return PostgisQuery(self.db, self, fields=fields, return_geom=return_geom,
-                            geom_with_srid=geom_with_srid, where=where, limit=limit, sql=sql)
+                            geom_with_srid=geom_with_srid, where=where, limit=limit, sql=sql,
+                            server_side=server_side, itersize=itersize, geom_format=geom_format,
+                            lazy_geom=lazy_geom, partitions=partitions, ordered=ordered, keyset=keyset,
+                            page_size=page_size, checkpoint=checkpoint, bbox=bbox, intersects=intersects,
+                            dwithin=dwithin, filter_srid=filter_srid, cache=cache,
+                            estimate_count=estimate_count, decode=decode, copy_format=copy_format)
 
     def prepare_val(self, val, type_):
         """Prepare a value for entry into the DB."""
-        if type_ == 'text':
-            if val:
-                val = str(val)
-                # accommodate value if contains single quote for proper postgres syntax. ('roland's code -> 'roland''s code')
-                val = val.replace("'", "''")
-                # wrap val in single quotes
-                val = "'{}'".format(val)
-            else:
-                val = 'NULL'
-        elif type_ == 'num':
-            if val is None or val =='':
-                val = 'NULL'
-            else:
-                val = str(val)
-        elif type_ == 'date':
-            # TODO dates should be converted to real dates, not strings
-            if val:
-                val = str(val)
-                val = "'{}'".format(val)
-            else:
-                val = 'NULL'
-        elif type_ == 'geometry':
-            if val:
-                val = str(val)
-            else:
-                val='NULL'
-        elif type_ == 'timestamp':
-            val=str(val)
-            if not val or val == 'None':
-                val = 'NULL'
-            elif 'timestamp' not in val.lower():
-                val = '''TIMESTAMP '{}' '''.format(val)
-            else:
-                val = val
-        elif type_ == 'timestamptz':
-            val = str(val)
-            if not val or val == 'None':
-                val = 'NULL'
-            elif 'timestamptz' not in str(val).lower():
-                val = '''TIMESTAMPTZ '{}' '''.format(val)
-        elif type_ == 'boolean':
-            val = val if val else 'NULL'
-        elif type_ == 'money':
-            if not val:
-                val = 'NULL'
-        elif type_ == 'uuid':
-            val=str(val)
-        else:
+        try:
+            encode = LITERAL_ENCODERS[type_]
+        except KeyError:
             raise TypeError("Unhandled type: '{}'".format(type_))
-        return val
+        return encode(val)
 
     def _prepare_geom(self, geom, srid, transform_srid=None, multi_geom=True):
-        """Prepares WKT geometry by projecting and casting as necessary."""
-        # if DB is sde enabled
+        """Prepares a geometry value as a SQL expression, normalized to 2D
+        and cast to MULTI on the client. Curves are linearized on the
+        server, since that can't be done here."""
+        geom = geometry.decode(geom)
+        if geom is None:
+            return 'null'
+        srid = geom.srid or srid
         if self.db.is_sde_enabled is True:
-            geom = "ST_GEOMETRY('{}', {})".format(geom, srid) if geom and geom != 'EMPTY' else "null"
-        # if DB is postgis enabled
+            # st_geometry doesn't take EWKB, and multi types are left as they are
+            val = "ST_GEOMETRY('{}', {})".format(geometry.to_wkt(geom), srid)
         elif self.db.is_postgis_enabled is True:
-            geom = "ST_GeomFromText('{}', {})".format(geom, srid) if geom and geom != 'EMPTY' else "null"
+            if geom.geom_type in geometry.CURVE_TYPES:
+                val = "ST_CurveToLine(ST_GeomFromText('{}', {}))".format(geometry.to_wkt(geom), srid)
+                if multi_geom:
+                    val = 'ST_Multi({})'.format(val)
+            else:
+                val = "'{}'::geometry".format(geometry.to_ewkb(geom, srid, multi=multi_geom).hex())
         else:
             raise Exception('DB is not SDE or Postgis enabled??')
 
-
-        # Handle 3D geometries
-        # TODO: screen these with regex
-        if 'NaN' in geom:
-            geom = geom.replace('NaN', '0')
-            geom = "ST_Force_2D({})".format(geom)
-
-        # Convert curve geometries (these aren't supported by PostGIS)
-        if 'CURVE' in geom or geom.startswith('CIRC'):
-            geom = "ST_CurveToLine({})".format(geom)
         # Reproject if necessary
         if transform_srid and srid != transform_srid:
-             geom = "ST_Transform({}, {})".format(geom, transform_srid)
-        # else:
-        #   geom = "ST_GeomFromText('{}', {})".format(geom, from_srid)
-
-        if multi_geom:
-            if self.db.is_sde_enabled is False:
-                geom = 'ST_Multi({})'.format(geom)
-        return geom
+            val = "ST_Transform({}, {})".format(val, transform_srid)
+        return val
 
-    def write(self, rows, from_srid=None, buffer_size=DEFAULT_WRITE_BUFFER_SIZE):
+    def write(self, rows, from_srid=None, buffer_size=DEFAULT_WRITE_BUFFER_SIZE, method='insert',
+              batch_bytes=DEFAULT_BATCH_BYTES, auto_tune=False, commit='batch', commit_every=1,
+              commit_bytes=None, synchronous_commit=True, defer_indexes=False, index_workers=1,
+              maintenance_work_mem=None, upsert=False, upsert_keys=None, parallel=1, replace=False,
+              on_error='raise', reject_file=None):
         """
         Inserts dictionary row objects in the the database
         Args: list of row dicts, table name, ordered field names
@@ -840,36 +1263,80 @@ class PostgisTable(object):
               the equivalent of running many insert statements)
             - calls to DB functions like ST_GeomFromText end up getting quoted;
               not sure how to disable this.
+
+        With method='copy' or 'binary' rows are streamed with COPY FROM STDIN
+        instead of being built into INSERT statements (see _copy_rows).
+        COPY can't linearize curves, so curved geometries raise ValueError.
+        method='prepared' binds values to a prepared INSERT (see
+        _write_prepared).
+
+        Rows are sent in batches of at most `buffer_size` rows and
+        `batch_bytes` bytes; see geopetl.batch.Batcher. When they're
+        committed is up to `commit`; see geopetl.batch.CommitPolicy.
+
+        With defer_indexes=True, indexes are dropped for the load and
+        recreated afterwards; see drop_indexes and create_indexes.
+
+        With upsert=True, rows whose `upsert_keys` (the objectid field by
+        default) match an existing row update it instead of being inserted;
+        see _write_upsert. Returns the inserted and updated counts.
+
+        With replace=True the table's rows are removed first, as part of the
+        load: truncated, or deleted for a parallel load.
+
+        With parallel > 1 batches are spread across that many new
+        connections; see _write_parallel.
+
+        With on_error='reject', rows the database rejects are written to
+        `reject_file` (<schema>.<table>_rejects.csv by default) with the
+        error, and the rest are loaded; see geopetl.batch.CommitPolicy.
         """
+        if method not in WRITE_METHODS:
+            raise ValueError("Unknown write method '{}', expected one of: {}".format(method, ', '.join(WRITE_METHODS)))
+        if on_error not in ON_ERROR_MODES:
+            raise ValueError("Unknown on_error '{}', expected one of: {}".format(on_error, ', '.join(ON_ERROR_MODES)))
+        if upsert and parallel > 1:
+            raise ValueError('upsert can\'t be combined with parallel')
         if self.database_object_type != 'table':
             raise TypeError('Database object {} is a {}, we cannot write to that!'.format(self.name,self.database_object_type))
-
+        # checked here as well as in _copy_rows, before replace=True removes
+        # any rows
+        if method in ('copy', 'binary') and not upsert and self.geom_field and self.db.is_sde_enabled \
+                and self.geom_udt == 'st_geometry':
+            raise ValueError('COPY cannot load sde.st_geometry columns, use method=\'insert\'')
+
+        # The source is read once, so a query or file isn't extracted again
+        # just to look at the first rows.
+        rows = RowStream.wrap(rows)
+        rejects = None
+        if on_error == 'reject':
+            rejects = RejectFile(reject_file or '{}.{}_rejects.csv'.format(self.schema, self.name), rows.header)
+        commit_policy = CommitPolicy(self.db.dbo, commit, every=commit_every, every_bytes=commit_bytes,
+                                     rejects=rejects)
         # Get fields from the row because some fields from self.fields may be
         # optional, such as autoincrementing integers.
         #fields from local data
-        fields = rows[0]
+        fields = rows.header
         geom_field = self.geom_field
         objectid_field = self.objectid_field
+        srid = None
+        multi_geom = False
 
-        
-        # convert rows to records (hybrid objects that can behave like dicts)
-        #rows = etl.records(rows)
-        # # convert rows to records (hybrid objects that can behave like dicts))
-        # rows2 = etl.records(rowsnotnone)
-
-        #rows = etl.records(rows)
-        # Get geom metadata
+        # Get geom metadata from the first geometry in the lookahead window
         if geom_field:
-            rowsnotnone = rows.select(geom_field, lambda v: v != None and v != '')
-            first_geom_val = rowsnotnone.values(geom_field)[0] or ''
+            first_geom = geometry.decode(rows.first(geom_field)) if geom_field in fields else None
             srid = from_srid or self.srid
-            match = re.match('[A-Z]+', first_geom_val)
-            row_geom_type = match.group() if match else None
+            # a curve further on still fails the COPY, but this catches the
+            # usual case of curved data before replace=True removes any rows
+            if method in ('copy', 'binary') and not upsert and first_geom and \
+                    first_geom.geom_type in geometry.CURVE_TYPES:
+                raise ValueError(CURVE_ERROR.format(first_geom.geom_type))
+            row_geom_type = first_geom.geom_type if first_geom else None
 
         # Do we need to cast the geometry to a MULTI type? (Assuming all rows
         # have the same geom type.)
         if geom_field:
-            if self.geom_type.startswith('MULTI') and \
+            if self.geom_type.startswith('MULTI') and row_geom_type and \
                 not row_geom_type.startswith('MULTI'):
                 multi_geom = True
             else:
@@ -887,71 +1354,602 @@ class PostgisTable(object):
                 type_map[field] = [x['type'] for x in self.metadata if x['name'] == field][0]
             except IndexError:
                 raise ValueError('Field `{}` does not exist'.format(field))
-        type_map_items = type_map.items()
+            # values read with decode='raw' are already the db's text for
+            # them, so they go through the 'raw' encoders
+            if type_map[field] != 'geometry' and field in rows.header and \
+                    isinstance(rows.first(field), RawValue):
+                type_map[field] = 'raw'
+
+        batching = {'max_rows': buffer_size, 'max_bytes': batch_bytes, 'auto_tune': auto_tune,
+                    'commit': commit_policy}
+        index_options = {'workers': index_workers, 'maintenance_work_mem': maintenance_work_mem}
+        deferred_indexes = self.drop_indexes() if defer_indexes else []
+        if deferred_indexes and parallel > 1:
+            # otherwise the workers would wait on the lock DROP INDEX holds
+            self.db.dbo.commit()
+        if not synchronous_commit:
+            # session level, so it covers every commit in the load
+            self.db.cursor.execute('SET synchronous_commit = off')
+        result = None
+        try:
+            if replace and parallel > 1 and not upsert:
+                # deleted along with the workers' load; see _write_parallel
+                pass
+            elif replace:
+                # in a single transaction, readers keep seeing the old rows
+                # until the load commits
+                self.truncate(commit=commit == 'batch')
+
+            if upsert:
+                result = self._write_upsert(rows, type_map, srid, multi_geom, batching, upsert_keys)
+            elif parallel > 1:
+                self._write_parallel(rows, type_map, srid, multi_geom, batching, method, parallel,
+                                     synchronous_commit, replace=replace)
+            elif method in ('copy', 'binary'):
+                self._copy_rows(rows, type_map, srid, multi_geom, batching, binary=method == 'binary')
+            elif method == 'prepared':
+                self._write_prepared(rows, type_map, srid, multi_geom, batching)
+            else:
+                self._write_inserts(rows, type_map, srid, multi_geom, batching)
+        except Exception:
+            commit_policy.abort()
+            if deferred_indexes:
+                try:
+                    self.create_indexes(deferred_indexes, **index_options)
+                except Exception:
+                    print('Geopetl: could not restore dropped indexes:\n{}'.format(';\n'.join(deferred_indexes)))
+            raise
+        finally:
+            if not synchronous_commit:
+                self.db.cursor.execute('RESET synchronous_commit')
+                self.db.dbo.commit()
+            if rejects is not None:
+                rejects.close()
+
+        if defer_indexes:
+            self.create_indexes(deferred_indexes, **index_options)
+            self.db.cursor.execute('ANALYZE {}.{}'.format(self.schema, self.name))
+            self.db.dbo.commit()
+        return result
+
+    def _write_parallel(self, rows, type_map, srid, multi_geom, batching, method, workers,
+                        synchronous_commit=True, replace=False):
+        """
+        Loads rows on `workers` new connections at once. This thread reads
+        the rows and hands them out a batch at a time; each worker writes
+        its batches with `method` on its own connection, so the time spent
+        encoding on the client and waiting on the database overlaps
+        (psycopg2 releases the GIL while it waits). With replace=True the
+        table's rows are deleted on one more connection first (TRUNCATE's
+        lock would keep the workers waiting).
+
+        Nothing is committed until every worker is done; the workers' loads
+        leave their commits to a deferred policy. If a worker fails, every
+        connection is rolled back and the error is raised.
+
+        The connections are committed with two-phase commit when the server
+        allows enough prepared transactions (max_prepared_transactions):
+        each is prepared (PREPARE TRANSACTION), and only once all of them
+        are is any committed, so a failure up to then leaves the table as
+        it was, and after it the load is committed in full (readers may
+        still see the commits land one after another). Otherwise they
+        are committed in turn, and a failure between those commits can leave
+        part of the load committed; a warning is printed.
+        """
+        it = iter(rows)
+        header = next(it)
+        max_prepared = self.db.fetch('SHOW max_prepared_transactions')[0]['max_prepared_transactions']
+        two_phase = int(max_prepared) >= workers + 1
+        if not two_phase:
+            print('Geopetl: max_prepared_transactions is below {}, so the parallel load is committed one '
+                  'connection at a time and isn\'t atomic'.format(workers + 1))
+        # prefix of the global transaction ids, unique to this load
+        gid = 'geopetl_{}_{}'.format(self.name, uuid.uuid4().hex)
+        xids = {}
+        chunks = queue.Queue(maxsize=workers * 2)
+        done = object()
+        failed = threading.Event()
+        # the first is what made the others stop
+        errors = []
+        connections = []
+        # rows written and seconds taken by each worker
+        stats = [[0, 0.0] for _ in range(workers)]
+
+        def put(chunk):
+            # give up once a worker has failed, since the rest may not be
+            # taking chunks anymore
+            while not failed.is_set():
+                try:
+                    chunks.put(chunk, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker_rows(i):
+            yield header
+            while True:
+                try:
+                    chunk = chunks.get(timeout=1)
+                except queue.Empty:
+                    if failed.is_set():
+                        raise RuntimeError('Parallel load stopped after another worker failed')
+                    continue
+                if chunk is done:
+                    return
+                stats[i][0] += len(chunk)
+                for row in chunk:
+                    yield row
+
+        def connect(i):
+            dbo = self.db.connect()
+            if two_phase:
+                # before any statement, which would start a plain transaction
+                xids[dbo] = '{}_{}'.format(gid, i)
+                dbo.tpc_begin(xids[dbo])
+            connections.append(dbo)
+            return dbo
+
+        def work(i):
+            dbo = connect(i)
+            try:
+                table = PostgisDatabase(dbo).table('{}.{}'.format(self.schema, self.name))
+                if not synchronous_commit:
+                    dbo.cursor().execute('SET synchronous_commit = off')
+                policy = CommitPolicy(dbo, 'single', defer_finish=True, rejects=batching['commit'].rejects)
+                worker_batching = dict(batching, auto_tune=False, commit=policy)
+                start = time.time()
+                if method in ('copy', 'binary'):
+                    table._copy_rows(worker_rows(i), type_map, srid, multi_geom, worker_batching,
+                                     binary=method == 'binary')
+                elif method == 'prepared':
+                    table._write_prepared(worker_rows(i), type_map, srid, multi_geom, worker_batching)
+                else:
+                    table._write_inserts(worker_rows(i), type_map, srid, multi_geom, worker_batching)
+                stats[i][1] = time.time() - start
+            except Exception as e:
+                errors.append(e)
+                failed.set()
+
+        chunk = []
+        chunk_rows = batching['max_rows'] or DEFAULT_WRITE_BUFFER_SIZE
+        try:
+            if replace:
+                connect(workers).cursor().execute('DELETE FROM {}.{}'.format(self.schema, self.name))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for i in range(workers):
+                    executor.submit(work, i)
+                try:
+                    for row in it:
+                        chunk.append(row)
+                        if len(chunk) >= chunk_rows:
+                            if not put(chunk):
+                                break
+                            chunk = []
+                    if chunk:
+                        put(chunk)
+                    for _ in range(workers):
+                        if not put(done):
+                            break
+                except Exception:
+                    # e.g. reading the source failed; stop the workers
+                    failed.set()
+                    raise
+            # leaving the with block waited for the workers
+            if errors:
+                raise errors[0]
+
+            # this connection holds nothing of the load, but may have a
+            # transaction open from reading the table's metadata
+            self.db.dbo.commit()
+            if two_phase:
+                for dbo in connections:
+                    dbo.tpc_prepare()
+            else:
+                for dbo in connections:
+                    dbo.commit()
+        except Exception:
+            for dbo in connections:
+                try:
+                    if two_phase:
+                        # also rolls back a prepared transaction
+                        dbo.tpc_rollback()
+                    else:
+                        dbo.rollback()
+                except psycopg2.Error:
+                    pass
+                dbo.close()
+            raise
 
-        fields_joined = ', '.join(fields)
-        stmt = "INSERT INTO {} ({}) VALUES ".format('.'.join([self.schema, self.name]), fields_joined)
-        rows = etl.records(rows)
-        len_rows = len(rows)
-        if buffer_size is None or len_rows < buffer_size:
-            iterations = 1
-        else:
-            iterations = int(len_rows / buffer_size)
-            iterations += (len_rows % buffer_size > 0)  # round up
+        # every connection is prepared, so the load is committed in full; a
+        # commit that fails stays prepared on the server until it's finished
+        uncommitted = []
+        try:
+            if two_phase:
+                for dbo in connections:
+                    try:
+                        dbo.tpc_commit()
+                    except psycopg2.Error:
+                        uncommitted.append(xids[dbo])
+        finally:
+            for dbo in connections:
+                dbo.close()
+        if uncommitted:
+            raise RuntimeError('Parallel load prepared but not committed; finish it with COMMIT PREPARED for: {}'
+                               .format(', '.join(uncommitted)))
+
+        for i, (rows_written, seconds) in enumerate(stats):
+            print('Geopetl: worker {} wrote {} rows in {:.1f}s ({:.0f} rows/s)'.format(
+                i + 1, rows_written, seconds, rows_written / seconds if seconds else 0))
+
+    def _write_inserts(self, rows, type_map, srid, multi_geom, batching):
+        """
+        Inserts rows with multi-row INSERT statements, one per batch, with
+        values formatted into the SQL by LITERAL_ENCODERS. Each column's
+        encoder is picked once, before the first row.
+        """
+        geom_field = self.geom_field
+        objectid_field = self.objectid_field
+        is_sde_enabled = self.db.is_sde_enabled
+
+        it = iter(rows)
+        header = list(next(it))
+
+        def encode_geom(val):
+            return self._prepare_geom(val, srid, multi_geom=multi_geom)
+
+        # pair each column with the index of its value in a row and an
+        # encoder for its type
+        columns = []
+        insert_fields = []
+        for field, type_ in type_map.items():
+            if type_ == 'geometry':
+                column = (header.index(geom_field), encode_geom)
+            # sde rowids are allocated on the client and appended to each row
+            elif field == objectid_field and is_sde_enabled:
+                column = (len(header), str)
+            # let the db fill in fields missing from the local data
+            elif field not in header:
+                continue
+            elif type_ in LITERAL_ENCODERS:
+                column = (header.index(field), LITERAL_ENCODERS[type_])
+            else:
+                raise TypeError("Unhandled type: '{}'".format(type_))
+            columns.append(column)
+            insert_fields.append(field)
+        encode_row = row_encoder(columns)
 
+        stmt = "INSERT INTO {} ({}) VALUES ".format('.'.join([self.schema, self.name]), ', '.join(insert_fields))
         execute = self.db.cursor.execute
-        commit = self.db.dbo.commit
+        rowids = SdeRowidAllocator(self) if objectid_field in insert_fields and is_sde_enabled else None
 
-        # Make list of value lists
-        val_rows = []
-        cur_stmt = stmt
-
-        # for each row
-        for i, row in enumerate(rows):
-            val_row = []
-            #  for each item in a row
-            for field, type_ in type_map_items:
-                if type_ == 'geometry':
-                    geom = row[geom_field]
-                    val = self._prepare_geom(geom, srid, multi_geom=multi_geom)
-                    val_row.append(val)
-
-                # if no object id and sde enabled, use sde index to append
-                elif field == objectid_field and self.db.is_sde_enabled: #and local_objectID_flag:
-                    val = "sde.next_rowid('{}', '{}')".format(self.schema, self.name)
-                    val_row.append(val)
-                else:
-                    val = self.prepare_val(row[field], type_)
-                    val_row.append(val)
-
-            val_rows.append(val_row)
-            # check if it's time to ship a chunk
-            if i % buffer_size == 0:
-                # Execute
-                vals_joined = ['({})'.format(', '.join(vals)) for vals in val_rows]
-                rows_joined = ', '.join(vals_joined)
-                cur_stmt += rows_joined
-                try:
-                    execute(cur_stmt)
-                except psycopg2.ProgrammingError:
-                    print(self.db.cursor.query)
-                    raise
-                commit()
+        def flush(val_rows):
+            cur_stmt = stmt + ', '.join(val_rows)
+            try:
+                execute(cur_stmt)
+            except psycopg2.ProgrammingError:
+                print(self.db.cursor.query)
+                raise
 
-                val_rows = []
-                cur_stmt = stmt
+        batcher = Batcher(flush, **batching)
+        for row in it:
+            if rowids:
+                row = tuple(row) + (rowids.next(),)
+            vals_joined = '({})'.format(', '.join(encode_row(row)))
+            batcher.add(vals_joined, len(vals_joined), row)
 
-        # Execute remaining rows (TODO clean this up)
-        if val_rows:
-            vals_joined = ['({})'.format(', '.join(vals)) for vals in val_rows]
-            rows_joined = ', '.join(vals_joined)
-            cur_stmt += rows_joined
-            execute(cur_stmt)
-            commit()
+        # Execute remaining rows
+        batcher.close()
+
+    def _copy_rows(self, rows, type_map, srid, multi_geom, batching, binary=False):
+        """
+        Streams rows into the table with COPY FROM STDIN, one COPY statement
+        per batch of rows. Values are encoded to COPY text as psycopg2 reads
+        them, so only the current batch of rows is in memory.
 
+        With binary=True rows are sent in COPY's binary format. Encoders are
+        picked by the real column types rather than the generic ones in
+        type_map, since binary values have to match them exactly.
+        """
+        geom_field = self.geom_field
+        objectid_field = self.objectid_field
+        is_sde_enabled = self.db.is_sde_enabled
+        if geom_field and is_sde_enabled and self.geom_udt == 'st_geometry':
+            raise ValueError('COPY cannot load sde.st_geometry columns, use method=\'insert\'')
+
+        if binary:
+            udts = self.column_udts
+            encoding = psycopg2.extensions.encodings[self.db.dbo.encoding]
+            timezone = tz.gettz(self.db.fetch('SHOW TimeZone')[0]['TimeZone'])
+
+            def encoder(field, type_):
+                return binary_encoder(udts[field], encoding=encoding, timezone=timezone)
+            geom_encoder = geom_binary_encoder(srid, multi_geom)
+        else:
+            def encoder(field, type_):
+                if type_ not in TEXT_ENCODERS:
+                    raise TypeError("Unhandled type: '{}'".format(type_))
+                return TEXT_ENCODERS[type_]
+            geom_encoder = geom_text_encoder(srid, multi_geom)
+
+        it = iter(rows)
+        header = list(next(it))
+
+        # pair each COPY column with the index of its value in a row and
+        # an encoder for its type
+        columns = []
+        copy_fields = []
+        for field, type_ in type_map.items():
+            if type_ == 'geometry':
+                column = (header.index(geom_field), geom_encoder)
+            # sde rowids are allocated per batch and appended to each row
+            elif field == objectid_field and is_sde_enabled:
+                column = (len(header), encoder(field, type_))
+            # let the db fill in fields missing from the local data
+            elif field not in header:
+                continue
+            else:
+                column = (header.index(field), encoder(field, type_))
+            columns.append(column)
+            copy_fields.append(field)
+
+        stream_cls = CopyBinaryStream if binary else CopyTextStream
+        stmt = 'COPY {} ({}) FROM STDIN{}'.format('.'.join([self.schema, self.name]),
+                                                  ', '.join([_quote(x) for x in copy_fields]),
+                                                  ' WITH (FORMAT binary)' if binary else '')
+        cursor = self.db.cursor
+        rowids = SdeRowidAllocator(self) if objectid_field in copy_fields and is_sde_enabled else None
+
+        def flush(chunk):
+            if rowids:
+                chunk = [tuple(row) + (rowid,) for row, rowid in zip(chunk, rowids.take(len(chunk)))]
+            cursor.copy_expert(stmt, stream_cls(chunk, columns), size=COPY_READ_SIZE)
+
+        batcher = Batcher(flush, **batching)
+        for row in it:
+            batcher.add(row, row_size(row))
+        batcher.close()
+
+    def _write_upsert(self, rows, type_map, srid, multi_geom, batching, keys=None):
+        """
+        Inserts or updates rows by `keys`, the objectid field by default.
+        Each batch is copied into a temp table and merged into the table
+        with one INSERT ... ON CONFLICT DO UPDATE. SDE tables, and tables
+        without a unique index on the keys, are merged with an UPDATE then an
+        INSERT of the rows that didn't match. New rows in SDE tables get SDE
+        object IDs unless the objectid field is a key. Returns the inserted
+        and updated counts.
+        """
+        geom_field = self.geom_field
+        objectid_field = self.objectid_field
+        is_sde_enabled = self.db.is_sde_enabled
+        keys = keys or ([objectid_field] if objectid_field else None)
+        if not keys:
+            raise ValueError('Upserts need upsert_keys for a table without an objectid field')
+
+        it = iter(rows)
+        header = list(next(it))
+        missing = [x for x in keys if x not in header]
+        if missing:
+            raise ValueError('Upsert keys not in the rows: {}'.format(', '.join(missing)))
+
+        columns = []
+        fields = []
+        for field, type_ in type_map.items():
+            # sde object ids are allocated for new rows
+            if field == objectid_field and is_sde_enabled and field not in keys:
+                continue
+            if field not in header:
+                continue
+            if type_ == 'geometry':
+                # st_geometry values are left as they are, as plain writes do
+                encode = geom_text_encoder(None if is_sde_enabled else srid, multi_geom and not is_sde_enabled,
+                                           curves=True)
+                columns.append((header.index(field), encode))
+            elif type_ in TEXT_ENCODERS:
+                columns.append((header.index(field), TEXT_ENCODERS[type_]))
+            else:
+                raise TypeError("Unhandled type: '{}'".format(type_))
+            fields.append(field)
+
+        # geometries are staged as text and converted while merging
+        name_with_schema = '.'.join([self.schema, self.name])
+        temp_name = 'geopetl_upsert_{}'.format(id(it))
+        cursor = self.db.cursor
+        cursor.execute('CREATE TEMP TABLE {} AS SELECT {} FROM {} WITH NO DATA'.format(
+            temp_name,
+            ', '.join(['NULL::text AS {}'.format(_quote(x)) if x == geom_field else _quote(x) for x in fields]),
+            name_with_schema))
+
+        def value(field):
+            if field != geom_field:
+                return 's.{}'.format(_quote(field))
+            if is_sde_enabled:
+                return 'sde.st_geometry(s.{}, {})'.format(_quote(field), srid)
+            # curves are staged as they are and linearized here
+            if multi_geom:
+                return 'ST_Multi(ST_CurveToLine(s.{}::geometry))'.format(_quote(field))
+            return 'ST_CurveToLine(s.{}::geometry)'.format(_quote(field))
+
+        # a key repeated in a batch keeps its last row
+        quoted_keys = ', '.join([_quote(x) for x in keys])
+        source = '(SELECT DISTINCT ON ({0}) * FROM {1} ORDER BY {0}, ctid DESC) s'.format(quoted_keys, temp_name)
+        copy_stmt = 'COPY {} ({}) FROM STDIN'.format(temp_name, ', '.join([_quote(x) for x in fields]))
+        insert_fields = [_quote(x) for x in fields]
+        insert_values = [value(x) for x in fields]
+        updates = [x for x in fields if x not in keys]
+        if is_sde_enabled or not self.has_unique_index(keys):
+            if is_sde_enabled and objectid_field and objectid_field not in fields:
+                insert_fields.append(_quote(objectid_field))
+                insert_values.append("sde.next_rowid('{}', '{}')".format(self.schema, self.name))
+            key_match = ' AND '.join(['t.{0} = s.{0}'.format(_quote(x)) for x in keys])
+            update_stmt = None
+            if updates:
+                update_stmt = 'UPDATE {} t SET {} FROM {} WHERE {}'.format(
+                    name_with_schema, ', '.join(['{} = {}'.format(_quote(x), value(x)) for x in updates]),
+                    source, key_match)
+            insert_stmt = 'INSERT INTO {} ({}) SELECT {} FROM {} WHERE NOT EXISTS (SELECT 1 FROM {} t WHERE {})'.format(
+                name_with_schema, ', '.join(insert_fields), ', '.join(insert_values), source,
+                name_with_schema, key_match)
+        else:
+            if updates:
+                on_conflict = 'DO UPDATE SET {}'.format(
+                    ', '.join(['{0} = EXCLUDED.{0}'.format(_quote(x)) for x in updates]))
+            else:
+                on_conflict = 'DO NOTHING'
+            insert_stmt = None
+            # xmax is 0 for rows that were inserted rather than updated
+            merge_stmt = """
+                WITH upserted AS (
+                    INSERT INTO {} ({}) SELECT {} FROM {}
+                    ON CONFLICT ({}) {}
+                    RETURNING (xmax = 0) AS inserted
+                )
+                SELECT count(*) FILTER (WHERE inserted) AS inserted,
+                    count(*) FILTER (WHERE NOT inserted) AS updated
+                FROM upserted""".format(name_with_schema, ', '.join(insert_fields), ', '.join(insert_values),
+                                        source, quoted_keys, on_conflict)
+
+        counts = {'inserted': 0, 'updated': 0}
+
+        def flush(chunk):
+            cursor.copy_expert(copy_stmt, CopyTextStream(chunk, columns), size=COPY_READ_SIZE)
+            if insert_stmt:
+                updated = 0
+                if update_stmt:
+                    cursor.execute(update_stmt)
+                    updated = cursor.rowcount
+                cursor.execute(insert_stmt)
+                inserted = cursor.rowcount
+            else:
+                cursor.execute(merge_stmt)
+                result = cursor.fetchone()
+                inserted, updated = result['inserted'], result['updated']
+            cursor.execute('TRUNCATE {}'.format(temp_name))
+            counts['inserted'] += inserted
+            counts['updated'] += updated
+
+        batcher = Batcher(flush, **batching)
+        try:
+            for row in it:
+                batcher.add(row, row_size(row))
+            batcher.close()
+        except Exception:
+            # before dropping the temp table commits
+            batching['commit'].abort()
+            raise
+        finally:
+            cursor.execute('DROP TABLE IF EXISTS {}'.format(temp_name))
+            self.db.dbo.commit()
+        print('Geopetl: upserted into {}: {} inserted, {} updated'.format(
+            name_with_schema, counts['inserted'], counts['updated']))
+        return counts
+
+    def _write_prepared(self, rows, type_map, srid, multi_geom, batching):
+        """
+        Inserts rows through one server-side prepared statement. Values are
+        bound as parameters rather than formatted into SQL by prepare_val,
+        and the geometry conversion lives once in the statement, so the
+        server only parses and plans the INSERT a single time.
+        """
+        geom_field = self.geom_field
+        objectid_field = self.objectid_field
+        is_sde_enabled = self.db.is_sde_enabled
+
+        it = iter(rows)
+        header = list(next(it))
+
+        # pair each bound field with the index of its value in a row and a
+        # converter to a python value
+        columns = []
+        stmt_fields = []
+        placeholders = []
+        for field, type_ in type_map.items():
+            if type_ == 'geometry':
+                param = '${}'.format(len(columns) + 1)
+                if is_sde_enabled:
+                    # ST_GEOMETRY takes plain WKT and the srid separately
+                    placeholder = 'ST_GEOMETRY({}::text, {})'.format(param, srid)
+                    convert = geometry.to_wkt
+                else:
+                    # curves are linearized here, once for every row; other
+                    # geometries pass through ST_CurveToLine unchanged
+                    placeholder = 'ST_CurveToLine({}::geometry)'.format(param)
+                    if multi_geom:
+                        placeholder = 'ST_Multi({})'.format(placeholder)
+                    convert = geom_ewkt_encoder(srid, multi_geom, curves=True)
+                columns.append((header.index(geom_field), convert))
+            # sde rowids are allocated on the client and appended to each row
+            elif field == objectid_field and is_sde_enabled:
+                placeholder = '${}'.format(len(columns) + 1)
+                columns.append((len(header), _param_null))
+            # let the db fill in fields missing from the local data
+            elif field not in header:
+                continue
+            elif type_ in PARAM_CONVERTERS:
+                placeholder = '${}'.format(len(columns) + 1)
+                columns.append((header.index(field), PARAM_CONVERTERS[type_]))
+            else:
+                raise TypeError("Unhandled type: '{}'".format(type_))
+            stmt_fields.append(_quote(field))
+            placeholders.append(placeholder)
+
+        # prepared statements live for the session, so give this one a name
+        # that won't clash with other writes on the same connection
+        stmt_name = 'geopetl_insert_{}'.format(id(it))
+        cursor = self.db.cursor
+        cursor.execute('PREPARE {} AS INSERT INTO {} ({}) VALUES ({})'.format(
+            stmt_name, '.'.join([self.schema, self.name]), ', '.join(stmt_fields), ', '.join(placeholders)))
+        execute_stmt = 'EXECUTE {}'.format(stmt_name)
+        if columns:
+            execute_stmt += ' ({})'.format(', '.join(['%s'] * len(columns)))
+        def flush(params):
+            execute_batch(cursor, execute_stmt, params, page_size=DEFAULT_PREPARED_PAGE_SIZE)
+
+        rowids = SdeRowidAllocator(self) if objectid_field in type_map and is_sde_enabled else None
+        encode_row = row_encoder(columns)
+        batcher = Batcher(flush, **batching)
+        try:
+            for row in it:
+                if rowids:
+                    row = tuple(row) + (rowids.next(),)
+                params = encode_row(row)
+                batcher.add(params, row_size(params), row)
+            batcher.flush(final=True)
+            # DEALLOCATE isn't transactional; it's left for the commit policy
+            # to end along with the load
+            cursor.execute('DEALLOCATE {}'.format(stmt_name))
+            batcher.close()
+        except Exception:
+            batching['commit'].abort()
+            # the statement goes with the session anyway, so failing to
+            # deallocate it mustn't hide the error that ended the load
+            try:
+                cursor.execute('DEALLOCATE {}'.format(stmt_name))
+                self.db.dbo.rollback()
+            except Exception:
+                pass
+            raise
 
-    def truncate(self, cascade=False):
-        """Drop all rows."""
+    @property
+    def rowid_sequence(self):
+        """Returns the name of the sequence SDE draws this table's object
+        IDs from, or None if it isn't registered or the sequence is missing."""
+        if not self.is_sde_registered:
+            return None
+        stmt = """
+            SELECT registration_id FROM sde.sde_table_registry
+            WHERE table_name = '{}' AND schema = '{}'
+            """.format(self.name, self.schema)
+        registration_id = self.db.fetch(stmt)[0]['registration_id']
+        sequence = '{}.r{}'.format(self.schema, registration_id)
+        stmt = "SELECT to_regclass('{}') IS NOT NULL AS exists".format(sequence)
+        return sequence if self.db.fetch(stmt)[0]['exists'] else None
+
+
+    def truncate(self, cascade=False, commit=True):
+        """Drop all rows. Pass commit=False to leave the truncate in the
+        current transaction, e.g. to load into the table before committing."""
         name = self.name
         schema = self.schema
         # RESTART IDENTITY resets sequence generators.
@@ -960,15 +1958,256 @@ class PostgisTable(object):
             stmt += ' CASCADE'
 
         self.db.cursor.execute(stmt)
+        if commit:
+            self.db.dbo.commit()
+
+    def has_unique_index(self, fields):
+        """Whether a unique index, which ON CONFLICT can use, covers exactly
+        these fields."""
+        stmt = """
+            SELECT 1 FROM pg_index x
+            WHERE x.indrelid = '{}.{}'::regclass AND x.indisunique AND x.indpred IS NULL
+            AND (SELECT array_agg(a.attname::text ORDER BY a.attname) FROM pg_attribute a
+                 WHERE a.attrelid = x.indrelid AND a.attnum = ANY(x.indkey)) = %s
+            """.format(self.schema, self.name)
+        self.db.cursor.execute(stmt, (sorted(fields),))
+        return bool(self.db.cursor.fetchall())
+
+    def write_delta(self, rows, **write_kwargs):
+        """
+        Writes only the rows that differ from what's in the table, matched on
+        the objectid field: new rows are inserted, changed rows updated, and
+        rows missing from `rows` deleted. Rows are compared by a hash of
+        their values (see geopetl.delta), so unchanged rows cost a read but
+        no writes. The table is read through a server-side cursor and the
+        changed rows stream into the write, so neither is held in memory.
+        Keyword args are passed to write(). Returns the changes.
+        """
+        objectid_field = self.objectid_field
+        rows = RowStream.wrap(rows)
+        header = list(rows.header)
+        if not objectid_field or objectid_field not in header:
+            raise ValueError('Delta writes need the objectid field in the rows')
+        types = {x['name']: x['type'] for x in self.metadata}
+        kinds = OrderedDict([(x, row_delta.column_kind(types[x])) for x in header
+                             if x in types and x != objectid_field])
+        multi_geom = bool(self.geom_field) and (self.geom_type or '').upper().startswith('MULTI')
+        # WKB is hashed as it comes, without parsing WKT
+        target = self.query(fields=[objectid_field] + list(kinds),
+                            return_geom=bool(self.geom_field) and self.geom_field in kinds,
+                            server_side=True, geom_format='wkb')
+        diff = row_delta.Diff(rows, target, objectid_field, dict(kinds), multi_geom=multi_geom)
+        changed = RowStream(diff)
+        if not changed.empty:
+            write_kwargs.update(upsert=True, upsert_keys=[objectid_field])
+            self.write(changed, **write_kwargs)
+        # the rows to delete are known once the source has been read
+        changes = diff.changes
+        if changes['delete']:
+            self.db.cursor.execute('DELETE FROM {}.{} WHERE {} = ANY(%s::numeric[])'.format(
+                self.schema, self.name, _quote(objectid_field)), (changes['delete'],))
         self.db.dbo.commit()
+        print('Geopetl: delta for {}.{}: {} inserted, {} updated, {} deleted, {} unchanged'.format(
+            self.schema, self.name, len(changes['insert']), len(changes['update']), len(changes['delete']),
+            changes['unchanged']))
+        return changes
+
+    def drop_indexes(self):
+        """
+        Drops the table's indexes, other than ones backing constraints like
+        the primary key, and returns their CREATE INDEX statements. The drop
+        isn't committed, so it's part of whatever transaction loads the
+        table next.
+        """
+        indexes = [x for x in self.index_definitions if not x['constraint_name']]
+        for index in indexes:
+            self.db.cursor.execute('DROP INDEX {}.{}'.format(self.schema, _quote(index['name'])))
+        if indexes:
+            print('Geopetl: dropped {} indexes on {}.{} for the load'.format(len(indexes), self.schema, self.name))
+        return [x['indexdef'] for x in indexes]
+
+    def create_indexes(self, indexdefs, workers=1, maintenance_work_mem=None):
+        """
+        Runs CREATE INDEX statements, e.g. from drop_indexes, skipping
+        indexes that already exist. With workers > 1 they're split across
+        that many new connections and built in parallel.
+        """
+        indexdefs = [_if_not_exists_indexdef(x) for x in indexdefs]
+        if not indexdefs:
+            return
+        parallel = workers > 1 and len(indexdefs) > 1
+
+        def build(stmts):
+            dbo = self.db.connect() if parallel else self.db.dbo
+            try:
+                cursor = dbo.cursor()
+                if maintenance_work_mem:
+                    cursor.execute('SET maintenance_work_mem = %s', (maintenance_work_mem,))
+                for stmt in stmts:
+                    print('Geopetl: {}'.format(stmt))
+                    cursor.execute(stmt)
+                    dbo.commit()
+                if maintenance_work_mem and not parallel:
+                    cursor.execute('RESET maintenance_work_mem')
+                    dbo.commit()
+            finally:
+                if parallel:
+                    dbo.close()
+
+        if not parallel:
+            build(indexdefs)
+            return
+        chunks = [indexdefs[i::workers] for i in range(min(workers, len(indexdefs)))]
+        with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            # list() raises the first worker error, if any
+            list(executor.map(build, chunks))
+
+    def write_swap(self, rows, **write_kwargs):
+        """
+        Replaces the table's rows without readers ever seeing it empty or
+        half-loaded. Rows are loaded into an UNLOGGED staging copy of the
+        table with no indexes, which is much faster than loading the live
+        table. The staging table is then made LOGGED, gets the table's
+        indexes, constraints and grants, is analyzed, and is renamed into
+        place in one short transaction.
+
+        Views and foreign keys that reference the table would block dropping
+        it, so tables with those are refused up front. Keyword args are
+        passed to write(), and what it returns is returned.
+        """
+        if self.db.is_sde_enabled:
+            raise ValueError('Swap loads are not supported for SDE databases.')
+        name_with_schema = '.'.join([self.schema, self.name])
+        regclass = "'{}'::regclass".format(name_with_schema)
+
+        dependents = self.db.fetch("""
+            SELECT DISTINCT v.relname AS name FROM pg_depend d
+            JOIN pg_rewrite r ON r.oid = d.objid
+            JOIN pg_class v ON v.oid = r.ev_class
+            WHERE d.refobjid = {0} AND v.oid <> {0}
+            UNION
+            SELECT conrelid::regclass::text FROM pg_constraint
+            WHERE confrelid = {0} AND contype = 'f'
+            """.format(regclass))
+        if dependents:
+            raise ValueError('Cannot swap {}, it is referenced by: {}'.format(
+                name_with_schema, ', '.join([x['name'] for x in dependents])))
+
+        indexes = self.index_definitions
+        foreign_keys = self.db.fetch("""
+            SELECT conname AS name, pg_get_constraintdef(oid) AS constraintdef FROM pg_constraint
+            WHERE conrelid = {} AND contype = 'f'
+            """.format(regclass))
+        grants = self.db.fetch("""
+            SELECT CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(pg_get_userbyid(a.grantee)) END AS grantee,
+                a.privilege_type
+            FROM pg_class c, aclexplode(c.relacl) a
+            WHERE c.oid = {} AND a.grantee <> c.relowner
+            """.format(regclass))
+        owner = self.db.fetch("SELECT pg_get_userbyid(relowner) AS owner FROM pg_class WHERE oid = {}".format(
+            regclass))[0]['owner']
+        # serial columns' sequences belong to the old table and would be
+        # dropped with it
+        owned_sequences = self.db.fetch("""
+            SELECT attname AS field, pg_get_serial_sequence('{}', attname) AS sequence
+            FROM pg_attribute WHERE attrelid = {} AND attnum > 0 AND NOT attisdropped AND attidentity = ''
+            """.format(name_with_schema, regclass))
+        owned_sequences = [x for x in owned_sequences if x['sequence']]
+
+        stage_name = _suffixed_name(self.name, '_geopetl_stage')
+        old_name = _suffixed_name(self.name, '_geopetl_old')
+        stage_with_schema = '.'.join([self.schema, stage_name])
+        execute = self.db.cursor.execute
+        commit = self.db.dbo.commit
+
+        execute('DROP TABLE IF EXISTS {}'.format(stage_with_schema))
+        execute('CREATE UNLOGGED TABLE {} (LIKE {} INCLUDING ALL EXCLUDING INDEXES)'.format(
+            stage_with_schema, name_with_schema))
+        commit()
+
+        # index names are unique per schema, so build them under temporary
+        # names and rename them once the old table is gone
+        renames = []
+        try:
+            stage = self.db.table(stage_with_schema)
+            result = stage.write(rows, **write_kwargs)
+
+            print('Geopetl: building indexes on {}'.format(stage_with_schema))
+            execute('ALTER TABLE {} SET LOGGED'.format(stage_with_schema))
+            if owner != self.db.user:
+                execute('ALTER TABLE {} OWNER TO {}'.format(stage_with_schema, owner))
+            for index in indexes:
+                temp_name = _suffixed_name(index['name'], '_geopetl')
+                if index['constraint_name']:
+                    execute('ALTER TABLE {} ADD CONSTRAINT {} {}'.format(
+                        stage_with_schema, temp_name, index['constraintdef']))
+                    renames.append('ALTER TABLE {} RENAME CONSTRAINT {} TO {}'.format(
+                        name_with_schema, temp_name, index['constraint_name']))
+                else:
+                    execute(_retarget_indexdef(index['indexdef'], temp_name, stage_with_schema))
+                    renames.append('ALTER INDEX {}.{} RENAME TO {}'.format(self.schema, temp_name, index['name']))
+            for fk in foreign_keys:
+                execute('ALTER TABLE {} ADD CONSTRAINT {} {}'.format(stage_with_schema, fk['name'], fk['constraintdef']))
+            for grant in grants:
+                execute('GRANT {} ON {} TO {}'.format(grant['privilege_type'], stage_with_schema, grant['grantee']))
+            commit()
+            execute('ANALYZE {}'.format(stage_with_schema))
+            commit()
+        except Exception:
+            self.db.dbo.rollback()
+            execute('DROP TABLE IF EXISTS {}'.format(stage_with_schema))
+            commit()
+            raise
+
+        # swap
+        try:
+            execute('LOCK TABLE {} IN ACCESS EXCLUSIVE MODE'.format(name_with_schema))
+            execute('ALTER TABLE {} RENAME TO {}'.format(name_with_schema, old_name))
+            execute('ALTER TABLE {} RENAME TO {}'.format(stage_with_schema, self.name))
+            for seq in owned_sequences:
+                execute('ALTER SEQUENCE {} OWNED BY {}.{}'.format(seq['sequence'], name_with_schema, seq['field']))
+            execute('DROP TABLE {}.{}'.format(self.schema, old_name))
+            for stmt in renames:
+                execute(stmt)
+            commit()
+        except Exception:
+            self.db.dbo.rollback()
+            execute('DROP TABLE IF EXISTS {}'.format(stage_with_schema))
+            commit()
+            raise
+        print('Geopetl: swapped new rows into {}'.format(name_with_schema))
+        return result
 
 ################################################################################
 # QUERY
 ################################################################################
 
+# names for server-side read cursors, unique within the process
+_read_cursor_ids = itertools.count()
+
+
 class PostgisQuery(Table):
     def __init__(self, db, table, fields=None, return_geom=True, geom_with_srid=False,
-                 to_srid=None, where=None, limit=None, sql=None):
+                 to_srid=None, where=None, limit=None, sql=None, server_side=False,
+                 itersize=DEFAULT_ITERSIZE, geom_format='wkt', lazy_geom=False, partitions=1,
+                 ordered=False, keyset=False, page_size=DEFAULT_PAGE_SIZE, checkpoint=None, bbox=None,
+                 intersects=None, dwithin=None, filter_srid=None, cache=None, estimate_count=False,
+                 decode='python', copy_format=None):
+        if geom_format not in GEOM_FORMATS:
+            raise ValueError("Unknown geom_format '{}', expected one of: {}".format(geom_format, ', '.join(GEOM_FORMATS)))
+        if decode not in DECODE_MODES:
+            raise ValueError("Unknown decode '{}', expected one of: {}".format(decode, ', '.join(DECODE_MODES)))
+        if copy_format is not None and copy_format not in COPY_FORMATS:
+            raise ValueError("Unknown copy_format '{}', expected one of: {}".format(copy_format, ', '.join(COPY_FORMATS)))
+        if copy_format == 'binary' and decode == 'raw':
+            raise ValueError('decode=\'raw\' can\'t be combined with copy_format=\'binary\'')
+        if partitions > 1 and (sql or limit):
+            raise ValueError('partitions can\'t be combined with sql or limit')
+        keyset = keyset or checkpoint is not None
+        if keyset and (sql or limit or partitions > 1):
+            raise ValueError('keyset can\'t be combined with sql, limit or partitions')
+        if copy_format and (partitions > 1 or keyset):
+            raise ValueError('copy_format can\'t be combined with partitions or keyset')
         self.db = db
         self.table = table
         self.fields = fields
@@ -978,26 +2217,558 @@ class PostgisQuery(Table):
         self.where = where
         self.limit = limit
         self.sql = sql
+        self.server_side = server_side
+        self.itersize = itersize
+        self.geom_format = geom_format
+        self.lazy_geom = lazy_geom
+        self.partitions = partitions
+        self.ordered = ordered
+        self.keyset = keyset
+        self.page_size = page_size
+        self.checkpoint = checkpoint
+        self.bbox = bbox
+        self.intersects = intersects
+        self.dwithin = dwithin
+        self.filter_srid = filter_srid
+        self.cache = ResultCache.wrap(cache)
+        self.estimate_count = estimate_count
+        self.decode = decode
+        self.copy_format = copy_format
+
+    def _read_cursor(self, dbo, name=None, withhold=False):
+        """Returns a cursor to read the query with. With decode='raw' its
+        typecasters leave values as text; they're registered on the cursor
+        rather than the connection, which other queries share."""
+        cursor = dbo.cursor(name=name, withhold=withhold)
+        if self.decode == 'raw':
+            psycopg2.extensions.register_type(RAW_TYPE, cursor)
+        return cursor
+
+    def mkcursor(self):
+        """Returns a named cursor, so the result stays on the server and is
+        fetched `itersize` rows at a time as it's iterated."""
+        dbo = self.db.dbo
+        # a named cursor only lives as long as its transaction unless it's
+        # declared WITH HOLD, which autocommit connections need
+        cursor = self._read_cursor(dbo, name='geopetl_read_{}'.format(next(_read_cursor_ids)),
+                                   withhold=dbo.autocommit)
+        cursor.itersize = self.itersize
+        return cursor
 
     def __iter__(self):
         """Proxy iteration to core petl."""
+        if self.cache is not None:
+            marker = self.table.change_marker
+            if marker is not None:
+                params = self.db.dbo.get_dsn_parameters()
+                key = self.cache.key(params.get('host'), params.get('port'), params.get('dbname'),
+                                     params.get('user'), self.sql or self.stmt(), marker,
+                                     self.geom_with_srid, self.lazy_geom, self.decode, self.copy_format)
+                return self.cache.rows(key, self._iter_rows)
+            print('Geopetl: {} has no change marker, so its rows aren\'t cached'.format(self.table.name_with_schema))
+        return self._iter_rows()
+
+    def _subquery(self):
+        return (self.sql or self.stmt()).rstrip().rstrip(';')
+
+    def header(self):
+        """Returns the header from running the query with LIMIT 0, rather
+        than reading its first row. The transaction the query opens is
+        rolled back, unless one was already open on the connection."""
+        dbo = self.db.dbo
+        idle = dbo.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        cursor = dbo.cursor()
+        try:
+            cursor.execute('SELECT * FROM ({}) AS q LIMIT 0'.format(self._subquery()))
+            return tuple([d[0] for d in cursor.description])
+        finally:
+            cursor.close()
+            # don't leave a transaction idle on the shared connection
+            if idle and not dbo.autocommit:
+                dbo.rollback()
+
+    def nrows(self, estimate=None):
+        """
+        Returns the number of rows the query returns, counted with COUNT(*)
+        in the database rather than by reading them. With estimate (which
+        defaults to estimate_count), returns the planner's estimate instead:
+        reltuples for a whole table, or EXPLAIN's for a filtered query or a
+        view. Estimates take no time but are only as current as the table's
+        last ANALYZE; the rows are counted if there isn't one.
+        """
+        if estimate is None:
+            estimate = self.estimate_count
+        if estimate:
+            n = self._estimate_count()
+            if n is not None:
+                return n
+        return self.db.fetch('SELECT count(*) AS n FROM ({}) AS q'.format(self._subquery()))[0]['n']
+
+    def _estimate_count(self):
+        if not (self.sql or self.where or self.spatial_filters()):
+            row = self.db.fetch("SELECT reltuples::bigint AS n, relkind FROM pg_class WHERE oid = '{}'::regclass"
+                                .format(self.table.name_with_schema))[0]
+            # -1 until a table has been analyzed
+            if row['relkind'] in ('r', 'm', 'p'):
+                if row['n'] < 0:
+                    return None
+                return min(row['n'], self.limit) if self.limit else row['n']
+        plan = self.db.fetch('EXPLAIN (FORMAT JSON) {}'.format(self._subquery()))[0]['QUERY PLAN']
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def _iter_rows(self):
         # form sql statement
         stmt = self.stmt() if not self.sql else self.sql
         # if self.sql:
         #     stmt = self.sql
 
-        # get petl iterator
-        dbo = self.db.dbo
-        db_view = etl.fromdb(dbo, stmt)
-        header = [h.lower() for h in db_view.header()]
-        if not self.sql and self.geom_with_srid and self.table.geom_field and self.table.geom_field in header and self.table.srid:
-            db_view = db_view.convert(self.table.geom_field, lambda g: 'SRID={srid};{g}'.format(srid=self.table.srid, g=g) if g not in ('', None) else '')
-        iter_fn = db_view.__iter__()
+        if self.partitions > 1:
+            rows = self._iter_partitions()
+        elif self.keyset:
+            rows = self._iter_keyset()
+        elif self.copy_format:
+            rows = self._iter_copy(stmt)
+        else:
+            # get petl iterator; petl calls mkcursor for a fresh cursor each
+            # time it's iterated
+            if self.server_side:
+                dbo = self.mkcursor
+            elif self.decode == 'raw':
+                dbo = lambda: self._read_cursor(self.db.dbo)
+            else:
+                dbo = self.db.dbo
+            # read the header off the rows rather than with db_view.header(),
+            # which would run the query an extra time
+            rows = iter(etl.fromdb(dbo, stmt))
+        header = next(rows)
+        yield header
+        header = [h.lower() for h in header]
+        geom_field = self.table.geom_field
+        convert = None
+        if not self.sql and geom_field and geom_field in header:
+            # WKT comes as it should from the statement, EWKT included
+            if self.geom_format != 'wkt' and self.return_geom:
+                convert = self._binary_geom_converter()
+        if convert is None:
+            for row in rows:
+                yield row
+        else:
+            i = header.index(geom_field)
+            for row in rows:
+                row = list(row)
+                row[i] = convert(row[i])
+                yield tuple(row)
+
+    def _partition_conditions(self, cursor):
+        """
+        Returns a WHERE condition for each partition and the field they're
+        split on. Partitions are equal ranges of the objectid field between
+        its lowest and highest value, or equal ranges of the table's blocks
+        by ctid if there's no objectid field. Run in the exported snapshot
+        so the bounds match what the partitions read.
+        """
+        n = self.partitions
+        key = self.table.objectid_field
+        if key:
+            stmt = 'SELECT min({0}), max({0}) FROM {1}'.format(_quote(key), self.table.name_with_schema)
+            if self.where:
+                stmt += ' WHERE {}'.format(self.where)
+            cursor.execute(stmt)
+            lo, hi = cursor.fetchone()
+            if lo is None:
+                return [None], key
+            lo, hi = int(lo), int(hi)
+            step = (hi - lo) // n + 1
+            bounds = sorted(set([min(lo + step * i, hi + 1) for i in range(n + 1)]))
+            return ['{0} >= {1} AND {0} < {2}'.format(_quote(key), a, b) for a, b in zip(bounds, bounds[1:])], key
+        # TID range scans (Postgres 14+) only read each range's blocks;
+        # older versions scan the table per partition but read it the same
+        cursor.execute("SELECT pg_relation_size('{}'::regclass) / current_setting('block_size')::int"
+                       .format(self.table.name_with_schema))
+        blocks = cursor.fetchone()[0]
+        step = blocks // n + 1
+        bounds = sorted(set([min(step * i, blocks) for i in range(n)]))
+        conditions = ["ctid >= '({},0)'::tid AND ctid < '({},0)'::tid".format(a, b) for a, b in zip(bounds, bounds[1:])]
+        # the last range is left open
+        conditions.append("ctid >= '({},0)'::tid".format(bounds[-1]))
+        return conditions, 'ctid'
+
+    def _iter_partitions(self):
+        """
+        Yields the header and rows of the query read as `partitions` ranges
+        at once. This connection exports a snapshot that a new connection
+        per range imports, so all of them see the table as it was at the
+        same moment. A thread per range fetches its rows through a named
+        cursor and hands them over `itersize` rows at a time.
+        """
+        coordinator = self.db.connect()
+        coordinator.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        connections = []
+        threads = []
+        stop = threading.Event()
+        done = object()
+        try:
+            cursor = coordinator.cursor()
+            cursor.execute('SELECT pg_export_snapshot()')
+            snapshot = cursor.fetchone()[0]
+            conditions, key = self._partition_conditions(cursor)
+            cursor.execute(self.stmt() + ' LIMIT 0')
+            header = tuple([d[0] for d in cursor.description])
+            n = len(conditions)
+            if self.ordered:
+                queues = [queue.Queue(maxsize=2) for _ in range(n)]
+            else:
+                queues = [queue.Queue(maxsize=n * 2)] * n
+
+            def put(q, item):
+                # stop if the rows are no longer being read
+                while not stop.is_set():
+                    try:
+                        q.put(item, timeout=1)
+                        return True
+                    except queue.Full:
+                        pass
+                return False
+
+            def read(dbo, condition, q):
+                try:
+                    cursor = self._read_cursor(dbo, name='geopetl_read_{}'.format(next(_read_cursor_ids)))
+                    cursor.execute(self.stmt(where=condition, order_by=key if self.ordered else None))
+                    while True:
+                        chunk = cursor.fetchmany(self.itersize)
+                        if not chunk:
+                            break
+                        if not put(q, chunk):
+                            return
+                    put(q, done)
+                except Exception as e:
+                    put(q, e)
+
+            for condition, q in zip(conditions, queues):
+                dbo = self.db.connect()
+                connections.append(dbo)
+                dbo.set_session(isolation_level='REPEATABLE READ', readonly=True)
+                dbo.cursor().execute('SET TRANSACTION SNAPSHOT %s', (snapshot,))
+                threads.append(threading.Thread(target=read, args=(dbo, condition, q), daemon=True))
+            for thread in threads:
+                thread.start()
+            print('Geopetl: reading {} partitions on {}'.format(n, key))
+
+            yield header
+            # with ordered, read each partition's queue in turn; otherwise
+            # they share one queue, which is done once every partition is
+            for q in (queues if self.ordered else queues[:1]):
+                pending = 1 if self.ordered else n
+                while pending:
+                    item = q.get()
+                    if item is done:
+                        pending -= 1
+                    elif isinstance(item, Exception):
+                        raise item
+                    else:
+                        for row in item:
+                            yield row
+        finally:
+            stop.set()
+            # if the rows weren't all read, don't wait on the queries still
+            # running
+            for dbo, thread in zip(connections, threads):
+                if thread.is_alive():
+                    dbo.cancel()
+            for thread in threads:
+                thread.join()
+            for dbo in connections + [coordinator]:
+                dbo.close()
+
+    def _iter_keyset(self):
+        """
+        Yields the header and rows of the query read a page at a time in
+        objectid order; see geopetl.keyset. Pages are read on a new
+        autocommit connection, so no transaction stays open between them.
+        """
+        key = self.table.objectid_field
+        if not key:
+            raise ValueError('Keyset reads need an objectid field')
+        if self.fields is not None and key not in self.fields:
+            raise ValueError('Keyset reads need the objectid field in fields')
+        checkpoint = None
+        if self.checkpoint:
+            checkpoint = Checkpoint(self.checkpoint, self.table.name_with_schema, self.stmt())
+        dbo = self.db.connect()
+        dbo.autocommit = True
+
+        def fetch_page(last, page_size):
+            # rows with a null key can't be paged through, so they're left out
+            where = '{} IS NOT NULL'.format(_quote(key))
+            if last is not None:
+                where = '{} > {}'.format(_quote(key), psycopg2.extensions.adapt(last).getquoted().decode())
+            cursor = self._read_cursor(dbo)
+            cursor.execute('{} LIMIT {}'.format(self.stmt(where=where, order_by=key), page_size))
+            header = [d[0] for d in cursor.description]
+            rows = cursor.fetchall()
+            cursor.close()
+            return header, rows
+
+        try:
+            for row in KeysetView(fetch_page, key, self.page_size, checkpoint):
+                yield row
+        finally:
+            dbo.close()
+
+    def _iter_copy(self, stmt):
+        """
+        Yields the header and rows of the query read with COPY (...) TO
+        STDOUT in copy_format, on a new connection. One thread runs the COPY,
+        with psycopg2 writing its output into a pipe, and another parses rows
+        out of the pipe and hands them over `itersize` rows at a time.
+        """
+        stmt = stmt.rstrip().rstrip(';')
+        binary = self.copy_format == 'binary'
+        dbo = self.db.connect()
+        threads = []
+        reader = writer = None
+        errors = []
+        stop = threading.Event()
+        done = object()
+        q = queue.Queue(maxsize=4)
+        try:
+            cursor = dbo.cursor()
+            cursor.execute('SELECT * FROM ({}) AS q LIMIT 0'.format(stmt))
+            header = tuple([d[0] for d in cursor.description])
+            oids = [d[1] for d in cursor.description]
+            cursor.execute('SELECT oid, typname FROM pg_type WHERE oid IN %s', (tuple(set(oids)),))
+            typnames = dict(cursor.fetchall())
+            encoding = psycopg2.extensions.encodings[dbo.encoding]
+            if binary:
+                cursor.execute('SHOW TimeZone')
+                timezone = tz.gettz(cursor.fetchone()[0])
+                decoders = [binary_decoder(typnames[x], encoding=encoding, timezone=timezone) for x in oids]
+                parse = lambda f: iter_copy_binary(f, decoders)
+            else:
+                converters = [self._copy_text_converter(x, typnames[x]) for x in oids]
+                parse = lambda f: iter_copy_text(f, encoding, converters)
+            copy_stmt = 'COPY ({}) TO STDOUT{}'.format(stmt, ' WITH (FORMAT binary)' if binary else '')
 
-        return iter_fn
+            def put(item):
+                # stop if the rows are no longer being read
+                while not stop.is_set():
+                    try:
+                        q.put(item, timeout=1)
+                        return True
+                    except queue.Full:
+                        pass
+                return False
+
+            def copy():
+                try:
+                    cursor.copy_expert(copy_stmt, writer, size=COPY_READ_SIZE)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    try:
+                        writer.close()
+                    except OSError:
+                        # the reading end is gone
+                        pass
+
+            def read():
+                try:
+                    chunk = []
+                    for row in parse(reader):
+                        chunk.append(row)
+                        if len(chunk) >= self.itersize:
+                            if not put(chunk):
+                                return
+                            chunk = []
+                    if chunk and not put(chunk):
+                        return
+                    put(done)
+                except Exception as e:
+                    put(e)
+                finally:
+                    # so a COPY still writing fails rather than waiting
+                    reader.close()
+
+            r, w = os.pipe()
+            reader, writer = os.fdopen(r, 'rb'), os.fdopen(w, 'wb')
+            threads = [threading.Thread(target=copy, daemon=True), threading.Thread(target=read, daemon=True)]
+            for thread in threads:
+                thread.start()
+            print('Geopetl: reading with COPY TO STDOUT ({} format)'.format(self.copy_format))
+
+            yield header
+            while True:
+                item = q.get()
+                if item is done or isinstance(item, Exception):
+                    # the parser ends early if the COPY failed, so its error
+                    # comes first
+                    threads[0].join()
+                    if errors:
+                        raise errors[0]
+                    if item is done:
+                        break
+                    raise item
+                for row in item:
+                    yield row
+        finally:
+            stop.set()
+            if threads:
+                # if the rows weren't all read, don't wait on the COPY
+                if threads[0].is_alive():
+                    dbo.cancel()
+                for thread in threads:
+                    thread.join()
+            else:
+                for f in (reader, writer):
+                    if f is not None:
+                        f.close()
+            dbo.close()
+
+    def _copy_text_converter(self, oid, typname):
+        """Returns the converter for a column's values in COPY text format,
+        or None to leave them strings."""
+        if typname == 'bytea':
+            # hex output, e.g. \x0101
+            return lambda val: bytes.fromhex(val[2:])
+        if self.decode == 'raw' and oid in RAW_TYPE_OIDS:
+            return RawValue
+        return None
+
+    def tocsv(self, source=None, encoding=None, errors='strict', write_header=True, **csvargs):
+        """
+        With copy_format, writes the query's rows to a CSV file straight from
+        COPY (...) TO STDOUT WITH (FORMAT csv), without making rows of them.
+        Values are written as COPY writes them, e.g. 't' and 'f' for
+        booleans, and lines end with \n. Otherwise, or with csv options or
+        binary geometries COPY can't write the same way, this is petl's
+        tocsv. As with header(), the transaction the COPY opens is rolled
+        back, unless one was already open on the connection.
+        """
+        pg_encoding = self._pg_encoding(encoding)
+        if not self.copy_format or csvargs or errors != 'strict' or self.geom_format != 'wkt' or \
+                pg_encoding is None:
+            return etl.tocsv(self, source, encoding=encoding, errors=errors, write_header=write_header, **csvargs)
+        dbo = self.db.dbo
+        # before forming the statement, which may read the table's metadata
+        idle = dbo.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        stmt = (self.sql or self.stmt()).rstrip().rstrip(';')
+        options = ['FORMAT csv', "ENCODING '{}'".format(pg_encoding)]
+        if write_header:
+            options.append('HEADER')
+        print('Geopetl: writing CSV with COPY TO STDOUT')
+        cursor = dbo.cursor()
+        try:
+            with write_source_from_arg(source).open('wb') as f:
+                cursor.copy_expert('COPY ({}) TO STDOUT WITH ({})'.format(stmt, ', '.join(options)), f,
+                                   size=COPY_READ_SIZE)
+        except Exception:
+            dbo.rollback()
+            raise
+        else:
+            # don't leave a transaction idle on the shared connection
+            if idle and not dbo.autocommit:
+                dbo.rollback()
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def _pg_encoding(encoding):
+        """Returns the Postgres name of a python codec, defaulting to the
+        locale's as petl does, or None if Postgres doesn't have it."""
+        try:
+            name = codecs.lookup(encoding or locale.getpreferredencoding(False)).name
+        except LookupError:
+            return None
+        for pg_name, py_name in psycopg2.extensions.encodings.items():
+            try:
+                if codecs.lookup(py_name).name == name:
+                    return pg_name
+            except LookupError:
+                continue
+        return None
+
+    def _binary_geom_converter(self):
+        """Returns a function turning the memoryviews psycopg2 gives for
+        bytea into bytes, or LazyGeometry with lazy_geom."""
+        wrap = geometry.LazyGeometry if self.lazy_geom else bytes
+        # st_geometry was read with ST_AsBinary, so add the SRID here
+        srid = None
+        if self.geom_format == 'ewkb' and self.table.geom_udt == 'st_geometry':
+            srid = self.to_srid or self.table.srid
+
+        def convert(g):
+            if g is None:
+                return None
+            if srid:
+                g = geometry.with_srid(g, srid)
+            return wrap(g)
+
+        return convert
+
+
+    def _filter_geom(self, val, sde):
+        """Returns SQL for a filter geometry in the table's SRID."""
+        geom = geometry.decode(val)
+        if geom is None:
+            raise ValueError('Spatial filters need a geometry, got: {!r}'.format(val))
+        table_srid = self.table.srid
+        srid = geom.srid or self.filter_srid or table_srid
+        if sde:
+            # st_geometry takes plain WKT and the srid separately
+            sql = "sde.st_geometry('{}', {})".format(geometry.to_wkt(geom, force_2d=False).replace("'", "''"), srid)
+            transform = 'sde.st_transform({}, {})'
+        else:
+            sql = "'{}'::geometry".format(geometry.to_ewkb(geom, srid, force_2d=False).hex())
+            transform = 'ST_Transform({}, {})'
+        if table_srid and srid != table_srid:
+            sql = transform.format(sql, table_srid)
+        return sql
 
+    def spatial_filters(self):
+        """
+        Returns WHERE conditions for the bbox, intersects and dwithin
+        filters, written so the geometry column's spatial index can be used:
+        && and ST_Intersects/ST_DWithin for PostGIS, st_envintersects and
+        st_intersects for st_geometry. Filter geometries are transformed to
+        the table's SRID rather than the column to theirs, which would rule
+        out the index.
+        """
+        if not (self.bbox or self.intersects or self.dwithin):
+            return []
+        geom_field = self.table.geom_field
+        if not geom_field:
+            raise ValueError('Spatial filters need a table with a geometry column')
+        column = _quote(geom_field)
+        sde = self.table.geom_udt == 'st_geometry'
+        conditions = []
+        if self.bbox:
+            xmin, ymin, xmax, ymax = [float(x) for x in self.bbox]
+            if sde:
+                envelope = 'POLYGON(({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))'.format(xmin, ymin, xmax, ymax)
+                conditions.append('sde.st_envintersects({}, {})'.format(column, self._filter_geom(envelope, sde)))
+            else:
+                envelope = 'ST_MakeEnvelope({}, {}, {}, {}, {})'.format(
+                    xmin, ymin, xmax, ymax, self.filter_srid or self.table.srid)
+                if self.filter_srid and self.filter_srid != self.table.srid:
+                    envelope = 'ST_Transform({}, {})'.format(envelope, self.table.srid)
+                conditions.append('{} && {}'.format(column, envelope))
+        if self.intersects:
+            fn = 'sde.st_intersects' if sde else 'ST_Intersects'
+            conditions.append('{}({}, {})'.format(fn, column, self._filter_geom(self.intersects, sde)))
+        if self.dwithin:
+            geom, distance = self.dwithin
+            distance = float(distance)
+            if sde:
+                # st_geometry has no st_dwithin; a buffer keeps the index usable
+                conditions.append('sde.st_intersects({}, sde.st_buffer({}, {}))'.format(
+                    column, self._filter_geom(geom, sde), distance))
+            else:
+                conditions.append('ST_DWithin({}, {}, {})'.format(column, self._filter_geom(geom, sde), distance))
+        return conditions
 
-    def stmt(self):
+    def stmt(self, where=None, order_by=None):
+        """Forms the query. `where` is a condition added to the query's own
+        where clause and `order_by` a field to sort on."""
         # handle fields
         fields = self.fields
         if fields is None:
@@ -1009,7 +2780,11 @@ class PostgisQuery(Table):
         geom_field = self.table.geom_field
         # replace geom field with wkt in fields list
         if geom_field and self.return_geom:
-            wkt_getter = self.table.wkt_getter(geom_field, self.to_srid)
+            if self.geom_format == 'wkt':
+                wkt_getter = self.table.wkt_getter(geom_field, self.to_srid,
+                                                   with_srid=bool(self.geom_with_srid and self.table.srid))
+            else:
+                wkt_getter = self.table.wkb_getter(geom_field, self.to_srid, ewkb=self.geom_format == 'ewkb')
             geom_field_index = fields.index('"'+geom_field+'"')
             fields[geom_field_index] = wkt_getter
 
@@ -1018,9 +2793,14 @@ class PostgisQuery(Table):
         stmt = 'SELECT {} FROM {}'.format(fields_joined,
                                           self.table.name_with_schema)
 
-        where = self.where
-        if where:
-            stmt += ' WHERE {}'.format(where)
+        wheres = [x for x in [self.where, where] + self.spatial_filters() if x]
+        if len(wheres) > 1:
+            stmt += ' WHERE {}'.format(' AND '.join(['({})'.format(x) for x in wheres]))
+        elif wheres:
+            stmt += ' WHERE {}'.format(wheres[0])
+
+        if order_by:
+            stmt += ' ORDER BY {}'.format(order_by if order_by == 'ctid' else _quote(order_by))
 
         limit = self.limit
         if limit:
@@ -0,0 +1,87 @@
+"""
+Single-pass reading of the rows handed to a writer.
+
+Indexing or filtering a petl table (rows[0], len(rows), rows.head(),
+rows.selectnotnone()) iterates it again from the start, and when the table
+is a database query or a large file that means running the whole extraction
+again. RowStream reads the source once and keeps a bounded number of rows
+buffered, which is enough to check whether there are any rows and to sniff
+geometry types before writing starts.
+"""
+
+# rows a writer may look through before it starts writing
+LOOKAHEAD_ROWS = 1000
+
+
+class RowStream(object):
+    """
+    Wraps a table so it's read exactly once. The header is read up front;
+    rows are buffered as the lookahead methods need them, up to `lookahead`
+    rows. Iterating yields the header and then every row, buffered ones
+    first, and can only be done once.
+    """
+
+    def __init__(self, rows, lookahead=LOOKAHEAD_ROWS):
+        self._it = iter(rows)
+        try:
+            self.header = tuple(next(self._it))
+        except StopIteration:
+            self.header = ()
+        self.lookahead = lookahead
+        self._buffer = []
+        self._exhausted = False
+        self._consumed = False
+
+    @classmethod
+    def wrap(cls, rows, lookahead=LOOKAHEAD_ROWS):
+        """Wraps rows, unless they're a RowStream already."""
+        return rows if isinstance(rows, cls) else cls(rows, lookahead)
+
+    def _read(self):
+        """Buffers one more row. Returns False at the end of the rows or the
+        lookahead window."""
+        if self._exhausted or len(self._buffer) >= self.lookahead:
+            return False
+        try:
+            self._buffer.append(next(self._it))
+        except StopIteration:
+            self._exhausted = True
+            return False
+        return True
+
+    @property
+    def empty(self):
+        """Whether there are no rows after the header."""
+        if not self._buffer:
+            self._read()
+        return not self._buffer
+
+    def head(self, n=1):
+        """Returns up to the first n rows, without the header."""
+        while len(self._buffer) < n and self._read():
+            pass
+        return self._buffer[:n]
+
+    def first(self, field):
+        """Returns the first value of `field` that isn't None or '' within
+        the lookahead window, or None."""
+        i = self.header.index(field)
+        for row in self._buffer:
+            if row[i] is not None and row[i] != '':
+                return row[i]
+        while self._read():
+            val = self._buffer[-1][i]
+            if val is not None and val != '':
+                return val
+        return None
+
+    def __iter__(self):
+        if self._consumed:
+            raise RuntimeError('The rows have already been read')
+        self._consumed = True
+        yield self.header
+        buffer, self._buffer = self._buffer, []
+        for row in buffer:
+            yield row
+        for row in self._it:
+            yield row
@@ -0,0 +1,182 @@
+import csv
+
+import pytest
+
+from geopetl import batch
+from geopetl.batch import Batcher, CommitPolicy, RejectFile, REJECT_ERROR_FIELD
+
+HEADER = ('id', 'name')
+ROWS = [(i, 'row {}'.format(i)) for i in range(10)]
+
+
+class FakeConnection(object):
+    """Keeps written rows in memory with the transaction and savepoint
+    semantics of a database connection."""
+
+    def __init__(self):
+        self.committed = []
+        self.pending = []
+        self.savepoints = []
+        self.commits = 0
+
+    def cursor(self):
+        return self
+
+    def execute(self, stmt):
+        if stmt.startswith('SAVEPOINT'):
+            self.savepoints.append(len(self.pending))
+        elif stmt.startswith('ROLLBACK TO SAVEPOINT'):
+            del self.pending[self.savepoints[-1]:]
+        elif stmt.startswith('RELEASE SAVEPOINT'):
+            self.savepoints.pop()
+
+    def commit(self):
+        self.committed += self.pending
+        self.pending = []
+        self.savepoints = []
+        self.commits += 1
+
+    def rollback(self):
+        self.pending = []
+        self.savepoints = []
+
+
+def failing_flush(dbo, bad, calls=None):
+    """A flush that writes rows up to the first bad one, then fails, like
+    an insert statement partway through a batch."""
+    def flush(rows):
+        if calls is not None:
+            calls.append(len(rows))
+        for row in rows:
+            if row[0] in bad:
+                raise ValueError('bad row {}'.format(row[0]))
+            dbo.pending.append(row)
+    return flush
+
+
+def read_rejects(path):
+    with open(path, newline='') as f:
+        return list(csv.reader(f))
+
+
+# a failed batch is bisected down to the bad rows, which go to the reject
+# file; every other row is committed
+def test_isolate_rejects(tmp_path):
+    dbo = FakeConnection()
+    rejects = RejectFile(str(tmp_path / 'rejects.csv'), HEADER)
+    calls = []
+    policy = CommitPolicy(dbo, 'single', rejects=rejects)
+    batcher = Batcher(failing_flush(dbo, {3, 7}, calls), max_rows=len(ROWS), commit=policy)
+    for row in ROWS:
+        batcher.add(row, source=row)
+    batcher.close()
+    rejects.close()
+
+    assert dbo.committed == [row for row in ROWS if row[0] not in (3, 7)]
+    assert dbo.commits == 1
+    assert policy.rows_committed == 8
+    assert read_rejects(rejects.path) == [['id', 'name', REJECT_ERROR_FIELD],
+                                          ['3', 'row 3', 'bad row 3'],
+                                          ['7', 'row 7', 'bad row 7']]
+    # the whole batch, then halves of 5, then down to the bad rows
+    assert calls[0] == 10
+    assert len(calls) < 2 * len(ROWS)
+
+# rows the flush skipped without failing, as Oracle's batcherrors does, are
+# rejected along with their source rows
+def test_isolate_skipped_rows(tmp_path):
+    dbo = FakeConnection()
+    rejects = RejectFile(str(tmp_path / 'rejects.csv'), HEADER)
+    policy = CommitPolicy(dbo, 'single', rejects=rejects)
+
+    def flush(rows):
+        dbo.pending += [x for x in rows if x[1] != 5]
+        return [(i, 'skipped') for i, x in enumerate(rows) if x[1] == 5]
+
+    batcher = Batcher(flush, max_rows=4, commit=policy)
+    for row in ROWS:
+        batcher.add(('encoded', row[0]), source=row)
+    batcher.close()
+    rejects.close()
+
+    assert rejects.count == 1
+    assert read_rejects(rejects.path)[1] == ['5', 'row 5', 'skipped']
+    assert len(dbo.committed) == 9
+
+# without a reject file a bad row fails the load; batch mode keeps the
+# batches committed before it
+def test_run_batch_mode():
+    dbo = FakeConnection()
+    policy = CommitPolicy(dbo, 'batch', every=2)
+    batcher = Batcher(failing_flush(dbo, {7}), max_rows=2, commit=policy)
+    with pytest.raises(ValueError):
+        for row in ROWS:
+            batcher.add(row)
+    assert dbo.committed == ROWS[:4]
+    assert dbo.pending == []
+
+# savepoint mode commits every batch before the failed one, once
+def test_run_savepoint_mode():
+    dbo = FakeConnection()
+    policy = CommitPolicy(dbo, 'savepoint')
+    batcher = Batcher(failing_flush(dbo, {7}), max_rows=3, commit=policy)
+    with pytest.raises(ValueError):
+        for row in ROWS:
+            batcher.add(row)
+    assert dbo.committed == ROWS[:6]
+    assert dbo.commits == 1
+
+# a deferred finish leaves the commit, or the rollback, to the caller
+def test_defer_finish():
+    dbo = FakeConnection()
+    policy = CommitPolicy(dbo, 'single', defer_finish=True)
+    batcher = Batcher(failing_flush(dbo, set()), max_rows=4, commit=policy)
+    for row in ROWS:
+        batcher.add(row)
+    batcher.close()
+    assert dbo.committed == []
+    assert dbo.pending == ROWS
+    policy.abort()
+    assert dbo.pending == ROWS
+
+# a batch is flushed on its byte budget before its row cap
+def test_batcher_byte_budget():
+    batches = []
+    batcher = Batcher(batches.append, max_rows=100, max_bytes=10)
+    for row in ROWS:
+        batcher.add(row, size=4)
+    stats = batcher.close()
+    assert [len(x) for x in batches] == [3, 3, 3, 1]
+    assert stats['bytes'] == 40
+    assert stats['batches'] == 4
+
+# auto-tune doubles the row cap while throughput improves and backs off from
+# a batch that takes too long
+def test_auto_tune(monkeypatch):
+    clock = [0.0]
+
+    class FakeTime(object):
+        @staticmethod
+        def time():
+            return clock[0]
+
+    def flush(rows):
+        # a second of overhead per batch makes bigger batches faster
+        clock[0] += 1 + 0.01 * len(rows)
+
+    monkeypatch.setattr(batch, 'time', FakeTime)
+    batcher = Batcher(flush, max_rows=10, max_bytes=None, auto_tune=True)
+    for i in range(3000):
+        batcher.add((i,))
+    stats = batcher.close()
+    # 1280 rows take 13.8s, over MAX_AUTO_TUNE_SECONDS
+    assert stats['batch_size'] == 640
+    assert batcher.settled
+
+# auto-tune settles on what the byte budget allows
+def test_auto_tune_byte_budget():
+    batcher = Batcher(lambda rows: None, max_rows=10, max_bytes=12, auto_tune=True)
+    for row in ROWS:
+        batcher.add(row, size=4)
+    assert batcher.max_rows == 3
+    assert batcher.settled
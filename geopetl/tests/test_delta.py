@@ -0,0 +1,42 @@
+from decimal import Decimal
+
+from geopetl import delta
+
+TARGET = [('objectid', 'textfield', 'numericfield'),
+          (Decimal(1), 'a', Decimal('1.50')),
+          (Decimal(2), 'b', Decimal(2)),
+          (Decimal(3), 'c', Decimal(3)),
+          (Decimal(4), 'd', Decimal(4))]
+KINDS = {'textfield': 'text', 'numericfield': 'num'}
+
+# values are compared normalized, fields in any order, and only new and
+# changed rows come through
+def test_diff():
+    source = [('numericfield', 'objectid', 'textfield'),
+              ('1.5', '1', 'a'),
+              ('2', '2', 'changed'),
+              ('5', '5', 'new'),
+              ('3', '3', 'c')]
+    diff = delta.Diff(source, TARGET, 'objectid', KINDS)
+    assert list(diff) == [source[0], source[2], source[3]]
+    assert diff.changes == {'insert': ['5'], 'update': ['2'], 'delete': ['4'], 'unchanged': 2}
+
+# changed rows are held back until before_update has had their keys
+def test_diff_before_update(monkeypatch):
+    monkeypatch.setattr(delta, 'UPDATE_BATCH_ROWS', 2)
+    source = [('objectid', 'textfield', 'numericfield')] + \
+             [(Decimal(i), 'changed', Decimal(i)) for i in (1, 2, 3)] + [(Decimal(5), 'new', None)]
+    seen = []
+
+    def before_update(keys):
+        seen.append(list(keys))
+    diff = delta.Diff(source, TARGET, 'objectid', KINDS, before_update=before_update)
+    rows = []
+    for row in diff:
+        # a changed row only comes through after its key was handled
+        if row[0] in diff.changes['update']:
+            assert any(row[0] in keys for keys in seen)
+        rows.append(row)
+    assert seen == [[1, 2], [3]]
+    assert sorted(row[0] for row in rows[1:]) == [1, 2, 3, 5]
+    assert diff.changes['delete'] == ['4']
@@ -0,0 +1,54 @@
+import struct
+
+import pytest
+
+from geopetl import geometry
+
+POINT_WKB = struct.pack('<BI2d', 1, 1, 1.5, 2)
+
+# WKT comes back as the same text, and through EWKB to the same WKT
+@pytest.mark.parametrize('wkt', ['POINT(1.5 2)',
+                                 'LINESTRING(1 2, 3 4)',
+                                 'POLYGON((0 0, 1 0, 1 1, 0 0), (0.2 0.2, 0.5 0.2, 0.2 0.5, 0.2 0.2))',
+                                 'MULTIPOINT((1 2), (3 4))',
+                                 'MULTIPOLYGON(((0 0, 1 0, 1 1, 0 0)))',
+                                 'GEOMETRYCOLLECTION(POINT(1 2), LINESTRING(1 2, 3 4))',
+                                 'POINT EMPTY'])
+def test_wkt_round_trip(wkt):
+    assert geometry.to_wkt(wkt) == wkt
+    assert geometry.to_wkt(geometry.to_ewkb(wkt)) == wkt
+
+# the SRID of EWKT is carried into EWKB and back
+def test_ewkt_round_trip():
+    ewkt = 'SRID=2272;POINT(2690000.5 240000)'
+    geom = geometry.decode(ewkt)
+    assert (geom.format, geom.srid, geom.geom_type, geom.dims) == ('wkt', 2272, 'POINT', 2)
+    ewkb = geometry.to_ewkb(ewkt)
+    assert geometry.decode(ewkb).srid == 2272
+    assert geometry.to_ewkt(ewkb) == ewkt
+
+# plain WKB takes the given SRID; EWKB keeps its own
+def test_ewkb_round_trip():
+    ewkb = geometry.to_ewkb(POINT_WKB, srid=4326)
+    assert geometry.decode(ewkb).srid == 4326
+    assert geometry.to_ewkb(ewkb, srid=2272) == ewkb
+    assert geometry.to_wkb(ewkb) == POINT_WKB
+    assert geometry.decode(ewkb.hex()).srid == 4326
+    assert str(geometry.LazyGeometry(ewkb)) == 'SRID=4326;POINT(1.5 2)'
+
+# single types are cast to MULTI and Z dropped when asked
+def test_multi_and_2d():
+    assert geometry.to_wkt('POINT Z (1 2 3)', multi=True) == 'MULTIPOINT((1 2))'
+    assert geometry.to_wkt(geometry.to_ewkb('LINESTRING(1 2 3, 4 5 6)', multi=True)) == 'MULTILINESTRING((1 2, 4 5))'
+    assert geometry.decode('POINT(1 2 3)').dims == 3
+
+# text that only looks like a geometry type isn't decoded as one
+@pytest.mark.parametrize('val', ['Point', 'Polygon', 'POINT', 'Point Breeze', 'abc', '00'])
+def test_not_a_geometry(val):
+    with pytest.raises(ValueError):
+        geometry.decode(val)
+
+# empty values decode to None
+@pytest.mark.parametrize('val', [None, '', 'EMPTY'])
+def test_empty_value(val):
+    assert geometry.decode(val) is None
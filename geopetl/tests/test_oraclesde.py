@@ -317,6 +317,24 @@ def test_reading_without_schema(oraclesde_db, csv_data,srid,):
     db_data2 = etl.fromoraclesde(dbo=oraclesde_db, table_name='{}_{}'.format(point_table_name,srid))
     assert_data_method(csv_data, db_data2, srid)
 
+# header and row counts come from the database without reading the rows
+def test_reading_header_and_count(oraclesde_db, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    csv_data.tooraclesde(oraclesde_db, table_name, srid=srid)
+    db_data = etl.fromoraclesde(dbo=oraclesde_db, table_name=table_name)
+    assert db_data.header() == tuple(next(iter(db_data)))
+    assert db_data.nrows() == etl.nrows(csv_data)
+
+# keyset reads page through the table in objectid order
+def test_reading_keyset(oraclesde_db, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    objectid_field = fields.get('object_id_field_name')
+    csv_data.tooraclesde(oraclesde_db, table_name, srid=srid)
+    db_data = etl.fromoraclesde(dbo=oraclesde_db, table_name=table_name, keyset=True, page_size=2)
+    objectids = list(db_data.values(objectid_field))
+    assert objectids == sorted(objectids)
+    assert_data_method(csv_data.convert(objectid_field, int).sort(objectid_field), db_data, srid)
+
 # #compare csv data with postgres data using geopetl
 def test_reading_line_table(oraclesde_db, schema,srid, create_line_table):
     csv_data = etl.fromcsv(line_csv_dir).convert(['objectid'], int)
@@ -466,3 +484,50 @@ def test_reading_with_types(db_data,oraclesde_db, schema, srid):
     # extract from second test table
     data2 = etl.fromoraclesde(dbo=oraclesde_db, table_name='{}.{}_{}_2'.format(schema,point_table_name,srid))
     assert_data_method(data1, data2, srid)
+
+# load in one transaction, with a savepoint per batch
+def test_write_savepoints(oraclesde_db, schema, srid):
+    csv_data = etl.fromcsv(line_csv_dir).convert([fields.get('object_id_field_name')], int)
+    csv_data.tooraclesde(oraclesde_db, '{}.{}_{}'.format(schema, line_table_name, srid), srid=srid,
+                         buffer_size=2, commit='savepoint')
+    stmt = '''select {objectid_field_name} as "{objectid_field_name}", SDE.ST_AsText({shape_field_name}) as "{shape_field_name}" from {}.{}_{}'''.format(
+        schema,
+        line_table_name,
+        srid,
+        objectid_field_name = fields.get('object_id_field_name'),
+        shape_field_name = fields.get('shape_field_name')
+    )
+    cursor = oraclesde_db.cursor()
+    cursor.execute(stmt)
+    assert_data_method(csv_data, cursor, srid,schema=schema, table=point_table_name)
+
+def test_write_delta(oraclesde_db, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    objectid_field = fields.get('object_id_field_name')
+    csv_data.tooraclesde(oraclesde_db, table_name, srid=srid)
+    changed_data = etl.fromcsv(point_csv_dir).head(etl.nrows(csv_data) - 1)
+    changes = changed_data.tooraclesde(oraclesde_db, table_name, srid=srid, delta=True, commit='single')
+    assert changes['insert'] == [] and changes['update'] == []
+    assert len(changes['delete']) == 1
+    db_data = etl.fromoraclesde(dbo=oraclesde_db, table_name=table_name)
+    assert etl.nrows(db_data) == etl.nrows(changed_data)
+
+# a changed row Oracle refuses leaves its original in the table, and rejecting
+# it instead isn't allowed
+def test_write_delta_bad_row(oraclesde_db, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    objectid_field = fields.get('object_id_field_name')
+    numeric_field = fields.get('numeric_field_name')
+    csv_data.tooraclesde(oraclesde_db, table_name, srid=srid)
+    first_objectid = etl.fromcsv(point_csv_dir).values(objectid_field)[0]
+    bad_data = etl.fromcsv(point_csv_dir).convert(
+        numeric_field, lambda v, row: 'abc' if row[objectid_field] == first_objectid else v, pass_row=True)
+    with pytest.raises(ValueError):
+        bad_data.tooraclesde(oraclesde_db, table_name, srid=srid, delta=True, on_error='reject')
+    with pytest.raises(Exception):
+        bad_data.tooraclesde(oraclesde_db, table_name, srid=srid, delta=True)
+    db_data = etl.fromoraclesde(dbo=oraclesde_db, table_name=table_name)
+    assert etl.nrows(db_data) == etl.nrows(csv_data)
+    original = csv_data.select(lambda row: int(row[objectid_field]) == int(first_objectid))
+    db_row = db_data.select(lambda row: int(row[objectid_field]) == int(first_objectid))
+    assert list(db_row.values(numeric_field)) == list(original.values(numeric_field))
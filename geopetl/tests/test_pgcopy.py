@@ -0,0 +1,88 @@
+import struct
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+from geopetl.pgcopy import binary_decoder, binary_encoder, geom_binary_encoder, geom_text_encoder
+
+NULL = b'\xff\xff\xff\xff'
+
+
+def field(data):
+    return struct.pack('>i', len(data)) + data
+
+
+def numeric(ndigits, weight, sign, dscale, *digits):
+    return field(struct.pack('>hhHh', ndigits, weight, sign, dscale) + struct.pack('>{}H'.format(len(digits)), *digits))
+
+# integers encode to their fixed widths, and integral strings are accepted
+def test_binary_ints():
+    assert binary_encoder('int2')(5) == field(struct.pack('>h', 5))
+    assert binary_encoder('int4')(-5) == field(struct.pack('>i', -5))
+    assert binary_encoder('int8')('2.0') == field(struct.pack('>q', 2))
+
+# a fraction is refused rather than truncated, as text COPY would refuse it
+@pytest.mark.parametrize('val', [1.7, '1.5', Decimal('-0.1')])
+def test_binary_ints_refuse_fractions(val):
+    with pytest.raises(ValueError):
+        binary_encoder('int4')(val)
+
+# None and '' are null for every type, and 'None' for temporal types
+def test_binary_nulls():
+    for udt in ('int4', 'numeric', 'text', 'bool', 'timestamp'):
+        assert binary_encoder(udt)(None) == NULL
+        assert binary_encoder(udt)('') == NULL
+    assert binary_encoder('date')('None') == NULL
+    assert binary_encoder('text')('None') == field(b'None')
+
+# numerics are base-10000 digits with a weight, sign and display scale
+def test_binary_numeric():
+    encode = binary_encoder('numeric')
+    assert encode('12345.678') == numeric(3, 1, 0x0000, 3, 1, 2345, 6780)
+    assert encode('-0.5') == numeric(1, -1, 0x4000, 1, 5000)
+    assert encode(10000) == numeric(1, 1, 0x0000, 0, 1)
+    assert encode('0') == numeric(0, 0, 0x0000, 0)
+    assert encode('0.0001') == numeric(1, -1, 0x0000, 4, 1)
+
+@pytest.mark.parametrize('val', ['0', '1', '-1', '12345.678', '-0.0001', '100000000', '1.10',
+                                 '-123456789.000000001', 'NaN'])
+def test_binary_numeric_round_trip(val):
+    data = binary_encoder('numeric')(val)
+    decoded = binary_decoder('numeric')(data[4:])
+    if val == 'NaN':
+        assert decoded.is_nan()
+    else:
+        assert decoded == Decimal(val)
+        assert str(decoded) == val
+
+def test_binary_temporal():
+    assert binary_encoder('date')('2000-01-02') == field(struct.pack('>i', 1))
+    assert binary_encoder('timestamp')('2000-01-01 00:00:01') == field(struct.pack('>q', 1000000))
+    assert binary_encoder('timestamp')(datetime(1999, 12, 31, 23, 59, 59)) == field(struct.pack('>q', -1000000))
+    assert binary_decoder('date')(struct.pack('>i', -1)) == date(1999, 12, 31)
+
+def test_binary_bool_and_text():
+    assert binary_encoder('bool')('t') == field(b'\x01')
+    assert binary_encoder('bool')(False) == field(b'\x00')
+    assert binary_encoder('text')({'a': 1}) == field(b'{"a": 1}')
+    assert binary_encoder('jsonb')('[]') == field(b'\x01[]')
+
+def test_binary_unhandled_type():
+    with pytest.raises(TypeError):
+        binary_encoder('tsvector')
+
+# COPY text refuses curves, unless the statement linearizes them
+def test_text_geom_curves():
+    curve = 'CIRCULARSTRING(0 0, 1 1, 2 0)'
+    with pytest.raises(ValueError, match="method='insert'"):
+        geom_text_encoder(2272)(curve)
+    assert geom_text_encoder(2272, curves=True)(curve) == 'SRID=2272;' + curve
+    assert geom_text_encoder(2272, multi_geom=True)('LINESTRING(0 0, 1 1)') == 'SRID=2272;MULTILINESTRING((0 0, 1 1))'
+
+# binary COPY refuses curves with the same error, and sends None as NULL
+def test_binary_geom():
+    with pytest.raises(ValueError, match="method='insert'"):
+        geom_binary_encoder(2272)('CIRCULARSTRING(0 0, 1 1, 2 0)')
+    assert geom_binary_encoder(2272)(None) == NULL
+    assert geom_binary_encoder(2272)('') == NULL
+    assert geom_binary_encoder(2272)('POINT(1 2)') == field(struct.pack('<BIIdd', 1, 0x20000001, 2272, 1, 2))
@@ -1,6 +1,8 @@
 import pytest
 import petl as etl
 from geopetl.postgis import PostgisDatabase
+from geopetl import geometry
+from geopetl.encoding import RawValue
 import psycopg2
 from pytz import timezone
 import csv
@@ -340,6 +342,141 @@ def test_stmt_arg(postgis,csv_data,schema,srid):
     db_data1 = etl.frompostgis(dbo=postgis.dbo,table_name='{}.{}_{}'.format(schema, point_table_name, srid),sql=qry)
     assert_data_method(csv_data, db_data1, srid)
     
+# a small itersize makes the named cursor fetch in several round trips
+def test_read_server_side(load_point_table, postgis, csv_data, schema, srid):
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name='{}.{}_{}'.format(schema, point_table_name, srid),
+                               server_side=True, itersize=2)
+    assert_data_method(csv_data, db_data1, srid)
+
+# binary geometries decode to the same shapes, and load back in as they are
+def test_read_ewkb(load_point_table, postgis, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    shape_field = fields.get('shape_field_name')
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name, geom_format='ewkb', lazy_geom=True)
+    geoms = [g for g in db_data1.values(shape_field) if g is not None]
+    assert all(g.srid == srid for g in geoms)
+    assert_data_method(csv_data, db_data1.convert(shape_field, lambda g: g.wkt if g is not None else None), srid)
+    etl.wrap(list(db_data1)).topostgis(postgis.dbo, table_name, method='binary')
+    assert_data_method(csv_data, etl.frompostgis(dbo=postgis.dbo, table_name=table_name), srid)
+
+# the database writes EWKT, with '' for null geometries
+def test_read_geom_with_srid(load_point_table, postgis, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    shape_field = fields.get('shape_field_name')
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name, geom_with_srid=True)
+    geoms = list(db_data1.values(shape_field))
+    prefix = 'SRID={};'.format(srid)
+    assert all(g == '' or g.startswith(prefix) for g in geoms)
+    assert_data_method(csv_data, db_data1.convert(shape_field, lambda g: g[len(prefix):] if g else None), srid)
+
+# ordered partitions come back in objectid order
+def test_read_partitions(load_point_table, postgis, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    objectid_field = fields.get('object_id_field_name')
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name, partitions=3, ordered=True)
+    objectids = list(db_data1.values(objectid_field))
+    assert objectids == sorted(objectids)
+    assert_data_method(csv_data.convert(objectid_field, int).sort(objectid_field), db_data1, srid)
+
+def test_read_partitions_unordered(load_point_table, postgis, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    objectid_field = fields.get('object_id_field_name')
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name, partitions=3, itersize=2)
+    assert_data_method(csv_data.convert(objectid_field, int).sort(objectid_field), db_data1.sort(objectid_field), srid)
+
+# a keyset read stopped partway resumes after the last full page
+def test_read_keyset_resume(load_point_table, postgis, schema, srid, tmp_path):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    objectid_field = fields.get('object_id_field_name')
+    checkpoint = tmp_path / 'checkpoint.json'
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name, page_size=2, checkpoint=str(checkpoint))
+    rows = iter(db_data1)
+    header = next(rows)
+    first = [next(rows) for _ in range(3)]
+    rows.close()
+    assert checkpoint.exists()
+    rest = [row for row in db_data1][1:]
+    assert not checkpoint.exists()
+    i = list(header).index(objectid_field)
+    objectids = sorted(etl.frompostgis(dbo=postgis.dbo, table_name=table_name).values(objectid_field))
+    assert [row[i] for row in first[:2] + rest] == objectids
+
+# a checkpoint isn't resumed by a read of other rows of the table
+def test_read_keyset_checkpoint_query(load_point_table, postgis, schema, srid, tmp_path):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    objectid_field = fields.get('object_id_field_name')
+    checkpoint = tmp_path / 'checkpoint.json'
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name, page_size=2, checkpoint=str(checkpoint))
+    rows = iter(db_data1)
+    [next(rows) for _ in range(4)]
+    rows.close()
+    db_data2 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name, page_size=2, checkpoint=str(checkpoint),
+                               where='{} > 1'.format(objectid_field))
+    with pytest.raises(ValueError):
+        list(db_data2)
+
+# spatial filters only return rows in the area
+def test_read_spatial_filters(load_point_table, postgis, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    shape_field = fields.get('shape_field_name')
+    cursor = postgis.dbo.cursor()
+    cursor.execute('SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e), n '
+                   'FROM (SELECT ST_Extent({0}) AS e, count({0}) AS n FROM {1}) x'.format(shape_field, table_name))
+    xmin, ymin, xmax, ymax, count = cursor.fetchone()
+    extent = 'POLYGON(({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))'.format(xmin, ymin, xmax, ymax)
+    assert etl.nrows(etl.frompostgis(dbo=postgis.dbo, table_name=table_name, bbox=(xmin, ymin, xmax, ymax))) == count
+    assert etl.nrows(etl.frompostgis(dbo=postgis.dbo, table_name=table_name, intersects=extent)) == count
+    assert etl.nrows(etl.frompostgis(dbo=postgis.dbo, table_name=table_name,
+                                     dwithin=('POINT({} {})'.format(xmax + 1000, ymax), 10))) == 0
+
+# the first full read is cached, and later reads come from the cache
+def test_read_cache(load_point_table, postgis, csv_data, schema, srid, tmp_path):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name, cache=str(tmp_path))
+    rows1 = [row for row in db_data1]
+    assert len(list(tmp_path.glob('*.rows'))) == 1
+    rows2 = [row for row in db_data1]
+    assert rows1 == rows2
+    assert_data_method(csv_data, etl.wrap(rows2), srid)
+
+# header and row counts come from the database without reading the rows
+def test_read_header_and_count(load_point_table, postgis, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name)
+    postgis.dbo.commit()
+    header = db_data1.header()
+    # describing the query doesn't leave a transaction open
+    assert postgis.dbo.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    assert header == tuple(next(iter(db_data1)))
+    assert db_data1.nrows() == etl.nrows(csv_data)
+    postgis.dbo.cursor().execute('ANALYZE {}'.format(table_name))
+    assert db_data1.nrows(estimate=True) == etl.nrows(csv_data)
+
+# raw values are the server's text for them, and are written back as they are
+def test_read_raw(load_point_table, postgis, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    objectid_field = fields.get('object_id_field_name')
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name, decode='raw')
+    rows = list(iter(db_data1))
+    assert all(isinstance(x, RawValue) for x in etl.wrap(rows).values(objectid_field) if x is not None)
+    etl.wrap(rows).topostgis(postgis.dbo, table_name, method='copy')
+    assert_data_method(csv_data, etl.frompostgis(dbo=postgis.dbo, table_name=table_name), srid)
+
+# COPY reads return what cursor reads do, and tocsv writes COPY's csv output
+def test_read_copy(load_point_table, postgis, schema, srid, tmp_path):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name)
+    db_data2 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name, copy_format='binary')
+    assert [row for row in db_data2] == [row for row in db_data1]
+    db_data3 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name, copy_format='text')
+    text_rows = [tuple('' if x is None else x for x in row) for row in db_data3]
+    path = str(tmp_path / 'copy.csv')
+    postgis.dbo.commit()
+    db_data3.tocsv(path)
+    # the COPY doesn't leave a transaction open
+    assert postgis.dbo.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    assert [tuple(row) for row in etl.fromcsv(path)] == text_rows
+
 def test_reading_materialized_view(create_point_view, postgis, schema,srid,csv_data):
     db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name='{}.{}_{}_view'.format(schema, point_table_name, srid))
     assert_data_method(csv_data, db_data1, srid)
@@ -529,3 +666,293 @@ def test_with_types(db_data, postgis, schema, srid,csv_data):
 
     assert_data_method(data1, data2, srid)
 
+
+
+def test_write_copy(postgis, csv_data, schema, srid):
+    csv_data.topostgis(postgis.dbo, '{}.{}_{}'.format(schema, point_table_name, srid),
+                       from_srid=srid, column_definition_json=point_column_definition, method='copy')
+    stmt = '''
+            select {objectid_field_name},{text_field_name},{numeric_field_name},{timestamp_field_name},{date_field_name},
+            {timezone_field_name}, st_astext({shape_field_name}) as {shape_field_name} from {schema}.{point_table_name}_{srid}'''.format(
+        schema=schema,
+        srid=srid,
+        point_table_name=point_table_name,
+        objectid_field_name=fields.get('object_id_field_name'),
+        text_field_name=fields.get('text_field_name'),
+        numeric_field_name=fields.get('numeric_field_name'),
+        timestamp_field_name=fields.get('timestamp_field_name'),
+        date_field_name=fields.get('date_field_name'),
+        shape_field_name=fields.get('shape_field_name'),
+        timezone_field_name=fields.get('timezone_field_name')
+    )
+    cursor = postgis.dbo.cursor()
+    cursor.execute(stmt)
+    assert_data_method(csv_data, cursor, srid)
+
+
+# COPY refuses curves before any rows are removed; insert linearizes them
+@pytest.mark.parametrize('method', ['copy', 'binary'])
+def test_write_curve(load_line_table, postgis, schema, srid, method):
+    table_name = '{}.{}_{}'.format(schema, line_table_name, srid)
+    objectid_field = fields.get('object_id_field_name')
+    shape_field = fields.get('shape_field_name')
+    curve = etl.wrap([(objectid_field, shape_field), (7, 'CIRCULARSTRING(0 0, 1 1, 2 0)')])
+    with pytest.raises(ValueError):
+        curve.topostgis(postgis.dbo, table_name, from_srid=srid, method=method)
+    cursor = postgis.dbo.cursor()
+    cursor.execute('SELECT count(*) FROM {}'.format(table_name))
+    assert cursor.fetchone()[0] == 6
+    curve.appendpostgis(postgis.dbo, table_name, from_srid=srid)
+    cursor.execute('SELECT GeometryType({}) FROM {} WHERE {} = 7'.format(shape_field, table_name, objectid_field))
+    assert cursor.fetchone()[0] == 'LINESTRING'
+
+# a prepared insert linearizes curves in its statement
+def test_write_prepared_curve(load_line_table, postgis, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, line_table_name, srid)
+    objectid_field = fields.get('object_id_field_name')
+    shape_field = fields.get('shape_field_name')
+    curve = etl.wrap([(objectid_field, shape_field), (7, 'CIRCULARSTRING(0 0, 1 1, 2 0)'),
+                      (8, 'LINESTRING(0 0, 1 1)')])
+    curve.appendpostgis(postgis.dbo, table_name, from_srid=srid, method='prepared')
+    cursor = postgis.dbo.cursor()
+    cursor.execute('SELECT GeometryType({0}), ST_SRID({0}) FROM {1} WHERE {2} IN (7, 8) ORDER BY {2}'.format(
+        shape_field, table_name, objectid_field))
+    assert cursor.fetchall() == [('LINESTRING', int(srid)), ('LINESTRING', int(srid))]
+
+# binary COPY round trips: load a fixture with geometries encoded as EWKB on
+# the client, then read it back and compare
+def assert_binary_round_trip(postgis, csv_data, table_name, srid):
+    csv_data.topostgis(postgis.dbo, table_name, from_srid=srid, method='binary')
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name)
+    assert_data_method(csv_data, db_data1, srid)
+
+def test_binary_write_points(load_point_table, postgis, csv_data, schema, srid):
+    assert_binary_round_trip(postgis, csv_data, '{}.{}_{}'.format(schema, point_table_name, srid), srid)
+
+def test_binary_write_lines(load_line_table, postgis, schema, srid):
+    csv_data = etl.fromcsv(line_csv_dir)
+    assert_binary_round_trip(postgis, csv_data, '{}.{}_{}'.format(schema, line_table_name, srid), srid)
+
+def test_binary_write_polygons(load_polygon_table, postgis, schema, srid):
+    csv_data = etl.fromcsv(polygon_csv_dir)
+    assert_binary_round_trip(postgis, csv_data, '{}.{}_{}'.format(schema, polygon_table_name, srid), srid)
+
+def test_binary_write_multipolygons(load_multipolygon_table, postgis, schema, srid):
+    csv_data = etl.fromcsv(multipolygon_csv_dir)
+    assert_binary_round_trip(postgis, csv_data, '{}.{}_{}'.format(schema, multipolygon_table_name, srid), srid)
+
+# geometries that are None, rather than empty strings, go through the binary
+# encoder as NULLs, first row included
+def test_binary_write_null_geometry(load_multipolygon_table, postgis, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, multipolygon_table_name, srid)
+    objectid_field = fields.get('object_id_field_name')
+    shape_field = fields.get('shape_field_name')
+    csv_data = etl.fromcsv(multipolygon_csv_dir)
+    null_row = etl.head(csv_data, 1).convert(objectid_field, lambda v: 999999).convert(shape_field, lambda v: None)
+    etl.cat(null_row, csv_data).topostgis(postgis.dbo, table_name, from_srid=srid, method='binary')
+    cursor = postgis.dbo.cursor()
+    cursor.execute('SELECT {} FROM {} WHERE {} IS NULL'.format(objectid_field, table_name, shape_field))
+    assert [int(x[0]) for x in cursor.fetchall()] == [999999]
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name).select(
+        lambda row: int(row[objectid_field]) != 999999)
+    assert_data_method(csv_data, db_data1, srid)
+
+def test_write_prepared(load_point_table, postgis, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    csv_data.topostgis(postgis.dbo, table_name, from_srid=srid, method='prepared')
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name)
+    assert_data_method(csv_data, db_data1, srid)
+
+# small batches exercise flushing on both the row cap and the byte budget,
+# including a batch holding the first row on its own
+def test_write_small_batches(load_point_table, postgis, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    csv_data.topostgis(postgis.dbo, table_name, from_srid=srid, buffer_size=3, batch_bytes=200)
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name)
+    assert_data_method(csv_data, db_data1, srid)
+
+def test_write_auto_tune(load_point_table, postgis, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    csv_data.topostgis(postgis.dbo, table_name, from_srid=srid, method='copy', buffer_size=1, auto_tune=True)
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name)
+    assert_data_method(csv_data, db_data1, srid)
+
+def test_write_single_transaction(load_point_table, postgis, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    csv_data.topostgis(postgis.dbo, table_name, from_srid=srid, buffer_size=3, commit='single',
+                       synchronous_commit=False)
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name)
+    assert_data_method(csv_data, db_data1, srid)
+
+# a failed single-transaction load leaves the table as it was
+def test_write_single_transaction_rollback(load_point_table, postgis, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    bad_data = etl.cat(csv_data, etl.head(csv_data, 1).convert(fields.get('numeric_field_name'), lambda v: 'abc'))
+    with pytest.raises(psycopg2.Error):
+        bad_data.topostgis(postgis.dbo, table_name, from_srid=srid, buffer_size=3, commit='single', method='copy')
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name)
+    assert_data_method(csv_data, db_data1, srid)
+
+# the source is only read once, e.g. so a query isn't run again
+def test_write_reads_source_once(load_point_table, postgis, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    reads = []
+
+    class CountingTable(etl.Table):
+        def __iter__(self):
+            reads.append(1)
+            return iter(csv_data)
+
+    CountingTable().topostgis(postgis.dbo, table_name, from_srid=srid, method='copy')
+    assert len(reads) == 1
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name)
+    assert_data_method(csv_data, db_data1, srid)
+
+# geometries given as EWKB hex are decoded on the client like WKT
+def test_write_ewkb(load_point_table, postgis, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    shape_field = fields.get('shape_field_name')
+    ewkb_data = csv_data.convert(shape_field, lambda v: geometry.to_ewkb(v, srid).hex() if v else v)
+    ewkb_data.topostgis(postgis.dbo, table_name, from_srid=srid)
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name)
+    assert_data_method(csv_data, db_data1, srid)
+
+# parallel workers write in no particular order, so compare sorted rows
+def test_write_parallel(load_point_table, postgis, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    objectid_field = fields.get('object_id_field_name')
+    csv_data.topostgis(postgis.dbo, table_name, from_srid=srid, buffer_size=2, method='copy', parallel=3)
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name).sort(objectid_field)
+    assert_data_method(csv_data.sort(objectid_field), db_data1, srid)
+
+# a failed worker rolls back every worker, and the truncate
+def test_write_parallel_rollback(load_point_table, postgis, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    bad_data = etl.cat(csv_data, etl.head(csv_data, 1).convert(fields.get('numeric_field_name'), lambda v: 'abc'))
+    with pytest.raises(psycopg2.Error):
+        bad_data.topostgis(postgis.dbo, table_name, from_srid=srid, buffer_size=2, method='copy', parallel=3)
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name)
+    assert_data_method(csv_data, db_data1, srid)
+
+# a connection failing to prepare rolls back the ones already prepared
+def test_write_parallel_prepare_failure(load_point_table, postgis, csv_data, schema, srid, monkeypatch):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    cursor = postgis.dbo.cursor()
+    cursor.execute('SHOW max_prepared_transactions')
+    if int(cursor.fetchone()[0]) < 4:
+        pytest.skip('needs max_prepared_transactions of at least 4')
+    connect = PostgisDatabase.connect
+    prepared = []
+
+    class FailingPrepare(object):
+        def __init__(self, dbo):
+            self._dbo = dbo
+
+        def __getattr__(self, name):
+            return getattr(self._dbo, name)
+
+        def tpc_prepare(self):
+            prepared.append(self)
+            if len(prepared) == 3:
+                raise psycopg2.OperationalError('prepare failed')
+            self._dbo.tpc_prepare()
+
+    monkeypatch.setattr(PostgisDatabase, 'connect', lambda self: FailingPrepare(connect(self)))
+    with pytest.raises(psycopg2.OperationalError):
+        csv_data.topostgis(postgis.dbo, table_name, from_srid=srid, buffer_size=2, method='copy', parallel=3)
+    monkeypatch.undo()
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name)
+    assert_data_method(csv_data, db_data1, srid)
+    cursor.execute("SELECT count(*) FROM pg_prepared_xacts WHERE gid LIKE 'geopetl_%'")
+    assert cursor.fetchone()[0] == 0
+
+# prepared workers leave the commit to the load, so a failed worker leaves an empty table empty
+def test_write_parallel_prepared_rollback(load_point_table, postgis, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    cursor = postgis.dbo.cursor()
+    cursor.execute('TRUNCATE {}'.format(table_name))
+    postgis.dbo.commit()
+    bad_data = etl.cat(csv_data, etl.head(csv_data, 1).convert(fields.get('numeric_field_name'), lambda v: 'abc'))
+    with pytest.raises(psycopg2.Error):
+        bad_data.appendpostgis(postgis.dbo, table_name, from_srid=srid, buffer_size=2, method='prepared',
+                               parallel=3)
+    cursor.execute('SELECT count(*) FROM {}'.format(table_name))
+    assert cursor.fetchone()[0] == 0
+
+# rows the database refuses are written to the reject file instead of failing the load
+def test_write_reject(load_point_table, postgis, csv_data, schema, srid, tmp_path):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    reject_file = str(tmp_path / 'rejects.csv')
+    bad_data = etl.cat(csv_data, etl.head(csv_data, 1).convert(fields.get('numeric_field_name'), lambda v: 'abc'))
+    bad_data.topostgis(postgis.dbo, table_name, from_srid=srid, buffer_size=4, on_error='reject',
+                       reject_file=reject_file)
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name)
+    assert_data_method(csv_data, db_data1, srid)
+    rejects = etl.fromcsv(reject_file)
+    assert etl.nrows(rejects) == 1
+    assert etl.header(rejects)[-1] == 'geopetl_error'
+    assert rejects.values(fields.get('numeric_field_name'))[0] == 'abc'
+
+# swap loads keep the table's indexes
+def test_write_swap(load_point_table, postgis, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    cursor = postgis.dbo.cursor()
+    cursor.execute('CREATE INDEX {}_{}_shape_idx ON {} USING gist ({})'.format(
+        point_table_name, srid, table_name, fields.get('shape_field_name')))
+    postgis.dbo.commit()
+    csv_data.topostgis(postgis.dbo, table_name, from_srid=srid, method='copy', swap=True)
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name)
+    assert_data_method(csv_data, db_data1, srid)
+    cursor.execute("SELECT indexname FROM pg_indexes WHERE schemaname = '{}' AND tablename = '{}_{}'".format(
+        schema, point_table_name, srid))
+    assert [x[0] for x in cursor.fetchall()] == ['{}_{}_shape_idx'.format(point_table_name, srid)]
+
+def test_write_defer_indexes(load_point_table, postgis, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    index_names = ['{}_{}_shape_idx'.format(point_table_name, srid), '{}_{}_text_idx'.format(point_table_name, srid)]
+    cursor = postgis.dbo.cursor()
+    cursor.execute('CREATE INDEX {} ON {} USING gist ({})'.format(index_names[0], table_name, fields.get('shape_field_name')))
+    cursor.execute('CREATE INDEX {} ON {} ({})'.format(index_names[1], table_name, fields.get('text_field_name')))
+    postgis.dbo.commit()
+    csv_data.topostgis(postgis.dbo, table_name, from_srid=srid, defer_indexes=True, index_workers=2,
+                       maintenance_work_mem='64MB')
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name)
+    assert_data_method(csv_data, db_data1, srid)
+    cursor.execute("SELECT indexname FROM pg_indexes WHERE schemaname = '{}' AND tablename = '{}_{}'".format(
+        schema, point_table_name, srid))
+    assert sorted([x[0] for x in cursor.fetchall()]) == sorted(index_names)
+
+def test_upsert(load_point_table, postgis, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    objectid_field = fields.get('object_id_field_name')
+    text_field = fields.get('text_field_name')
+    cursor = postgis.dbo.cursor()
+    cursor.execute('CREATE UNIQUE INDEX ON {} ({})'.format(table_name, objectid_field))
+    postgis.dbo.commit()
+    # update every row, and insert one copied row under a new objectid
+    new_objectid = max(int(x) for x in csv_data.values(objectid_field)) + 1
+    changed = csv_data.convert(text_field, lambda v: 'changed')
+    new_row = etl.head(csv_data, 1).convert(objectid_field, lambda v: new_objectid)
+    counts = etl.cat(changed, new_row).appendpostgis(postgis.dbo, table_name, from_srid=srid, upsert=True,
+                                                      buffer_size=3)
+    assert counts == {'inserted': 1, 'updated': etl.nrows(csv_data)}
+    cursor.execute('SELECT DISTINCT {} FROM {} WHERE {} <> {}'.format(
+        text_field, table_name, objectid_field, new_objectid))
+    assert cursor.fetchall() == [('changed',)]
+
+# only the changed row is updated and the missing row deleted
+def test_write_delta(load_point_table, postgis, csv_data, schema, srid):
+    table_name = '{}.{}_{}'.format(schema, point_table_name, srid)
+    objectid_field = fields.get('object_id_field_name')
+    text_field = fields.get('text_field_name')
+    objectids = list(csv_data.values(objectid_field))
+    changed_data = (csv_data.select(lambda row: row[objectid_field] != objectids[-1])
+                    .convert(text_field, lambda v, row: 'changed' if row[objectid_field] == objectids[0] else v,
+                             pass_row=True))
+    changes = changed_data.topostgis(postgis.dbo, table_name, from_srid=srid, delta=True)
+    assert changes['insert'] == []
+    assert changes['update'] == [objectids[0]]
+    assert len(changes['delete']) == 1
+    assert changes['unchanged'] == len(objectids) - 2
+    db_data1 = etl.frompostgis(dbo=postgis.dbo, table_name=table_name)
+    assert_data_method(changed_data, db_data1, srid)
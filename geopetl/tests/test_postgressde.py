@@ -478,3 +478,12 @@ def test_with_types(db_data, postgis, schema, srid):
                             table_name='{}.{}_{}_2'.format(schema, point_table_name, srid))
     assert_data_method(data1, data2, srid)
 
+
+# object ids come from blocks reserved up front, and don't repeat
+def test_rowid_allocator(postgis, schema, srid):
+    from geopetl.postgis import SdeRowidAllocator
+    table = postgis.table('{}.{}_{}'.format(schema, point_table_name, srid))
+    allocator = SdeRowidAllocator(table, block_size=10)
+    rowids = [allocator.next() for _ in range(25)] + allocator.take(30)
+    assert len(set(rowids)) == 55
+    assert allocator.round_trips == 4
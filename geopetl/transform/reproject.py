@@ -2,6 +2,7 @@ import petl as etl
 from petl import Table
 from petl.compat import text_type
 from geopetl.base import SpatialQuery
+from geopetl import geometry
 
 class ReprojectView(Table):
     def __init__(self, source, to_srid, from_srid=None, geom_field=None):
@@ -28,9 +29,13 @@ class ReprojectView(Table):
 
         for row in it:
             _row = list(row)
-            geom = row[geom_field_i]
-            geom_t = self.tsf.transform(geom)
-            _row[geom_field_i] = geom_t
+            geom = geometry.decode(row[geom_field_i])
+            if geom is not None:
+                geom_t = self.tsf.transform(geometry.to_wkt(geom, force_2d=False))
+                # keep EWKT as EWKT
+                if geom.srid:
+                    geom_t = 'SRID={};{}'.format(self.to_srid, geom_t)
+                _row[geom_field_i] = geom_t
 
             yield tuple(_row)
 